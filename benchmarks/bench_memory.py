@@ -0,0 +1,116 @@
+"""
+Memory held by the history of a long agent session.
+
+Builds a history from simulated ChatGPT streams, the same way PaiConsole does, and
+reports the bytes that stay allocated for each node. The history is built twice: with
+the node data of pai.history, and with the same data in plain dataclasses without
+__slots__ or interned prompts as a baseline.
+
+    PYTHONPATH=src python benchmarks/bench_memory.py --nodes 2000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import openai
+from openai.openai_object import OpenAIObject
+
+from pai.code_exec import SpilledOutput
+from pai.history import HistoryNode, HistoryTree
+from pai.llms.chat_gpt import ChatGPT
+from pai.llms.llm_protocol import LLMResponseCode
+
+
+def fake_stream(message: str, code: str, chunk_size: int = 4):
+    """Chunks shaped like a streamed ChatCompletion with a function call."""
+    arguments = '{"code": "' + code.replace("\n", "\\n") + '"}'
+
+    def chunk(delta, finish_reason=None):
+        return OpenAIObject.construct_from(
+            {
+                "id": "chatcmpl-7abcdefghijklmnopqrstuvwxyz",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "gpt-4-0613",
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+        )
+
+    yield chunk({"role": "assistant", "content": ""})
+    for i in range(0, len(message), chunk_size):
+        yield chunk({"content": message[i : i + chunk_size]})
+    yield chunk({"function_call": {"name": "python", "arguments": ""}})
+    for i in range(0, len(arguments), chunk_size):
+        yield chunk({"function_call": {"arguments": arguments[i : i + chunk_size]}})
+    yield chunk({}, finish_reason="function_call")
+
+
+@dataclass
+class PlainLLMCode:
+    """HistoryNode.LLMCode as a plain dataclass."""
+
+    prompt: str
+    code: str
+    result: str
+    raw_resp: Any
+    spilled_output: Optional[SpilledOutput] = None
+
+
+def build_history(nodes: int, data_class: Callable[..., Any]) -> HistoryTree:
+    llm = ChatGPT("gpt-4")
+    tree = HistoryTree()
+    for i in range(nodes):
+        message = f"Step {i}: look at the files in the directory before changing them."
+        code = f"import os\nfiles_{i} = sorted(os.listdir('.'))\nfiles_{i}[:10]"
+        openai.ChatCompletion.create = lambda **kwargs: fake_stream(message, code)
+
+        gen = llm.call([], "")
+        try:
+            while True:
+                next(gen)
+        except StopIteration as e:
+            resp = e.value
+        assert isinstance(resp, LLMResponseCode)
+
+        tree.add_node(
+            data_class(
+                # a prompt typed by the user is a new string every time
+                prompt=" ".join(["summarize", "the", "files"]),
+                code=resp.code,
+                result=f"['README.md', 'pyproject.toml', 'src']\n",
+                raw_resp=resp.raw,
+            )
+        )
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nodes", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"nodes: {args.nodes}")
+    for name, data_class in [
+        ("plain dataclass", PlainLLMCode),
+        ("HistoryNode.LLMCode", HistoryNode.LLMCode),
+    ]:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tree = build_history(args.nodes, data_class)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        assert len(tree.lineage()) == args.nodes
+        print(f"{name}: {(after - before) / args.nodes:,.0f} bytes per node")
+        del tree
+
+
+if __name__ == "__main__":
+    main()
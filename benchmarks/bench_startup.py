@@ -0,0 +1,91 @@
+"""
+Time from launching pai to the first INP> prompt.
+
+Runs pai in a pseudo terminal, waits for the prompt and exits with Ctrl+D. The time of
+a bare interpreter start is reported too, and of one that imports prompt_toolkit, which
+draws the first prompt. That is the floor for pai. POSIX only.
+
+    PYTHONPATH=src python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import os
+import pty
+import select
+import statistics
+import subprocess
+import sys
+import time
+
+
+def time_to_prompt(args, timeout: float = 30.0) -> float:
+    """Seconds until the output of the command contains the prompt."""
+    main, secondary = pty.openpty()
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        args, stdin=secondary, stdout=secondary, stderr=secondary, close_fds=True
+    )
+    os.close(secondary)
+
+    output = b""
+    elapsed = None
+    try:
+        while time.perf_counter() - start < timeout:
+            ready, _, _ = select.select([main], [], [], 0.01)
+            if ready:
+                try:
+                    output += os.read(main, 4096)
+                except OSError:
+                    break
+                if b"INP>" in output:
+                    elapsed = time.perf_counter() - start
+                    break
+            elif proc.poll() is not None:
+                break
+        # Ctrl+D exits
+        os.write(main, b"\x04")
+        proc.wait(timeout=timeout)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        os.close(main)
+
+    if elapsed is None:
+        raise RuntimeError(f"no prompt from {args}: {output.decode(errors='replace')}")
+    return elapsed
+
+
+def time_to_exit(args) -> float:
+    start = time.perf_counter()
+    subprocess.run(args, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "pai_args", nargs="*", help="Arguments for pai, e.g. --kernel", default=[]
+    )
+    args = parser.parse_args()
+
+    # one run to warm the file system cache and write the bytecode
+    time_to_prompt([sys.executable, "-m", "pai.cli"] + args.pai_args)
+
+    bare = [time_to_exit([sys.executable, "-c", "pass"]) for _ in range(args.runs)]
+    toolkit = [
+        time_to_exit([sys.executable, "-c", "import prompt_toolkit"])
+        for _ in range(args.runs)
+    ]
+    pai = [
+        time_to_prompt([sys.executable, "-m", "pai.cli"] + args.pai_args)
+        for _ in range(args.runs)
+    ]
+
+    print(f"runs: {args.runs}")
+    print(f"python -c pass: {statistics.median(bare) * 1000:.0f} ms")
+    print(f"import prompt_toolkit: {statistics.median(toolkit) * 1000:.0f} ms")
+    print(f"pai to first prompt: {statistics.median(pai) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Benchmarks for the hot paths of the console and the agent loop.
+
+Measures:
+- events per second from PaiConsole.streaming_exec and streaming_code_gen
+- ChatGPT.prompt and LlamaCpp.prompt build time versus history depth
+- HistoryTree.lineage versus history depth
+- custom_run_source overhead per cell, and showing a large value
+
+The LLM is a FakeLLM that streams without waiting, so only pai itself is measured.
+Results are written as JSON, one entry per benchmark, so runs can be compared.
+
+    PYTHONPATH=src python benchmarks/bench_suite.py --output results.json
+    PYTHONPATH=src python benchmarks/bench_suite.py --only prompt --depths 10 100
+"""
+import argparse
+import json
+import platform
+import statistics
+import time
+import timeit
+from typing import Any, Callable, Dict, List, Optional
+
+from pai.code_exec import CodeExec
+from pai.console import PaiConsole, UserCode
+from pai.history import HistoryNode, HistoryTree
+from pai.llms.chat_gpt import ChatGPT
+from pai.llms.fake import FakeLLM
+from pai.version import VERSION
+
+DEFAULT_DEPTHS = [10, 100, 1000, 10000]
+
+
+def measure(fn: Callable[[], Any], repeat: int = 5) -> Dict[str, float]:
+    """Seconds per call of fn. The number of calls per sample is picked like timeit does."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    samples = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "median_s": statistics.median(samples),
+        "min_s": min(samples),
+        "calls": number * repeat,
+    }
+
+
+def measure_each(fns: List[Callable[[], Any]]) -> Dict[str, float]:
+    """Seconds per call when each fn can only be called once."""
+    samples = []
+    for fn in fns:
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(samples),
+        "min_s": min(samples),
+        "calls": len(samples),
+    }
+
+
+def history_data(i: int) -> HistoryNode.Data:
+    """A node like the ones a session adds. Cycles through the node types."""
+    kind = i % 4
+    if kind == 0:
+        return HistoryNode.UserCode(
+            code=f"files_{i} = sorted(os.listdir('.'))",
+            result="",
+        )
+    if kind == 1:
+        return HistoryNode.LLMCode(
+            prompt="summarize the files",
+            code=f"import os\nfiles_{i} = sorted(os.listdir('.'))\nfiles_{i}[:10]",
+            result="['README.md', 'pyproject.toml', 'src']\n",
+            raw_resp=None,
+        )
+    if kind == 2:
+        return HistoryNode.LLMMessage(
+            prompt="what is in the directory?",
+            message="A Python project with a README, a pyproject.toml and a src directory.",
+            raw_resp=None,
+        )
+    return HistoryNode.UserCode(code=f"len(files_{i - 3})", result="3\n")
+
+
+def build_tree(depth: int) -> HistoryTree:
+    tree = HistoryTree()
+    for i in range(depth):
+        tree.add_node(history_data(i))
+    return tree
+
+
+def bench_console(cells: int) -> List[Dict[str, Any]]:
+    results = []
+    console = PaiConsole(FakeLLM(chunk_delay=0))
+    try:
+        for name, run in [
+            ("streaming_exec", lambda: console.streaming_exec(UserCode("x = 1"))),
+            ("streaming_code_gen", lambda: console.streaming_code_gen("list files")),
+        ]:
+            events = 0
+            start = time.perf_counter()
+            for _ in range(cells):
+                for _ in run():
+                    events += 1
+            elapsed = time.perf_counter() - start
+            results.append(
+                {
+                    "name": f"console.{name}",
+                    "params": {"calls": cells},
+                    "events_per_second": events / elapsed,
+                    "mean_s": elapsed / cells,
+                }
+            )
+    finally:
+        console.close()
+    return results
+
+
+def _llama_prompt() -> Optional[Callable[[List[HistoryNode], str], str]]:
+    try:
+        from pai.llms.llama import LlamaCpp
+    except ImportError:
+        return None
+    # prompt() doesn't use the model, so none is loaded
+    return LlamaCpp.prompt.__get__(LlamaCpp.__new__(LlamaCpp))
+
+
+def bench_prompt(depths: List[int]) -> List[Dict[str, Any]]:
+    results = []
+    llama_prompt = _llama_prompt()
+    for depth in depths:
+        tree = build_tree(depth)
+        history = tree.lineage()
+
+        # a new llm has nothing cached
+        results.append(
+            {
+                "name": "ChatGPT.prompt.cold",
+                "params": {"depth": depth},
+                **measure(lambda: ChatGPT("gpt-4").prompt(history, "next")),
+            }
+        )
+
+        # the usual case: the history grew by one node since the last call
+        llm = ChatGPT("gpt-4")
+        llm.prompt(history, "next")
+        appended = []
+        for i in range(depth, depth + 50):
+            tree.add_node(history_data(i))
+            lineage = tree.lineage()
+            appended.append(lambda lineage=lineage: llm.prompt(lineage, "next"))
+        results.append(
+            {
+                "name": "ChatGPT.prompt.append",
+                "params": {"depth": depth},
+                **measure_each(appended),
+            }
+        )
+
+        if llama_prompt is not None:
+            results.append(
+                {
+                    "name": "LlamaCpp.prompt",
+                    "params": {"depth": depth},
+                    **measure(lambda: llama_prompt(history, "next")),  # type: ignore
+                }
+            )
+        else:
+            results.append(
+                {
+                    "name": "LlamaCpp.prompt",
+                    "params": {"depth": depth},
+                    "skipped": "llama_cpp is not installed",
+                }
+            )
+    return results
+
+
+def bench_lineage(depths: List[int]) -> List[Dict[str, Any]]:
+    results = []
+    for depth in depths:
+        tree = build_tree(depth)
+        results.append(
+            {
+                "name": "HistoryTree.lineage",
+                "params": {"depth": depth},
+                **measure(tree.lineage),
+            }
+        )
+        count_tokens = ChatGPT("gpt-4").count_tokens
+        results.append(
+            {
+                "name": "HistoryTree.lineage.max_tokens",
+                "params": {"depth": depth, "max_tokens": 8000},
+                **measure(
+                    lambda: tree.lineage(max_tokens=8000, count_tokens=count_tokens)
+                ),
+            }
+        )
+    return results
+
+
+def bench_run_source(kernel: bool) -> List[Dict[str, Any]]:
+    results = []
+    execs: List[Any] = [("CodeExec", CodeExec())]
+    if kernel:
+        from pai.kernel import KernelExec
+
+        execs.append(("KernelExec", KernelExec()))
+    for name, console in execs:
+        try:
+            # a large value as the trailing expression
+            console.custom_run_source("big = list(range(1_000_000))")
+            for source in ["x = 1", "1 + 1", "print('hello')", "big"]:
+                results.append(
+                    {
+                        "name": f"{name}.custom_run_source",
+                        "params": {"source": source},
+                        **measure(lambda: console.custom_run_source(source)),
+                    }
+                )
+        finally:
+            if hasattr(console, "close"):
+                console.close()
+    return results
+
+
+BENCHMARKS = ["console", "prompt", "lineage", "run_source"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument(
+        "--only", choices=BENCHMARKS, nargs="+", help="Only run these benchmarks"
+    )
+    parser.add_argument("--depths", type=int, nargs="+", default=DEFAULT_DEPTHS)
+    parser.add_argument("--cells", type=int, default=200)
+    parser.add_argument(
+        "--kernel", action="store_true", help="Measure KernelExec as well"
+    )
+    args = parser.parse_args()
+
+    only = args.only or BENCHMARKS
+    results: List[Dict[str, Any]] = []
+    if "console" in only:
+        results += bench_console(args.cells)
+    if "prompt" in only:
+        results += bench_prompt(args.depths)
+    if "lineage" in only:
+        results += bench_lineage(args.depths)
+    if "run_source" in only:
+        results += bench_run_source(args.kernel)
+
+    report = {
+        "pai": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Run the agent on many tasks without the REPL.
+
+Each task runs in its own PaiConsole in agent mode. The generated code is approved
+automatically until the agent answers with a message or the task runs out of steps.
+Tasks are spread over a pool of processes, and the result and history of each task is
+written as a JSON line as soon as it finishes.
+"""
+import json
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
+
+from pai.console import (
+    DEFAULT_INITIAL_CODE_BLOCKS,
+    LLMMessage,
+    PaiConsole,
+    WaitingForInput,
+    WaitingForInputApproval,
+)
+from pai.history import HistoryNode
+from pai.llms.llm_protocol import LLM
+
+if TYPE_CHECKING:
+    from pai.kernel import KernelConfig
+
+
+def load_tasks(path: str) -> List[Dict[str, Any]]:
+    """Read the tasks from a JSON lines file. Blank lines are skipped."""
+    tasks = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                task = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: {e.msg}") from e
+            if not isinstance(task, dict) or not isinstance(task.get("prompt"), str):
+                raise ValueError(
+                    f"{path}:{line_number}: a task needs a prompt, like "
+                    '{"prompt": "count the files in the directory"}'
+                )
+            task.setdefault("id", str(line_number))
+            tasks.append(task)
+    return tasks
+
+
+def run_task(console: PaiConsole, prompt: str, max_steps: int) -> Dict[str, Any]:
+    """
+    Run the agent until it answers with a message or has run max_steps steps.
+
+    A step is running one piece of generated code. Returns the status, the number of
+    steps and the last message of the llm.
+    """
+    status = "done"
+    steps = 0
+    message: Optional[str] = None
+
+    events = console.streaming_code_gen(prompt, agent_mode=True)
+    while events is not None:
+        next_events = None
+        try:
+            for event in events:
+                if isinstance(event, LLMMessage):
+                    message = event.value
+                elif isinstance(event, WaitingForInputApproval):
+                    if steps >= max_steps:
+                        status = "max_steps"
+                        break
+                    # approve the code. in agent mode the llm is called again after it runs
+                    steps += 1
+                    next_events = console.streaming_exec(event.code)
+                    break
+                elif isinstance(event, WaitingForInput):
+                    break
+        finally:
+            events.close()
+        events = next_events
+
+    if isinstance(console.history_tree.cursor.data, HistoryNode.LLMError):
+        status = "error"
+    return {"status": status, "steps": steps, "message": message}
+
+
+# the llm of this worker process
+_llm: Optional[LLM] = None
+
+
+def _init_worker(llm_factory: Callable[[], LLM]):
+    global _llm
+    _llm = llm_factory()
+
+
+def _run_in_worker(
+    index: int,
+    task: Dict[str, Any],
+    llm_context_tokens: Optional[int],
+    summarize_after: Optional[int],
+    namespace_digest: bool,
+    kernel: Optional["KernelConfig"],
+    max_steps: int,
+) -> Dict[str, Any]:
+    assert _llm is not None
+    start = time.perf_counter()
+    record: Dict[str, Any] = {
+        "index": index,
+        "id": task["id"],
+        "prompt": task["prompt"],
+    }
+    console = None
+    try:
+        console = PaiConsole(
+            _llm,
+            llm_context_tokens=llm_context_tokens,
+            summarize_after=summarize_after,
+            namespace_digest=namespace_digest,
+            initial_code_blocks=DEFAULT_INITIAL_CODE_BLOCKS,
+            kernel=kernel,
+        )
+        record.update(
+            run_task(console, task["prompt"], task.get("max_steps", max_steps))
+        )
+    except Exception:
+        record.update(status="failed", error=traceback.format_exc())
+    finally:
+        if console is not None:
+            record["history"] = [
+                node.to_dict() for node in console.history_tree.lineage()
+            ]
+            console.close()
+        record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def _failed_record(index: int, task: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "index": index,
+        "id": task["id"],
+        "prompt": task["prompt"],
+        "status": "failed",
+        "error": "The worker process died.",
+    }
+
+
+def _run_pool(
+    tasks: List[Dict[str, Any]],
+    indices: Iterable[int],
+    workers: int,
+    llm_factory: Callable[[], LLM],
+    args: Tuple[Any, ...],
+    write: Callable[[Dict[str, Any]], None],
+) -> Tuple[List[int], List[int]]:
+    """
+    Run the tasks in a new pool, at most workers at a time, and write their records.
+
+    A worker that dies, e.g. because the code the agent wrote called os._exit() or
+    crashed, breaks the pool. Then the tasks that were running and the ones not started
+    yet are returned, so they can be run again.
+    """
+    queue = deque(indices)
+    running: Dict["Future[Dict[str, Any]]", int] = {}
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(llm_factory,)
+    ) as pool:
+        try:
+            while queue or running:
+                while queue and len(running) < workers:
+                    index = queue.popleft()
+                    future = pool.submit(_run_in_worker, index, tasks[index], *args)
+                    running[future] = index
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                if any(isinstance(f.exception(), BrokenProcessPool) for f in finished):
+                    # the pool is broken. the other running tasks fail right away
+                    wait(running)
+                    finished = set(running)
+                broken = []
+                for future in finished:
+                    index = running.pop(future)
+                    try:
+                        record = future.result()
+                    except BrokenProcessPool:
+                        broken.append(index)
+                        continue
+                    write(record)
+                if broken:
+                    return sorted(broken), list(queue)
+        except KeyboardInterrupt:
+            for future in running:
+                future.cancel()
+            raise
+    return [], []
+
+
+def run_batch(
+    tasks: List[Dict[str, Any]],
+    output: TextIO,
+    llm_factory: Callable[[], LLM],
+    llm_context_tokens: Optional[int] = None,
+    kernel: Optional["KernelConfig"] = None,
+    max_steps: int = 10,
+    summarize_after: Optional[int] = None,
+    namespace_digest: bool = False,
+    workers: int = 4,
+):
+    """
+    Run the tasks from load_tasks() in a pool of worker processes.
+
+    llm_factory is called once in each worker, so it has to be picklable, e.g. a
+    module level function. A JSON line is written to output for each task as it
+    finishes, with its index in the file so the order can be restored. Progress is
+    shown on stderr.
+
+    A task that kills its worker is recorded as failed. The other tasks that were
+    running with it are run again, each on its own, to find the one that crashed.
+    """
+    args = (llm_context_tokens, summarize_after, namespace_digest, kernel, max_steps)
+    done = 0
+
+    def write(record: Dict[str, Any]):
+        nonlocal done
+        done += 1
+        output.write(json.dumps(record, default=str) + "\n")
+        output.flush()
+        print(
+            f"[{done}/{len(tasks)}] {record['id']}: {record['status']}"
+            f", {record.get('steps', 0)} steps",
+            file=sys.stderr,
+        )
+
+    running, queued = _run_pool(
+        tasks, range(len(tasks)), workers, llm_factory, args, write
+    )
+    while running or queued:
+        for index in running:
+            if len(running) == 1:
+                write(_failed_record(index, tasks[index]))
+                continue
+            crashed, _ = _run_pool(tasks, [index], 1, llm_factory, args, write)
+            if crashed:
+                write(_failed_record(index, tasks[index]))
+        running, queued = _run_pool(tasks, queued, workers, llm_factory, args, write)
@@ -1,12 +1,15 @@
 import argparse
+import sys
+from typing import TYPE_CHECKING, List, Optional
 
-from pai.repl import REPL
 from pai.version import VERSION
 
+if TYPE_CHECKING:
+    from pai.kernel import KernelConfig
+    from pai.llms.llm_protocol import LLM
 
-def parse_args():
-    parser = argparse.ArgumentParser(description="pai")
 
+def _add_llm_arguments(parser: argparse.ArgumentParser):
     group = parser.add_mutually_exclusive_group()
 
     group.add_argument(
@@ -28,6 +31,132 @@ def parse_args():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--llm-context-tokens",
+        help="Only use the newest history that fits in this many tokens as llm "
+        "context. The system prompt and the prompt count towards it.",
+        metavar="TOKENS",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--summarize-after",
+        help="Once the history is longer than N nodes, send the oldest nodes to the llm "
+        "as a summary that it writes. Each summary is written once and reused.",
+        metavar="N",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--namespace-digest",
+        help="Send the llm a short description of the variables that exist, and only "
+        "the start of the long outputs of older cells.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cache",
+        help="Cache llm responses on disk and replay them for the same prompt.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-path",
+        help="Where to keep the llm cache. Uses ~/.cache/pai/llm_cache.sqlite3 if not "
+        "given. Implies --cache.",
+        metavar="PATH",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Evict the least recently used responses when the cache is larger than this.",
+        metavar="MB",
+        type=int,
+        default=100,
+    )
+
+
+def _add_kernel_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--kernel",
+        help="Run code in a separate worker process that can be interrupted and restarted.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cell-timeout",
+        help="Interrupt code that runs longer than this. Implies --kernel.",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--memory-limit",
+        help="Limit the memory of the worker process. Implies --kernel.",
+        metavar="MB",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--cpu-limit",
+        help="Limit the CPU time of each cell. Implies --kernel.",
+        metavar="SECONDS",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--snapshots",
+        help="Keep copy-on-write snapshots of the namespace after the last N cells, so "
+        "going back to an earlier node of the history restores its state. No snapshot "
+        "is taken while threads started by the code run. Implies --kernel.",
+        metavar="N",
+        type=int,
+        default=None,
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="pai",
+        epilog="Run 'pai batch --help' to run tasks from a file without the REPL, "
+        "or 'pai serve --help' to serve sessions over a local HTTP API.",
+    )
+
+    _add_llm_arguments(parser)
+
+    parser.add_argument(
+        "--session",
+        help="Save the history to this file as it grows.",
+        metavar="PATH",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue the newest history in the --session file. "
+        "Uses ~/.local/share/pai/session.sqlite3 if --session is not given.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--retrieve",
+        help="Also give the llm the K nodes from anywhere in the history that match the "
+        "prompt best, e.g. from other branches or too old to fit in the context.",
+        metavar="K",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="Write how long each phase of each turn takes to this file. "
+        "A .json file gets Chrome trace events, anything else gets JSON lines.",
+        metavar="PATH",
+        type=str,
+        default=None,
+    )
+
+    _add_kernel_arguments(parser)
+
     parser.add_argument(
         "--version",
         help="Print the version and exit.",
@@ -39,12 +168,99 @@ def parse_args():
         "prompt", help="The initial prompt for the LLM agent", nargs="?", default=""
     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def parse_batch_args(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="pai batch",
+        description="Run the agent on each task in a JSON lines file without the REPL. "
+        'Each line is an object like {"id": "t1", "prompt": "...", "max_steps": 10}. '
+        "Only prompt is required. The code the agent generates is run without approval.",
+    )
+    parser.add_argument("tasks", help="The JSON lines file with the tasks.")
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Write a JSON line with the result and history of each task here, "
+        "in the order they finish. Defaults to stdout.",
+        metavar="PATH",
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Run this many tasks at the same time, each in a process. Tasks mostly wait "
+        "for the llm, so this can be more than the number of CPUs.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--max-steps",
+        help="Stop a task after running this much generated code, unless the task sets max_steps.",
+        type=int,
+        default=10,
+    )
+
+    _add_llm_arguments(parser)
+    _add_kernel_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def parse_serve_args(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="pai serve",
+        description="Serve console sessions over a local HTTP API. Console events are "
+        "streamed as JSON lines. See pai/server.py for the endpoints. Code runs in a "
+        "kernel process per session unless --in-process is given.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--unix-socket",
+        help="Listen on this Unix socket instead of --host and --port.",
+        metavar="PATH",
+        default=None,
+    )
+    parser.add_argument(
+        "--token",
+        help="The bearer token clients must send. Defaults to $PAI_TOKEN, "
+        "or a random token that is printed at startup.",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-llm-calls",
+        help="The most llm calls in flight across all sessions.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--max-sessions",
+        help="The most sessions that can be open at the same time.",
+        type=int,
+        default=32,
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        help="Close sessions that haven't been used for this long.",
+        metavar="SECONDS",
+        type=float,
+        default=30 * 60,
+    )
+    parser.add_argument(
+        "--in-process",
+        help="Run the code of every session in the server process instead of a kernel per session.",
+        action="store_true",
+    )
+
+    _add_llm_arguments(parser)
+    _add_kernel_arguments(parser)
+
+    return parser.parse_args(argv)
+
 
+def make_llm(args: argparse.Namespace) -> "LLM":
+    """The llm chosen by the llm arguments."""
     if args.llama_cpp:
         from pai.llms.llama import LlamaCpp
 
@@ -58,7 +274,142 @@ def main():
 
         llm = ChatGPT(args.openai)
 
-    REPL(llm, args.prompt)
+    if args.cache or args.cache_path is not None:
+        from pai.llms.cache import DEFAULT_CACHE_PATH, CachedLLM
+
+        llm = CachedLLM(
+            llm,
+            path=args.cache_path or DEFAULT_CACHE_PATH,
+            max_size=args.cache_size * 1024 * 1024,
+        )
+    return llm
+
+
+def make_kernel_config(args: argparse.Namespace) -> Optional["KernelConfig"]:
+    """The kernel config chosen by the kernel arguments. None to run code in process."""
+    if (
+        args.kernel
+        or args.cell_timeout
+        or args.memory_limit
+        or args.cpu_limit
+        or args.snapshots
+    ):
+        from pai.kernel import KernelConfig
+
+        return KernelConfig(
+            timeout=args.cell_timeout,
+            memory_limit=args.memory_limit * 1024 * 1024 if args.memory_limit else None,
+            cpu_limit=args.cpu_limit,
+            snapshots=args.snapshots or 0,
+        )
+    return None
+
+
+def batch_main(argv: List[str]):
+    import functools
+
+    from pai.batch import load_tasks, run_batch
+
+    args = parse_batch_args(argv)
+    try:
+        tasks = load_tasks(args.tasks)
+    except (OSError, ValueError) as e:
+        sys.exit(f"pai batch: {e}")
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        run_batch(
+            tasks,
+            output,
+            # each worker process makes its own llm
+            llm_factory=functools.partial(make_llm, args),
+            llm_context_tokens=args.llm_context_tokens,
+            kernel=make_kernel_config(args),
+            max_steps=args.max_steps,
+            workers=args.workers,
+            summarize_after=args.summarize_after,
+            namespace_digest=args.namespace_digest,
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def serve_main(argv: List[str]):
+    import asyncio
+    import os
+    import secrets
+
+    from pai.server import PaiServer
+
+    args = parse_serve_args(argv)
+    kernel = make_kernel_config(args)
+    if kernel is None and not args.in_process:
+        from pai.kernel import KernelConfig
+
+        kernel = KernelConfig()
+
+    token = args.token or os.environ.get("PAI_TOKEN") or secrets.token_urlsafe(24)
+    server = PaiServer(
+        make_llm(args),
+        token=token,
+        kernel=kernel,
+        llm_context_tokens=args.llm_context_tokens,
+        summarize_after=args.summarize_after,
+        namespace_digest=args.namespace_digest,
+        max_llm_calls=args.max_llm_calls,
+        max_sessions=args.max_sessions,
+        idle_timeout=args.idle_timeout,
+    )
+
+    where = args.unix_socket or f"http://{args.host}:{args.port}"
+    print(f"pai v{VERSION} serving on {where}")
+    if not (args.token or os.environ.get("PAI_TOKEN")):
+        print(f"token: {token}")
+    try:
+        asyncio.run(server.serve(args.host, args.port, unix_path=args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    if sys.argv[1:2] == ["batch"]:
+        return batch_main(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        return serve_main(sys.argv[2:])
+
+    args = parse_args()
+
+    llm = make_llm(args)
+    kernel = make_kernel_config(args)
+
+    session_store = None
+    if args.session or args.resume:
+        from pai.session import DEFAULT_SESSION_PATH, SessionStore
+
+        session_store = SessionStore(args.session or DEFAULT_SESSION_PATH)
+
+    telemetry = None
+    if args.trace:
+        from pai.telemetry import Telemetry, TraceFile
+
+        telemetry = Telemetry(TraceFile(args.trace))
+
+    # prompt_toolkit is slow to import. --help and --version don't need it
+    from pai.repl import REPL
+
+    REPL(
+        llm,
+        args.prompt,
+        llm_context_tokens=args.llm_context_tokens,
+        kernel=kernel,
+        session_store=session_store,
+        resume=args.resume,
+        telemetry=telemetry,
+        retrieve=args.retrieve,
+        summarize_after=args.summarize_after,
+        namespace_digest=args.namespace_digest,
+    )
 
 
 if __name__ == "__main__":
@@ -1,33 +1,427 @@
 import ast
+import builtins
 import code
+import ctypes
+import functools
 import io
+import mmap
+import os
+import queue
 import sys
+import tempfile
+import textwrap
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import CodeType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from pai.digest import NamespaceDigest
+from pai.display import PAGE_CHARS, safe_repr
+from pai.replay import CellNames, tree_names
+
+# how many characters of the start and end of the output are kept in memory
+DEFAULT_OUTPUT_HEAD = 10_000
+DEFAULT_OUTPUT_TAIL = 10_000
+# how many compiled cells are kept, e.g. for agent retries and replays
+COMPILE_CACHE_SIZE = 256
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_cell(
+    source: str,
+) -> Tuple[Optional[CodeType], Optional[CodeType], CellNames]:
+    """
+    Compile a cell with a single parse.
+
+    Returns the code of the statements, the code of the trailing expression, if the
+    cell ends with one, and the names the cell uses. The expression is compiled in
+    "eval" mode so its value can be shown. Either code is None if there is nothing to
+    run.
+    Raises SyntaxError if the cell doesn't parse.
+    """
+    tree = ast.parse(source, "<string>", "exec")
+    names = tree_names(tree)
+    last = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        expr = ast.Expression(body=tree.body.pop().value)  # type: ignore
+        last = compile(expr, "<string>", "eval")
+    body = compile(tree, "<string>", "exec") if tree.body else None
+    return body, last, names
+
+
+class SpilledOutput:
+    """
+    Output that was too large to keep in memory.
+
+    It is stored in a temp file that is removed when the SpilledOutput is garbage collected.
+    Use read() to page it back in.
+    """
+
+    def __init__(self, path: str, size: int = 0):
+        self.path = path
+        # size in bytes
+        self.size = size
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    def read(self, offset: int = 0, size: Optional[int] = None) -> str:
+        """Read size bytes of the output starting at offset. Reads to the end if size is None."""
+        if self.size == 0:
+            return ""
+        end = self.size if size is None else min(self.size, offset + size)
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[offset:end].decode("utf-8", errors="replace")
+
+    def __repr__(self):
+        return f"SpilledOutput(path={self.path!r}, size={self.size})"
+
+
+class OutputCapture(io.TextIOBase):
+    """
+    Collects the output of code execution.
+
+    The first head_size and the last tail_size characters are kept in memory.
+    Everything in between is spilled to a temp file.
+    """
+
+    def __init__(
+        self,
+        head_size: int = DEFAULT_OUTPUT_HEAD,
+        tail_size: int = DEFAULT_OUTPUT_TAIL,
+        on_write: Optional[Callable[[str], None]] = None,
+    ):
+        super().__init__()
+        self.on_write = on_write
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self._head: List[str] = []
+        self._head_len = 0
+        self._tail: List[str] = []
+        self._tail_len = 0
+        self._spill: Optional[SpilledOutput] = None
+        self._spill_file = None
+        self.spilled_chars = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        n = len(s)
+        if self.on_write is not None and s:
+            self.on_write(s)
+        if self._head_len < self.head_size:
+            head = s[: self.head_size - self._head_len]
+            self._head.append(head)
+            self._head_len += len(head)
+            s = s[len(head) :]
+
+        if s:
+            self._tail.append(s)
+            self._tail_len += len(s)
+            # trim lazily so every write doesn't have to join the tail
+            if self._tail_len > 2 * self.tail_size:
+                self._trim_tail()
+        return n
+
+    def _trim_tail(self):
+        overflow = self._tail_len - self.tail_size
+        if overflow <= 0:
+            return
+        tail = "".join(self._tail)
+        self._write_spill(tail[:overflow])
+        tail = tail[overflow:]
+        self._tail = [tail] if tail else []
+        self._tail_len = len(tail)
+
+    def _write_spill(self, text: str):
+        if self._spill is None:
+            f = tempfile.NamedTemporaryFile(prefix="pai-output-", delete=False)
+            self._spill = SpilledOutput(f.name)
+            self._spill_file = f
+        data = text.encode("utf-8", errors="replace")
+        self._spill_file.write(data)  # type: ignore
+        self._spill.size += len(data)
+        self.spilled_chars += len(text)
+
+    def getvalue(self) -> str:
+        """Get the output that is kept in memory."""
+        self._trim_tail()
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self.spilled_chars:
+            return head + tail
+        return f"{head}\n... {self.spilled_chars} characters of output not shown ...\n{tail}"
+
+    def spilled(self) -> Optional[SpilledOutput]:
+        """Get the output that was spilled to disk, if there was any."""
+        self._trim_tail()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        return self._spill
+
+
+class _ThreadRouter(io.TextIOBase):
+    """
+    Replaces sys.stdout and sys.stderr while code runs.
+
+    Writes go to the capture of the context they are made in. A cell or a job sets it
+    for its own context. Threads don't inherit it, so writes from a thread without a
+    capture, e.g. one the cell started or a ThreadPoolExecutor worker, go to the
+    capture of the main thread, where the REPL runs cells, if it has one. Otherwise
+    they go to the original stream.
+    """
+
+    def __init__(self, stream: TextIO):
+        super().__init__()
+        self.stream = stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        capture = _current_capture()
+        if capture is None:
+            return self.stream.write(s)
+        return capture.write(s)
+
+    def flush(self):
+        if _current_capture() is None:
+            self.stream.flush()
+
+    def isatty(self) -> bool:
+        return _current_capture() is None and self.stream.isatty()
+
+    @property
+    def encoding(self):  # type: ignore
+        return self.stream.encoding
+
+
+# the capture of the context. _UNCAPTURED writes to the original stream
+_capture: "ContextVar[Any]" = ContextVar("pai_capture", default=None)
+_UNCAPTURED = object()
+# the capture of the main thread, for writes from threads without one
+_main_capture: Optional[OutputCapture] = None
+# how many captures are active. the routers are installed while there are any
+_active_captures = 0
+_captures_lock = threading.Lock()
+
+
+def _current_capture() -> Optional[OutputCapture]:
+    capture = _capture.get()
+    if capture is None:
+        return _main_capture
+    if capture is _UNCAPTURED:
+        return None
+    return capture
+
+
+@contextmanager
+def capture_output(capture: OutputCapture):
+    """Capture what the code running in this context writes to stdout and stderr."""
+    global _main_capture, _active_captures
+    main = threading.current_thread() is threading.main_thread()
+    with _captures_lock:
+        if not _active_captures:
+            # a router can be left in sys.stdout, e.g. by code that saved it while it
+            # was installed and put it back later. it is reused, not wrapped again
+            if not isinstance(sys.stdout, _ThreadRouter):
+                sys.stdout = _ThreadRouter(sys.stdout)
+            if not isinstance(sys.stderr, _ThreadRouter):
+                sys.stderr = _ThreadRouter(sys.stderr)
+        _active_captures += 1
+        # code that is running can run more code, e.g. by creating a console
+        outer = _main_capture
+        if main:
+            _main_capture = capture
+    token = _capture.set(capture)
+    try:
+        yield capture
+    finally:
+        _capture.reset(token)
+        with _captures_lock:
+            if main:
+                _main_capture = outer
+            _active_captures -= 1
+            if not _active_captures:
+                if isinstance(sys.stdout, _ThreadRouter):
+                    sys.stdout = sys.stdout.stream
+                if isinstance(sys.stderr, _ThreadRouter):
+                    sys.stderr = sys.stderr.stream
+
+
+@contextmanager
+def uncaptured():
+    """Write to the original stdout and stderr from this context, even while code runs."""
+    token = _capture.set(_UNCAPTURED)
+    try:
+        yield
+    finally:
+        _capture.reset(token)
+
+
+class OutputReader:
+    """
+    Passes output to a callback on a thread of its own, as it is written.
+
+    This shows the output of code that runs on the main thread, e.g. so it can set
+    signal handlers, while it runs. What the callback writes isn't captured.
+    """
+
+    def __init__(self, on_output: Callable[[str], None]):
+        self.on_output = on_output
+        self._chunks: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._read, name="pai-output-reader", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, text: str):
+        self._chunks.put(text)
+
+    def close(self):
+        """Wait until the output that was put has been passed on."""
+        self._chunks.put(None)
+        self._thread.join()
+
+    def _read(self):
+        with uncaptured():
+            done = False
+            while not done:
+                parts = [self._chunks.get()]
+                # join everything that is already waiting into one chunk
+                while parts[-1] is not None:
+                    try:
+                        parts.append(self._chunks.get_nowait())
+                    except queue.Empty:
+                        break
+                done = parts[-1] is None
+                text = "".join(part for part in parts if part is not None)
+                if text:
+                    self.on_output(text)
+
+
+class Job:
+    """A cell running on a background thread. Started with bg()."""
+
+    def __init__(self, id: int, source: str):
+        self.id = id
+        self.source = source
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        # the output, like custom_run_source returns it
+        self.result: Optional[str] = None
+        self.spill: Optional[SpilledOutput] = None
+        # the result was shown by wait() or added to the history
+        self.collected = False
+        self.done = threading.Event()
+
+    def __repr__(self):
+        status = "done" if self.done.is_set() else "running"
+        seconds = (self.finished or time.time()) - self.started
+        lines = self.source.strip().splitlines() or [""]
+        first = lines[0] + (" ..." if len(lines) > 1 else "")
+        return f"[{self.id}] {status} {seconds:.1f}s: {first}"
+
+
+# a job that finished: id, source, result and spilled output
+FinishedJob = Tuple[int, str, str, Optional[SpilledOutput]]
 
 
 class CodeExec(code.InteractiveConsole):
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        output_head: int = DEFAULT_OUTPUT_HEAD,
+        output_tail: int = DEFAULT_OUTPUT_TAIL,
+        # add bg(), jobs() and wait() to the namespace
+        background_jobs: bool = False,
+        **kwargs,
+    ):
+        # the exception of the code running on each thread, for jobs running next to
+        # the foreground code
+        self._exception = threading.local()
         super().__init__(*args, **kwargs)
-        self.last_exception = None
+        self.output_head = output_head
+        self.output_tail = output_tail
+        # the output of the last run that didn't fit in memory
+        self.last_spill: Optional[SpilledOutput] = None
+        # the last run raised or didn't compile
+        self.last_failed = False
+        # see KernelExec.snapshot_skipped. snapshots are never taken in process
+        self.snapshot_skipped: Optional[str] = None
+        # the thread running code from custom_run_source
+        self._running: Optional[threading.Thread] = None
+        # code that is run again after a restart
+        self.startup_code: List[str] = []
+        # cells running on background threads by id
+        self.jobs: Dict[int, Job] = {}
+        if background_jobs:
+            self.locals.update(self.job_functions())
+        # the last value that display() cut, for page(), and the last repr it made
+        self._cut_value: Any = None
+        self._page_cache: Optional[Tuple[Any, str]] = None
+        self.locals.setdefault("page", self.page)
+        self._initial_locals = dict(self.locals)
+        self._digest = NamespaceDigest(skip=self._initial_locals)
+        # the names touched since the digest was updated. None for all of them
+        self._touched: Optional[Set[str]] = None
+
+    def restart(self):
+        """Reset the namespace to its initial state and run the startup code again."""
+        self.locals.clear()
+        self.locals.update(self._initial_locals)
+        self.resetbuffer()
+        self._touched = None
+        self._cut_value = self._page_cache = None
+        for source in self.startup_code:
+            self.custom_run_source(source)
+
+    def close(self):
+        """Release the resources held by the executor."""
+        self.interrupt()
+
+    @property
+    def last_exception(self) -> Optional[BaseException]:
+        """The exception raised by the code running on the current thread."""
+        return getattr(self._exception, "value", None)
+
+    @last_exception.setter
+    def last_exception(self, value: Optional[BaseException]):
+        self._exception.value = value
 
     def showtraceback(self, *args, **kwargs):
         """Override the default traceback behavior to store the last exception."""
         self.last_exception = sys.exc_info()[1]
         super().showtraceback(*args, **kwargs)
 
-    def _is_expression(self, code: str) -> bool:
-        """Check if the given code is an expression."""
-        try:
-            ast.parse(code, mode="eval")
-            return True
-        except:
-            return False
-
-    def custom_run_source(self, source: str) -> str:
+    def custom_run_source(
+        self, source: str, on_output: Optional[Callable[[str], None]] = None
+    ) -> str:
         """
         Push a block of code and get the string output.
 
-        This behaves like a REPL. If the last line of the code
-        is an expression, it is evaluated and the result is added to the output.
+        This behaves like a REPL. If the code ends with an expression,
+        it is evaluated and the result is added to the output.
 
         For example:
         source:
@@ -38,6 +432,13 @@ class CodeExec(code.InteractiveConsole):
         If a block of code is given, the output is printed and the last expression
         is returned.
 
+        Only the start and end of a large output is returned. The rest is
+        available from last_spill.
+
+        on_output is called with the output as it is written, on the thread that
+        writes it. The code runs on the calling thread, so it can set signal handlers
+        when that is the main thread. interrupt() stops it from another thread.
+
         source:
             def add(a, b):
                 print("Adding a and b")
@@ -46,48 +447,193 @@ class CodeExec(code.InteractiveConsole):
         returns:
             "Adding a and b\n3"
         """
-        collector = io.StringIO()
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        sys.stdout = collector
-        sys.stderr = collector
-
-        all_lines = source.strip().split("\n")
-        last_line = all_lines[-1]
-
-        # If the last line of the full_code is an expression, evaluate it after executing the rest
-        if self._is_expression(last_line):
-            # Execute all lines except the last one
-            exec_code = "\n".join(all_lines[:-1])
-            try:
-                compiled_code = compile(exec_code, "<string>", "exec")
-                self.runcode(compiled_code)
-
-                # if there was not exception, then we can evaluate the last line
-                if not self.last_exception:
-                    self.push(last_line)
-            except Exception as e:
-                # handle an error compiling the exec_code
-                sys.stdout = original_stdout
-                sys.stderr = original_stderr
-                return f"{e}"
+        self.last_spill = None
+        collector = OutputCapture(self.output_head, self.output_tail, on_output)
+        outer, self._running = self._running, threading.current_thread()
+        try:
+            output, self.last_failed = self._run_cell(source, collector)
+        finally:
+            self._running = outer
+        self.last_spill = collector.spilled()
+        return output
+
+    def _run_cell(self, source: str, collector: OutputCapture) -> Tuple[str, bool]:
+        """
+        Run the source with its output captured by the collector. Returns the output and
+        whether the cell failed.
+        """
+        try:
+            body, last, names = compile_cell(source.strip())
+        except (SyntaxError, ValueError) as e:
+            # ValueError is raised for source with null bytes
+            return f"{e}\n", True
+        self._touch(names)
+
+        with capture_output(collector):
+            if body is not None:
+                self.runcode(body)
+            # the trailing expression is only shown if the statements didn't raise
+            if last is not None and not self.last_exception:
+                self.run_expression(last)
+
+            # clear the last exception
+            failed = self.last_exception is not None
+            self.last_exception = None
+
+        # get the output from the collector
+        return collector.getvalue(), failed
+
+    def run_expression(self, code: CodeType):
+        """Evaluate the trailing expression of a cell and display its value."""
+        try:
+            value = eval(code, self.locals)
+        except SystemExit:
+            raise
+        except BaseException:
+            # like runcode
+            self.showtraceback()
+        else:
+            self.display(value)
+
+    def display(self, value: Any):
+        """
+        Print the value like sys.displayhook, but with safe_repr() so a large value
+        doesn't take long. page() shows the full repr of a value that was cut.
+        """
+        if value is None:
+            return
+        builtins._ = value  # type: ignore
+        text, cut = safe_repr(value)
+        if cut:
+            self._cut_value = value
+            text += "\n(cut. page() shows all of it)"
+        print(text)
+
+    def page(self, value: Any = None, start: int = 0, size: int = PAGE_CHARS):
+        """
+        Show the full repr of the value from the character at start, size characters
+        at a time. Shows the last value that was cut if no value is given.
+        """
+        if value is None:
+            value = self._cut_value
+        if value is None:
+            print("Nothing was cut")
+            return
+        # the repr of the last value is kept, so paging through it doesn't repeat it
+        cached = self._page_cache
+        if cached is not None and cached[0] is value:
+            text = cached[1]
         else:
-            # If the last line is not an expression, try to compile and execute the full_code
+            text = repr(value)
+            self._page_cache = (value, text)
+        end = min(len(text), start + size)
+        print(text[start:end])
+        if end < len(text):
+            print(
+                f"({start}-{end} of {len(text)} characters. page(start={end}) for more)"
+            )
+
+    def _touch(self, names: CellNames):
+        """Remember the names a cell can change for namespace_digest()."""
+        if self._touched is None:
+            return
+        if names.opaque:
+            self._touched = None
+        else:
+            self._touched |= names.stores | names.mutates | names.calls_on
+
+    def namespace_digest(self) -> str:
+        """
+        A short description of the variables, see pai.digest. Only the names touched
+        since the last call are described again.
+        """
+        touched, self._touched = self._touched, set()
+        self._digest.update(self.locals, touched)
+        return self._digest.text()
+
+    def start_job(self, source: str) -> Job:
+        """
+        Run the source on a background thread, like custom_run_source.
+
+        The job shares the namespace but has its own output capture, so code can keep
+        running in the foreground. The result is kept on the Job.
+        """
+        job = Job(max(self.jobs, default=0) + 1, source)
+        self.jobs[job.id] = job
+
+        def run():
+            collector = OutputCapture(self.output_head, self.output_tail)
             try:
-                compiled_code = compile(source, "<string>", "exec")
-                self.runcode(compiled_code)
-            except SyntaxError as e:
-                sys.stdout = original_stdout
-                sys.stderr = original_stderr
-                return f"{e}\n"
+                job.result, _ = self._run_cell(source, collector)
+                job.spill = collector.spilled()
+            except BaseException as e:
+                # e.g. SystemExit, which runcode doesn't catch
+                job.result = f"{type(e).__name__}: {e}\n"
+            finally:
+                job.finished = time.time()
+                job.done.set()
 
-        # clear the last exception
-        self.last_exception = None
+        threading.Thread(target=run, name=f"pai-job-{job.id}", daemon=True).start()
+        return job
 
-        # restore stdout and stderr
-        sys.stdout = original_stdout
-        sys.stderr = original_stderr
+    def take_finished_jobs(self) -> List[FinishedJob]:
+        """The jobs that finished since the last call, except the ones shown by wait()."""
+        finished = []
+        for job in list(self.jobs.values()):
+            if job.done.is_set() and not job.collected:
+                job.collected = True
+                finished.append((job.id, job.source, job.result or "", job.spill))
+        return finished
 
-        # get the output from the collector
-        output = collector.getvalue()
-        return output
+    def snapshot(self) -> Optional[int]:
+        """Snapshots need a process to fork. Only KernelExec has them, so this returns None."""
+        return None
+
+    def restore(self, snapshot: int) -> bool:
+        """See KernelExec.restore. There are no snapshots to restore in process."""
+        return False
+
+    def job_functions(self) -> Dict[str, Callable]:
+        """The bg(), jobs() and wait() commands for the namespace."""
+
+        def bg(source: str) -> Job:
+            """Run the code on a background thread. Use jobs() and wait() to follow it."""
+            return self.start_job(textwrap.dedent(source))
+
+        def jobs():
+            """Show the background jobs."""
+            for job in self.jobs.values():
+                print(job)
+
+        def wait(id: Optional[int] = None, timeout: Optional[float] = None):
+            """Wait for a background job, the newest if no id is given, and show its output."""
+            if id is None:
+                id = max(self.jobs, default=None)  # type: ignore
+            job = self.jobs.get(id)  # type: ignore
+            if job is None:
+                raise ValueError(f"No background job {id}")
+            deadline = None if timeout is None else time.monotonic() + timeout
+            # wait in steps so Ctrl+C can interrupt
+            while not job.done.wait(0.1):
+                if deadline is not None and time.monotonic() > deadline:
+                    print(job)
+                    return
+            job.collected = True
+            print(job)
+            print(job.result, end="")
+
+        return {"bg": bg, "jobs": jobs, "wait": wait}
+
+    def interrupt(self):
+        """Raise KeyboardInterrupt in the code that custom_run_source is running."""
+        thread = self._running
+        if (
+            thread is not None
+            and thread.is_alive()
+            and thread.ident is not None
+            # the code can't interrupt itself, e.g. by calling close()
+            and thread is not threading.current_thread()
+        ):
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(thread.ident), ctypes.py_object(KeyboardInterrupt)
+            )
@@ -1,17 +1,70 @@
-from typing import Any, Generator, List, Optional, Union
-from dataclasses import dataclass
-from pai.code_exec import CodeExec
+import asyncio
+import inspect
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Union,
+)
+from dataclasses import dataclass, field, replace
+from pai.code_exec import (
+    DEFAULT_OUTPUT_HEAD,
+    DEFAULT_OUTPUT_TAIL,
+    CodeExec,
+    OutputReader,
+)
 
 from pai.history import HistoryNode, HistoryTree
+from pai.replay import ReplayPlan, plan_replay
+from pai.retrieval import BM25Index, context_node
+from pai.summary import (
+    SUMMARY_PROMPT,
+    pending_summaries,
+    summary_ancestor,
+    summary_node,
+    summary_text,
+)
+from pai.telemetry import Stats, Telemetry
 from pai.llms.llm_protocol import (
     LLM,
+    AsyncLLM,
+    AsyncLLMWrapper,
     LLMError,
+    LLMResponse,
     LLMResponseCode,
     LLMResponseMessage,
     LLMStreamChunk,
 )
 
 
+if TYPE_CHECKING:
+    from pai.kernel import KernelConfig, KernelExec
+    from pai.session import SessionStore
+
+
+# Some initial code blocks to execute that tell the LLM about the system
+DEFAULT_INITIAL_CODE_BLOCKS = [
+    "import os",
+    "import platform",
+    "platform.version()",
+    "platform.machine()",
+    "os.getcwd()",
+]
+# characters of the output of older nodes that are sent with the namespace digest
+OLD_OUTPUT_CHARS = 500
+
+
 @dataclass
 class UserCode:
     code: str
@@ -25,6 +78,8 @@ class LLMCode:
     code: str
     raw_resp: Any
     agent_mode: bool = False
+    # how many candidates to generate when the llm is called again in agent mode
+    candidates: int = 1
     name: str = "llm-code"
 
 
@@ -40,9 +95,11 @@ class WaitingForInput:
 
 @dataclass
 class WaitingForInputApproval:
-    """Approve the given code."""
+    """Approve the given code, or one of the other candidates."""
 
     code: LLMCode
+    # the candidates that compile, starting with code
+    candidates: List[LLMCode] = field(default_factory=list)
     name: str = "waiting-for-input-approval"
 
 
@@ -61,6 +118,14 @@ class LLMMessage:
     name: str = "llm-message"
 
 
+@dataclass
+class CodeOutputChunk:
+    """Output written by code while it is running."""
+
+    text: str
+    name: str = "code-output-chunk"
+
+
 @dataclass
 class CodeResult:
     """A new output from code execution."""
@@ -69,45 +134,257 @@ class CodeResult:
     name: str = "code-result"
 
 
+@dataclass
+class Notice:
+    """Something the user should know that isn't output of the code."""
+
+    text: str
+    name: str = "notice"
+
+
 ConsoleEvent = Union[
     WaitingForInput,
     WaitingForInputApproval,
     WaitingForLLM,
+    CodeOutputChunk,
     CodeResult,
+    Notice,
     LLMMessage,
     LLMStreamChunk,
 ]
 
 
-class PaiConsole:
-    "Manages the state of the console."
-    console: CodeExec
+class AsyncPaiConsole:
+    "Manages the state of the console. Events are yielded from async generators."
+    console: Union[CodeExec, "KernelExec"]
     history_tree: HistoryTree
-    llm: LLM
+    llm: AsyncLLM
     max_history_nodes_for_llm_context: Optional[int]
+    max_history_tokens_for_llm_context: Optional[int]
 
     def __init__(
         self,
-        llm: LLM,
+        llm: Union[LLM, AsyncLLM],
         llm_context_nodes: Optional[int] = None,
+        llm_context_tokens: Optional[int] = None,
         locals={},
         # code blocks to execute immediately after creating the console
         initial_code_blocks=[],
+        # characters of the start and end of code output to keep in memory
+        output_head: int = DEFAULT_OUTPUT_HEAD,
+        output_tail: int = DEFAULT_OUTPUT_TAIL,
+        # run code in a worker process with these limits
+        kernel: Optional["KernelConfig"] = None,
+        # store the history in this session store
+        session: Optional["SessionStore"] = None,
+        # continue the newest history in the session store
+        resume: bool = False,
+        # run the initial code blocks on a thread. the console waits for them
+        # before it runs code or calls the llm
+        init_in_background: bool = False,
+        # records how long each phase of a turn takes. can be shared by the consoles
+        # of a session
+        telemetry: Optional[Telemetry] = None,
+        # add bg(), jobs() and wait() to the namespace. jobs that finish are added
+        # to the history
+        background_jobs: bool = False,
+        # add this many nodes from anywhere in the history that match the prompt to
+        # the llm context
+        retrieve: int = 0,
+        # once the lineage is longer than this many nodes, send the oldest nodes to
+        # the llm as a summary that it writes. see pai.summary
+        summarize_after: Optional[int] = None,
+        # send a description of the variables that exist to the llm, and cut the long
+        # outputs of older nodes. see pai.digest
+        namespace_digest: bool = False,
+        # run code in process on the thread of the event loop instead of a worker
+        # thread, e.g. the main thread so the code can set signal handlers. the loop
+        # is blocked while the code runs, so its output is passed to on_output, on a
+        # thread of its own, instead of being yielded as CodeOutputChunk events
+        run_code_on_loop_thread: bool = False,
+        on_output: Optional[Callable[[str], None]] = None,
     ):
-        self.console = CodeExec(locals=locals)
+        if kernel is not None:
+            from pai.kernel import KernelExec
+
+            self.console = KernelExec(
+                locals=locals,
+                config=replace(
+                    kernel,
+                    output_head=output_head,
+                    output_tail=output_tail,
+                    background_jobs=background_jobs,
+                ),
+            )
+        else:
+            # copy the locals so consoles in the same process don't share a namespace
+            self.console = CodeExec(
+                locals=dict(locals),
+                output_head=output_head,
+                output_tail=output_tail,
+                background_jobs=background_jobs,
+            )
         self.history_tree = HistoryTree()
-        self.llm = llm
+        resumed = False
+        if session is not None:
+            tree = session.resume() if resume else None
+            resumed = tree is not None
+            self.history_tree = tree or session.new_tree()
+        # a sync llm is called on the default executor
+        if not inspect.isasyncgenfunction(llm.call):
+            llm = AsyncLLMWrapper(llm)  # type: ignore
+        self.llm = llm  # type: ignore
         self.max_history_nodes_for_llm_context = llm_context_nodes
+        self.max_history_tokens_for_llm_context = llm_context_tokens
+        self.summarize_after = summarize_after
+        self.namespace_digest = namespace_digest
+        # the nodes with their output cut, by the node they stand in for
+        self._short_nodes: "weakref.WeakKeyDictionary[HistoryNode, HistoryNode]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.telemetry = telemetry or Telemetry()
+        self.background_jobs = background_jobs
+        self.run_code_on_loop_thread = run_code_on_loop_thread
+        self.on_output = on_output
+        # the functions in locals act on the console, e.g. the commands of the REPL.
+        # cells that call them aren't replayed
+        self._commands = {name for name, value in locals.items() if callable(value)}
+        # page() is in every namespace
+        self._commands.add("page")
+        if background_jobs:
+            self._commands |= {"bg", "jobs", "wait"}
+        self._running_code = False
 
-        # execute the initial code blocks
-        for block in initial_code_blocks:
-            self.exec(block)
+        # cached llm state is for the old lineage after the history branches
+        self.history_tree.branch_listeners.append(
+            lambda node: self.llm.invalidate_cache()
+        )
+        # snapshots of the namespace after the code of a node ran. only the kernel
+        # takes them
+        self._snapshots: "weakref.WeakKeyDictionary[HistoryNode, int]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.history_tree.branch_listeners.append(self._restore_namespace)
 
-    def code_gen(
-        self, prompt: str, agent_mode: bool = False
+        self.retrieve = retrieve
+        self.index: Optional[BM25Index] = None
+        if retrieve:
+            self.index = BM25Index()
+            self.index.add_tree(self.history_tree.root)
+            self.history_tree.add_listeners.append(self.index.add)
+
+        self._ready = threading.Event()
+        self._init_error: Optional[BaseException] = None
+        if init_in_background:
+            threading.Thread(
+                target=self._init,
+                args=(initial_code_blocks, resumed),
+                name="pai-console-init",
+                daemon=True,
+            ).start()
+        else:
+            self._init(initial_code_blocks, resumed)
+            self.wait_ready()
+
+    def _init(self, initial_code_blocks: List[str], resumed: bool):
+        try:
+            # execute the initial code blocks
+            for block in initial_code_blocks:
+                result = self.console.custom_run_source(block)
+                # a resumed history already has them
+                if not resumed:
+                    self.history_tree.add_node(
+                        HistoryNode.UserCode(
+                            code=block,
+                            result=result,
+                            spilled_output=self.console.last_spill,
+                        )
+                    )
+            self.console.startup_code = list(initial_code_blocks)
+            self._snapshot(self.history_tree.cursor)
+        except BaseException as e:
+            self._init_error = e
+        finally:
+            self._ready.set()
+
+    def wait_ready(self):
+        """Wait for the initial code blocks to finish running."""
+        self._ready.wait()
+        if self._init_error is not None:
+            raise self._init_error
+
+    async def _wait_ready_async(self):
+        if not self._ready.is_set():
+            await asyncio.get_running_loop().run_in_executor(None, self._ready.wait)
+        self.wait_ready()
+
+    def restart(self):
+        """Reset the code execution state. The history is kept."""
+        self.wait_ready()
+        self.console.restart()
+
+    def close(self):
+        """Stop running code and release the code execution resources."""
+        self._ready.wait()
+        self.console.close()
+
+    def _snapshot(self, node: HistoryNode) -> Optional[Notice]:
+        """Snapshot the namespace. Returns a notice if snapshots stop being taken."""
+        skipped = self.console.snapshot_skipped
+        snapshot = self.console.snapshot()
+        if snapshot is not None:
+            self._snapshots[node] = snapshot
+        if self.console.snapshot_skipped in (None, skipped):
+            return None
+        return Notice(
+            f"No snapshot was taken because {self.console.snapshot_skipped}. Moving "
+            "back in the history won't restore the namespace while they run.\n"
+        )
+
+    def _restore_namespace(self, node: HistoryNode):
+        """
+        Restore the namespace to what it was at the node, from the snapshot of the
+        newest node with code in its lineage. It is left alone if that node has none.
+        """
+        while node is not None:
+            snapshot = self._snapshots.get(node)
+            if snapshot is not None:
+                self.console.restore(snapshot)
+                return
+            if isinstance(node.data, (HistoryNode.UserCode, HistoryNode.LLMCode)):
+                return
+            node = node.parent  # type: ignore
+
+    def collect_jobs(self):
+        """Add the background jobs that finished, and weren't shown by wait(), to the history."""
+        if not self.background_jobs:
+            return
+        for job_id, source, result, spill in self.console.take_finished_jobs():
+            self.history_tree.add_node(
+                HistoryNode.UserCode(
+                    code=f"# background job {job_id}\n{source}",
+                    result=result,
+                    spilled_output=spill,
+                )
+            )
+
+    def interrupt(self) -> bool:
+        """Interrupt the running code. Returns False if no code is running."""
+        if not self._running_code:
+            return False
+        self.console.interrupt()
+        return True
+
+    async def code_gen(
+        self, prompt: str, agent_mode: bool = False, candidates: int = 1
     ) -> Union[LLMCode, LLMMessage]:
         # get the events from the code gen
-        events = [e for e in self.streaming_code_gen(prompt, agent_mode=agent_mode)]
+        events = [
+            e
+            async for e in self.streaming_code_gen(
+                prompt, agent_mode=agent_mode, candidates=candidates
+            )
+        ]
 
         # if the last event is a code input, then return it
         if isinstance(events[-1], WaitingForInputApproval):
@@ -124,9 +401,9 @@ class PaiConsole:
             f"Unexpected state. Second to last event should be a message but got {events[-2]}"
         )
 
-    def streaming_code_gen(
-        self, prompt: str, agent_mode: bool = False
-    ) -> Generator[ConsoleEvent, None, None]:
+    async def streaming_code_gen(
+        self, prompt: str, agent_mode: bool = False, candidates: int = 1
+    ) -> AsyncGenerator[ConsoleEvent, None]:
         """
         Handles code gen commands. calls the llm, sets correct input state, updates the history
 
@@ -135,28 +412,90 @@ class PaiConsole:
         agent_mode: sets the agent_mode flag on LLMCodeInput (if returned) so when it is
         later passed to handle_input, it will call the llm again immediately
 
+        candidates: how many responses to request. The first one is streamed. The code
+        responses that compile are offered for approval
+
         """
         # set the input state to waiting for the LLM and yield it
         yield WaitingForLLM()
 
-        history = self.history_tree.lineage(
-            max_nodes=self.max_history_nodes_for_llm_context
-        )
-        resp = yield from self.llm.call(history, prompt)
+        await self._wait_ready_async()
+        self.collect_jobs()
+        self.telemetry.begin_turn()
+        await self._summarize()
+        with self.telemetry.span("prompt") as attrs:
+            history = self.get_history(prompt)
+            context = []
+            if self.index is not None:
+                context += self._retrieved(history, prompt)
+            if self.namespace_digest:
+                context += await self._digest()
+            if context:
+                history = self._with_context(history, context, prompt)
+            # the llm keeps the prompt it built last, so call() doesn't build it again
+            rendered = self.llm.prompt(history, prompt)
+            prompt_tokens = self.llm.count_prompt_tokens(rendered)
+            attrs["nodes"] = len(history)
 
-        if isinstance(resp, LLMResponseCode):
-            llm_inp = LLMCode(
-                prompt=resp.prompt,
-                message=resp.message,
-                code=resp.code,
-                raw_resp=resp.raw,
-                agent_mode=agent_mode,
-            )
+        if candidates > 1:
+            calls = self._call_candidates(history, prompt, candidates)
+        else:
+            calls = self.llm.call(history, prompt)
+        responses: List[LLMResponse] = []
+        with self.telemetry.span(
+            "llm", prompt_tokens=prompt_tokens, candidates=candidates
+        ) as attrs:
+            start = time.perf_counter()
+            first_token = None
+            streamed = []
+            async with _aclosing(calls):
+                async for item in calls:
+                    if isinstance(item, LLMStreamChunk):
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                        streamed.append(item.text)
+                        yield item
+                    else:
+                        responses.append(item)
+            completion_tokens = self.llm.count_tokens("".join(streamed))
+            attrs["completion_tokens"] = completion_tokens
+            if first_token is not None:
+                attrs["time_to_first_token"] = first_token
+                streaming = time.perf_counter() - start - first_token
+                if streaming > 0:
+                    attrs["tokens_per_second"] = completion_tokens / streaming
+
+        code_responses = []
+        for r in responses:
+            if (
+                isinstance(r, LLMResponseCode)
+                and _compiles(r.code)
+                and all(r.code != c.code for c in code_responses)
+            ):
+                code_responses.append(r)
+        resp = responses[0] if responses else None
+        if not code_responses and isinstance(resp, LLMResponseCode):
+            # none of them compile. let the user fix the first one
+            code_responses = [resp]
+
+        if code_responses:
+            llm_inps = [
+                LLMCode(
+                    prompt=r.prompt,
+                    message=r.message,
+                    code=r.code,
+                    raw_resp=r.raw,
+                    agent_mode=agent_mode,
+                    candidates=candidates,
+                )
+                for r in code_responses
+            ]
             # yield the message if there is one
-            if resp.message:
-                yield LLMMessage(resp.message)
-            # yield the code input
-            yield WaitingForInputApproval(llm_inp)
+            if code_responses[0].message:
+                yield LLMMessage(code_responses[0].message)
+            # yield the code input. the approval span ends when the code is run
+            self.telemetry.start("approval")
+            yield WaitingForInputApproval(llm_inps[0], candidates=llm_inps)
         elif isinstance(resp, LLMResponseMessage):
             new_history_node = HistoryNode.LLMMessage(
                 prompt=resp.prompt,
@@ -164,7 +503,7 @@ class PaiConsole:
                 raw_resp=resp.raw,
             )
             yield LLMMessage(value=resp.message)
-            self.history_tree.add_node(new_history_node)
+            self.telemetry.attach(self.history_tree.add_node(new_history_node))
             yield WaitingForInput()
         elif isinstance(resp, LLMError):
             new_history_node = HistoryNode.LLMError(
@@ -173,26 +512,31 @@ class PaiConsole:
                 raw_resp=resp.raw,
             )
             yield LLMMessage(resp.error)
-            self.history_tree.add_node(new_history_node)
+            self.telemetry.attach(self.history_tree.add_node(new_history_node))
             yield WaitingForInput()
         else:
             raise ValueError(f"Unknown LLM response type: {type(resp)}")
 
-    def exec(self, console_input: Union[ConsoleInput, str]):
+    async def exec(self, console_input: Union[ConsoleInput, str]):
         last_event = None
 
         # if the input is a string, then convert it to a UserInput
         if isinstance(console_input, str):
             console_input = UserCode(code=console_input)
 
-        for event in self.streaming_exec(console_input):
-            if isinstance(event, WaitingForInput):
-                return last_event
-            last_event = event
+        events = self.streaming_exec(console_input)
+        try:
+            async for event in events:
+                if isinstance(event, WaitingForInput):
+                    return last_event
+                if not isinstance(event, Notice):
+                    last_event = event
+        finally:
+            await events.aclose()
 
-    def streaming_exec(
+    async def streaming_exec(
         self, console_input: ConsoleInput
-    ) -> Generator[ConsoleEvent, None, None]:
+    ) -> AsyncGenerator[ConsoleEvent, None]:
         """
         Yields console events.
 
@@ -200,55 +544,583 @@ class PaiConsole:
         The caller can use the events to update the UI in realtime.
         The next input state describes what sort of input to collect next.
         """
+        await self._wait_ready_async()
+        self.collect_jobs()
 
         if isinstance(console_input, UserCode):
             if console_input.code.strip() == "":
                 yield WaitingForInput()
             # if the input is not a special command, then run it
-            result = self.console.custom_run_source(console_input.code)
-            yield CodeResult(result)
-            self.history_tree.add_node(
-                HistoryNode.UserCode(code=console_input.code, result=result)
+            self.telemetry.begin_turn()
+            result = ""
+            with self.telemetry.span("exec") as attrs:
+                async with _aclosing(self._stream_run(console_input.code)) as events:
+                    async for event in events:
+                        if isinstance(event, CodeResult):
+                            result = event.value
+                        yield event
+                attrs["output_chars"] = len(result)
+            node = self.history_tree.add_node(
+                HistoryNode.UserCode(
+                    code=console_input.code,
+                    result=result,
+                    spilled_output=self.console.last_spill,
+                )
             )
+            self.telemetry.attach(node)
+            notice = self._snapshot(node)
+            if notice is not None:
+                yield notice
+            self.collect_jobs()
             yield WaitingForInput()
         elif isinstance(console_input, LLMCode):
-            result = self.console.custom_run_source(console_input.code)
-            yield CodeResult(result)
+            self.telemetry.end("approval")
+            result = ""
+            with self.telemetry.span("exec") as attrs:
+                async with _aclosing(self._stream_run(console_input.code)) as events:
+                    async for event in events:
+                        if isinstance(event, CodeResult):
+                            result = event.value
+                        yield event
+                attrs["output_chars"] = len(result)
 
             new_history_node = HistoryNode.LLMCode(
                 prompt=console_input.prompt,
                 code=console_input.code,
                 result=result,
                 raw_resp=console_input.raw_resp,
+                spilled_output=self.console.last_spill,
             )
-            self.history_tree.add_node(new_history_node)
+            node = self.history_tree.add_node(new_history_node)
+            self.telemetry.attach(node)
+            notice = self._snapshot(node)
+            if notice is not None:
+                yield notice
+            self.collect_jobs()
 
             if console_input.agent_mode:
                 # if agent mode is enabled, then we want to immediately call the LLM again
                 # and it will generate code based on the result of the previous code
-                yield from self.streaming_code_gen("", agent_mode=True)
+                events = self.streaming_code_gen(
+                    "", agent_mode=True, candidates=console_input.candidates
+                )
+                async with _aclosing(events):
+                    async for event in events:
+                        yield event
             else:
                 # otherwise, just return to waiting for input
                 yield WaitingForInput()
         else:
             raise ValueError(f"Unknown input type: {type(console_input)}")
 
-    def get_history(self) -> List[HistoryNode]:
-        """Get the history of the console."""
-        return self.history_tree.lineage(self.max_history_nodes_for_llm_context)
+    async def _call_candidates(
+        self, history: List[HistoryNode], prompt: str, n: int
+    ) -> AsyncGenerator[Union[LLMStreamChunk, LLMResponse], None]:
+        """Call the llm n times. Streams the first call, then yields the n responses."""
+
+        async def collect() -> LLMResponse:
+            resp = None
+            async with _aclosing(self.llm.call(history, prompt)) as items:
+                async for item in items:
+                    if not isinstance(item, LLMStreamChunk):
+                        resp = item
+            return resp  # type: ignore
+
+        # the other calls run while the first one is streamed
+        others = []
+        if self.llm.parallel_support():
+            others = [asyncio.ensure_future(collect()) for _ in range(n - 1)]
+        try:
+            async with _aclosing(self.llm.call(history, prompt)) as items:
+                async for item in items:
+                    yield item
+            if others:
+                for resp in await asyncio.gather(*others):
+                    yield resp
+            else:
+                for _ in range(n - 1):
+                    yield await collect()
+        finally:
+            for task in others:
+                task.cancel()
+
+    async def _stream_run(self, code: str) -> AsyncGenerator[ConsoleEvent, None]:
+        """
+        Run the code on a thread. Yields its output as it is written, then the CodeResult.
+
+        The code is interrupted if the caller stops waiting for it. See
+        run_code_on_loop_thread for code that runs in process.
+        """
+        if self.run_code_on_loop_thread and isinstance(self.console, CodeExec):
+            reader = OutputReader(self.on_output) if self.on_output else None
+            self._running_code = True
+            try:
+                result = self.console.custom_run_source(
+                    code, on_output=reader.put if reader else None
+                )
+            finally:
+                self._running_code = False
+                if reader is not None:
+                    reader.close()
+            yield CodeResult(result)
+            return
+
+        loop = asyncio.get_running_loop()
+        events: "asyncio.Queue[Union[ConsoleEvent, BaseException]]" = asyncio.Queue()
+
+        def put(event):
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, event)
+            except RuntimeError:
+                # the loop was closed while the code was running
+                pass
+
+        def run():
+            try:
+                result = self.console.custom_run_source(
+                    code, on_output=lambda text: put(CodeOutputChunk(text))
+                )
+                put(CodeResult(result))
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=run, name="pai-stream-run", daemon=True)
+        self._running_code = True
+        thread.start()
+        finished = False
+        try:
+            while not finished:
+                event = await events.get()
+                if isinstance(event, BaseException):
+                    raise event
+                finished = isinstance(event, CodeResult)
+                yield event
+        finally:
+            self._running_code = False
+            if not finished:
+                self.console.interrupt()
+
+    def get_history(self, prompt: str = "") -> List[HistoryNode]:
+        """Get the history of the console that is used as llm context for the prompt."""
+        self.wait_ready()
+        return self._lineage(self._history_budget(prompt))
+
+    def _history_budget(self, prompt: str) -> Optional[int]:
+        """
+        The tokens left for the history once the parts of the prompt that are always
+        sent, e.g. the system prompt and the user prompt, are counted.
+        """
+        max_tokens = self.max_history_tokens_for_llm_context
+        if max_tokens is None:
+            return None
+        fixed = self.llm.count_prompt_tokens(self.llm.prompt([], prompt))
+        return max(0, max_tokens - fixed)
+
+    def _lineage(self, max_tokens: Optional[int]) -> List[HistoryNode]:
+        """
+        The newest part of the lineage that fits in max_tokens. The nodes before the
+        cut are replaced by their summary once it is made.
+        """
+        summary = None
+        if self.summarize_after:
+            cut = summary_ancestor(self.history_tree.cursor, self.summarize_after)
+            summary = cut.summary if cut is not None else None
+        if summary is not None and max_tokens is not None:
+            # the summary comes out of the token budget
+            max_tokens = max(0, max_tokens - summary.tokens(self.llm.count_tokens))
+        lineage = self.history_tree.lineage(
+            max_nodes=self.max_history_nodes_for_llm_context,
+            max_tokens=max_tokens,
+            count_tokens=self.llm.count_tokens,
+        )
+        if summary is not None:
+            summarized = summary.data.nodes  # type: ignore
+            lineage = [summary] + [node for node in lineage if node.depth > summarized]
+        if self.namespace_digest:
+            lineage = self._cut_old_outputs(lineage)
+        return lineage
+
+    def _cut_old_outputs(self, lineage: List[HistoryNode]) -> List[HistoryNode]:
+        """
+        Replace the nodes with long outputs, except the newest node, with a node with the
+        start of the output. The digest has the state they showed. The replacements are
+        kept, so llms can reuse the prompt they built for them.
+        """
+        lineage = list(lineage)
+        for i, node in enumerate(lineage[:-1]):
+            data = node.data
+            if (
+                not isinstance(data, (HistoryNode.UserCode, HistoryNode.LLMCode))
+                or len(data.result) <= OLD_OUTPUT_CHARS
+            ):
+                continue
+            short = self._short_nodes.get(node)
+            if short is None:
+                result = data.result[:OLD_OUTPUT_CHARS] + "\n... (output cut)\n"
+                short = HistoryNode(replace(data, result=result))
+                short.depth = node.depth
+                self._short_nodes[node] = short
+            lineage[i] = short
+        return lineage
+
+    async def _summarize(self):
+        """Make the summaries the lineage needs that aren't cached yet."""
+        if not self.summarize_after:
+            return
+        cut = summary_ancestor(self.history_tree.cursor, self.summarize_after)
+        if cut is None or cut.summary is not None:
+            return
+        chunks = pending_summaries(cut, self.summarize_after)
+        previous = chunks[0][0].parent.summary  # type: ignore
+        with self.telemetry.span("summarize", summaries=len(chunks)):
+            for nodes in chunks:
+                history = nodes if previous is None else [previous] + nodes
+                resp = None
+                async with _aclosing(self.llm.call(history, SUMMARY_PROMPT)) as items:
+                    async for item in items:
+                        if not isinstance(item, LLMStreamChunk):
+                            resp = item
+                text = summary_text(resp)
+                if text is None:
+                    # send the whole lineage. it is tried again on the next call
+                    return
+                previous = summary_node(text, nodes[-1].depth)
+                nodes[-1].summary = previous
 
     def get_history_since(self, idx: int) -> List[HistoryNode]:
+        self.wait_ready()
         return self.history_tree.lineage_since(idx)
 
+    def _retrieved(self, history: List[HistoryNode], prompt: str) -> List[HistoryNode]:
+        """A node with the nodes of the tree that match the prompt best, and aren't in the history."""
+        assert self.index is not None
+        # the agent calls the llm again without a prompt. the newest node is the query
+        query = prompt or (history[-1].text() if history else "")
+        # nodes with their output cut stand in for nodes of the lineage
+        originals = {id(short): node for node, short in self._short_nodes.items()}
+        exclude = history + [originals[id(n)] for n in history if id(n) in originals]
+        found = self.index.search(query, self.retrieve, exclude=exclude)
+        return [context_node(found)] if found else []
+
+    async def _digest(self) -> List[HistoryNode]:
+        """A node with the digest of the namespace."""
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self.console.namespace_digest)
+        if not digest:
+            return []
+        return [
+            HistoryNode(
+                HistoryNode.UserCode(
+                    code="# the variables that exist now",
+                    result=digest,
+                )
+            )
+        ]
+
+    def _with_context(
+        self, history: List[HistoryNode], context: List[HistoryNode], prompt: str
+    ) -> List[HistoryNode]:
+        """Add the context nodes after the history. They come out of the token budget."""
+        max_tokens = self._history_budget(prompt)
+        if max_tokens is not None:
+            tokens = sum(node.tokens(self.llm.count_tokens) for node in context)
+            history = self._lineage(max(0, max_tokens - tokens))
+        return history + context
+
     def get_prompt(self, prompt: str) -> Any:
         """Get the prompt for the LLM"""
-        return self.llm.prompt(self.get_history(), prompt)
+        return self.llm.prompt(self.get_history(prompt), prompt)
+
+    def stats(self) -> Stats:
+        """Latencies of each phase of the turns so far, and token counts."""
+        return self.telemetry.stats()
+
+    def plan_replay(self, targets: Optional[Iterable[str]] = None) -> ReplayPlan:
+        """The cells of the lineage that define the targets, all names if None. See pai.replay."""
+        return plan_replay(self.get_history_since(0), targets, self._commands)
+
+    async def streaming_replay(
+        self, targets: Optional[Iterable[str]] = None
+    ) -> AsyncGenerator[ConsoleEvent, None]:
+        """
+        Run the cells of plan_replay() again, e.g. after restart(). Nothing is added to
+        the history. Yields a line for each cell before its output. Stops at the first
+        cell that fails, since the cells after it need what it defines.
+        """
+        await self._wait_ready_async()
+        plan = self.plan_replay(targets)
+        start = time.perf_counter()
+        # code run on the loop thread only streams its output to on_output
+        unstreamed = (
+            self.run_code_on_loop_thread
+            and isinstance(self.console, CodeExec)
+            and self.on_output is None
+        )
+        replayed = 0
+        for i, cell in enumerate(plan.cells, 1):
+            yield CodeOutputChunk(f"replay {i}/{len(plan.cells)} {cell.title()}\n")
+            async with _aclosing(self._stream_run(cell.code)) as events:
+                async for event in events:
+                    if isinstance(event, CodeOutputChunk):
+                        yield event
+                    elif isinstance(event, CodeResult) and unstreamed and event.value:
+                        yield CodeOutputChunk(event.value)
+            if self.console.last_failed:
+                break
+            replayed += 1
+        summary = (
+            f"Replayed {replayed} of {len(plan.cells) + len(plan.skipped)} "
+            f"cells in {time.perf_counter() - start:.1f}s\n"
+        )
+        if replayed < len(plan.cells):
+            summary += f"Stopped at {plan.cells[replayed].title()}, which failed\n"
+        yield CodeOutputChunk(summary)
+        yield CodeResult(summary)
+        yield WaitingForInput()
+
+    async def initial_state_generator(self) -> AsyncGenerator[ConsoleEvent, None]:
+        # yield the initial waiting for input state
+        yield WaitingForInput()
+
+
+@asynccontextmanager
+async def _aclosing(agen: AsyncGenerator) -> AsyncIterator[AsyncGenerator]:
+    """Close the async generator when the block exits, like contextlib.aclosing."""
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+# returned by _anext at the end of an async generator
+_DONE = object()
+
+
+async def _anext(agen: AsyncGenerator) -> Any:
+    try:
+        return await agen.__anext__()
+    except StopAsyncIteration:
+        return _DONE
+
+
+class PaiConsole:
+    "Manages the state of the console. Runs an AsyncPaiConsole on its own event loop."
+    async_console: AsyncPaiConsole
+    llm: LLM
+
+    def __init__(
+        self,
+        llm: LLM,
+        llm_context_nodes: Optional[int] = None,
+        llm_context_tokens: Optional[int] = None,
+        locals={},
+        # code blocks to execute immediately after creating the console
+        initial_code_blocks=[],
+        # characters of the start and end of code output to keep in memory
+        output_head: int = DEFAULT_OUTPUT_HEAD,
+        output_tail: int = DEFAULT_OUTPUT_TAIL,
+        # run code in a worker process with these limits
+        kernel: Optional["KernelConfig"] = None,
+        # store the history in this session store
+        session: Optional["SessionStore"] = None,
+        # continue the newest history in the session store
+        resume: bool = False,
+        # run the initial code blocks on a thread
+        init_in_background: bool = False,
+        # records how long each phase of a turn takes
+        telemetry: Optional[Telemetry] = None,
+        # add bg(), jobs() and wait() to the namespace
+        background_jobs: bool = False,
+        # add this many matching nodes from anywhere in the history to the llm context
+        retrieve: int = 0,
+        # send the oldest nodes of a long lineage as a summary
+        summarize_after: Optional[int] = None,
+        # send a description of the variables instead of long old outputs
+        namespace_digest: bool = False,
+        # called with the output of code that runs in process as it is written. that
+        # code runs on the calling thread, so it isn't yielded as CodeOutputChunk events
+        on_output: Optional[Callable[[str], None]] = None,
+    ):
+        self.async_console = AsyncPaiConsole(
+            llm,
+            llm_context_nodes=llm_context_nodes,
+            llm_context_tokens=llm_context_tokens,
+            locals=locals,
+            initial_code_blocks=initial_code_blocks,
+            output_head=output_head,
+            output_tail=output_tail,
+            kernel=kernel,
+            session=session,
+            resume=resume,
+            init_in_background=init_in_background,
+            telemetry=telemetry,
+            background_jobs=background_jobs,
+            retrieve=retrieve,
+            summarize_after=summarize_after,
+            namespace_digest=namespace_digest,
+            run_code_on_loop_thread=True,
+            on_output=on_output,
+        )
+        self.llm = llm
+        self._loop = asyncio.new_event_loop()
+        self._closed = False
+
+    @property
+    def console(self) -> Union[CodeExec, "KernelExec"]:
+        return self.async_console.console
+
+    @property
+    def history_tree(self) -> HistoryTree:
+        return self.async_console.history_tree
+
+    @property
+    def telemetry(self) -> Telemetry:
+        return self.async_console.telemetry
+
+    @property
+    def max_history_nodes_for_llm_context(self) -> Optional[int]:
+        return self.async_console.max_history_nodes_for_llm_context
+
+    @max_history_nodes_for_llm_context.setter
+    def max_history_nodes_for_llm_context(self, value: Optional[int]):
+        self.async_console.max_history_nodes_for_llm_context = value
+
+    @property
+    def max_history_tokens_for_llm_context(self) -> Optional[int]:
+        return self.async_console.max_history_tokens_for_llm_context
+
+    @max_history_tokens_for_llm_context.setter
+    def max_history_tokens_for_llm_context(self, value: Optional[int]):
+        self.async_console.max_history_tokens_for_llm_context = value
+
+    def _run(self, awaitable: Awaitable) -> Any:
+        """
+        Run the event loop until the awaitable is done.
+
+        Ctrl+C interrupts the running code. If no code is running, or on a second Ctrl+C,
+        the awaitable is cancelled and the KeyboardInterrupt is raised.
+        """
+        task = self._loop.create_task(awaitable)  # type: ignore
+        interrupted = False
+        while True:
+            try:
+                return self._loop.run_until_complete(task)
+            except KeyboardInterrupt:
+                if task.done():
+                    raise
+                if not interrupted and self.async_console.interrupt():
+                    interrupted = True
+                    continue
+                task.cancel()
+                try:
+                    self._loop.run_until_complete(task)
+                except (asyncio.CancelledError, KeyboardInterrupt):
+                    pass
+                raise
+
+    def _iterate(
+        self, agen: AsyncGenerator[ConsoleEvent, None]
+    ) -> Generator[ConsoleEvent, None, None]:
+        try:
+            while True:
+                event = self._run(_anext(agen))
+                if event is _DONE:
+                    return
+                yield event
+        finally:
+            if not self._loop.is_closed():
+                try:
+                    self._loop.run_until_complete(agen.aclose())
+                except RuntimeError:
+                    # the loop is already running. it closes the generator itself
+                    pass
+                if self._closed:
+                    self._close_loop()
+
+    def _close_loop(self):
+        if self._loop.is_running() or self._loop.is_closed():
+            return
+        self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        self._loop.close()
+
+    def restart(self):
+        """Reset the code execution state. The history is kept."""
+        self.async_console.restart()
+
+    def close(self):
+        """Stop running code and release the code execution resources."""
+        self.async_console.close()
+        # close() can be called by the running code. the loop is closed when it stops
+        self._closed = True
+        self._close_loop()
+
+    def code_gen(
+        self, prompt: str, agent_mode: bool = False, candidates: int = 1
+    ) -> Union[LLMCode, LLMMessage]:
+        return self._run(
+            self.async_console.code_gen(
+                prompt, agent_mode=agent_mode, candidates=candidates
+            )
+        )
+
+    def streaming_code_gen(
+        self, prompt: str, agent_mode: bool = False, candidates: int = 1
+    ) -> Generator[ConsoleEvent, None, None]:
+        """See AsyncPaiConsole.streaming_code_gen."""
+        return self._iterate(
+            self.async_console.streaming_code_gen(
+                prompt, agent_mode=agent_mode, candidates=candidates
+            )
+        )
+
+    def exec(self, console_input: Union[ConsoleInput, str]):
+        return self._run(self.async_console.exec(console_input))
+
+    def streaming_exec(
+        self, console_input: ConsoleInput
+    ) -> Generator[ConsoleEvent, None, None]:
+        """See AsyncPaiConsole.streaming_exec."""
+        return self._iterate(self.async_console.streaming_exec(console_input))
+
+    def get_history(self, prompt: str = "") -> List[HistoryNode]:
+        """Get the history of the console that is used as llm context for the prompt."""
+        return self.async_console.get_history(prompt)
+
+    def get_history_since(self, idx: int) -> List[HistoryNode]:
+        return self.async_console.get_history_since(idx)
+
+    def get_prompt(self, prompt: str) -> Any:
+        """Get the prompt for the LLM"""
+        return self.async_console.get_prompt(prompt)
+
+    def stats(self) -> Stats:
+        """See AsyncPaiConsole.stats."""
+        return self.async_console.stats()
+
+    def plan_replay(self, targets: Optional[Iterable[str]] = None) -> ReplayPlan:
+        """See AsyncPaiConsole.plan_replay."""
+        return self.async_console.plan_replay(targets)
+
+    def streaming_replay(
+        self, targets: Optional[Iterable[str]] = None
+    ) -> Generator[ConsoleEvent, None, None]:
+        """See AsyncPaiConsole.streaming_replay."""
+        return self._iterate(self.async_console.streaming_replay(targets))
 
     def initial_state_generator(self) -> Generator[ConsoleEvent, None, None]:
         # yield the initial waiting for input state
         yield WaitingForInput()
 
 
+def _compiles(code: str) -> bool:
+    """Check that the code is valid Python without running it."""
+    try:
+        compile(code, "<candidate>", "exec")
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
 def append_new_line(text: str) -> str:
     """Append a new line to the end of the string if it doesn't already have one."""
     if text[-1] != "\n":
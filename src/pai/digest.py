@@ -0,0 +1,139 @@
+"""
+A short description of the variables in the namespace, for the llm context.
+
+Otherwise the llm only learns what exists by reading old outputs, which are long and
+can be out of date. The digest has a line for each variable: its name, type, size and
+the start of its repr. A line is only made again when a cell touched the name or the
+name was bound to another object, so keeping it up to date costs little however large
+the namespace is. Changes made through a function, e.g. f() appending to a global
+list, are missed until a cell touches the name.
+"""
+import inspect
+import reprlib
+import types
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# characters of the digest. the oldest lines are left out of a longer one
+MAX_DIGEST_CHARS = 2_000
+# characters of each line
+MAX_LINE_CHARS = 160
+
+_repr = reprlib.Repr()
+_repr.maxlevel = 2
+_repr.maxstring = 60
+_repr.maxother = 60
+_repr.maxlist = _repr.maxtuple = _repr.maxset = _repr.maxfrozenset = 5
+_repr.maxdict = 4
+_repr.maxlong = 40
+
+# columns of a data frame that are shown
+_MAX_COLUMNS = 8
+_MISSING = object()
+
+
+def _shape(value: Any) -> Optional[str]:
+    """The shape of arrays and data frames, e.g. numpy, pandas and torch."""
+    shape = getattr(value, "shape", None)
+    if not isinstance(shape, tuple) or isinstance(value, type):
+        return None
+    text = f"shape={shape}"
+    dtype = getattr(value, "dtype", None)
+    if dtype is not None and not callable(dtype):
+        text += f" dtype={dtype}"
+    columns = getattr(value, "columns", None)
+    if columns is not None:
+        try:
+            names = [str(c) for c in list(columns[:_MAX_COLUMNS])]
+        except Exception:
+            names = []
+        if names:
+            more = ", ..." if len(columns) > _MAX_COLUMNS else ""
+            text += f" columns=[{', '.join(names)}{more}]"
+    return text
+
+
+def describe(value: Any) -> str:
+    """The type, size and start of the repr of the value."""
+    kind = type(value).__name__
+    try:
+        shape = _shape(value)
+        if shape is not None:
+            return f"{kind} {shape}"
+        if isinstance(value, (types.FunctionType, types.BuiltinFunctionType)):
+            try:
+                return f"function{inspect.signature(value)}"
+            except (TypeError, ValueError):
+                return "function"
+        if isinstance(value, type):
+            return "class"
+        text = _repr.repr(value)
+        if isinstance(value, (str, bytes, list, tuple, dict, set, frozenset)):
+            return f"{kind} len={len(value)} {text}"
+        return f"{kind} {text}"
+    except Exception as e:
+        # a broken __repr__ or property
+        return f"{kind} (repr failed: {type(e).__name__})"
+
+
+def _line(name: str, value: Any) -> str:
+    line = f"{name}: {describe(value)}".replace("\n", " ")
+    if len(line) > MAX_LINE_CHARS:
+        line = line[: MAX_LINE_CHARS - 3] + "..."
+    return line
+
+
+class NamespaceDigest:
+    """
+    Lines for the variables of a namespace, updated with update().
+
+    Names starting with _ and modules are left out of the lines. Modules are listed on
+    one line. Values of skip, e.g. the commands of the REPL, are left out until the name
+    is bound to something else.
+    """
+
+    def __init__(self, skip: Optional[Dict[str, Any]] = None):
+        self.skip = skip or {}
+        # name -> (id of the value, line). the most recently changed are last
+        self.lines: Dict[str, Tuple[int, str]] = {}
+        self.modules: List[str] = []
+
+    def update(self, namespace: Dict[str, Any], touched: Optional[Iterable[str]]):
+        """Describe again the touched names, all if None, and the names bound to another object."""
+        touched = None if touched is None else set(touched)
+        items = list(namespace.items())
+        present = {name for name, _ in items}
+        for name in [n for n in self.lines if n not in present]:
+            del self.lines[name]
+
+        modules = []
+        for name, value in items:
+            if name.startswith("_") or self.skip.get(name, _MISSING) is value:
+                continue
+            if isinstance(value, types.ModuleType):
+                modules.append(name)
+                self.lines.pop(name, None)
+                continue
+            entry = self.lines.get(name)
+            if entry is not None and entry[0] == id(value):
+                if touched is not None and name not in touched:
+                    continue
+            self.lines.pop(name, None)
+            self.lines[name] = (id(value), _line(name, value))
+        self.modules = sorted(modules)
+
+    def text(self, max_chars: int = MAX_DIGEST_CHARS) -> str:
+        """The digest. The oldest lines are left out when it is longer than max_chars."""
+        head = f"modules: {', '.join(self.modules)}\n" if self.modules else ""
+        shown: List[str] = []
+        size = len(head)
+        for _, line in reversed(self.lines.values()):
+            if size + len(line) + 1 > max_chars:
+                break
+            shown.append(line)
+            size += len(line) + 1
+        if len(shown) < len(self.lines):
+            # make room for the note
+            while shown and size + 40 > max_chars:
+                size -= len(shown.pop()) + 1
+            head += f"... {len(self.lines) - len(shown)} older variables not shown\n"
+        return head + "".join(line + "\n" for line in reversed(shown))
@@ -0,0 +1,249 @@
+"""
+Show the value of the trailing expression of a cell without the cost of a full repr.
+
+The repr of a large list or dict can take seconds and be megabytes long before the
+output is cut. safe_repr() limits the depth, the items of each container, the length
+and the time, in the way reprlib does. Arrays and data frames of numpy and pandas are
+shown with their own summarized repr. page() shows the full repr of a value that was
+cut, a page at a time.
+
+The time limit is checked between items, so a slow __repr__ of a single object isn't
+stopped.
+"""
+import reprlib
+import sys
+import time
+from collections import Counter, OrderedDict, defaultdict
+from itertools import islice
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+# characters of a value that are shown
+MAX_DISPLAY_CHARS = 4_000
+# seconds spent on the repr of a value
+MAX_DISPLAY_SECONDS = 0.5
+# characters shown by each page()
+PAGE_CHARS = 8_000
+
+# reprlib picks the method by the name of the type, so a subclass, e.g. Counter, would
+# get the full repr. these are shown with the method of their base instead
+_CONTAINERS = (
+    (dict, "repr_dict"),
+    (list, "repr_list"),
+    (tuple, "repr_tuple"),
+    (set, "repr_set"),
+    (frozenset, "repr_frozenset"),
+)
+
+
+class SafeRepr(reprlib.Repr):
+    """A Repr that stops once it has made max_chars characters or used up its time."""
+
+    def __init__(
+        self, max_chars: int = MAX_DISPLAY_CHARS, seconds: float = MAX_DISPLAY_SECONDS
+    ):
+        super().__init__()
+        self.maxlevel = 4
+        self.maxtuple = self.maxlist = self.maxarray = 100
+        self.maxset = self.maxfrozenset = self.maxdeque = 100
+        self.maxdict = 50
+        self.maxstring = max_chars
+        self.maxlong = 1_000
+        self.maxother = max_chars
+        self.max_chars = max_chars
+        self.deadline = time.perf_counter() + seconds
+        # the repr was cut by a limit
+        self.cut = False
+        self._used = 0
+
+    def _spent(self) -> bool:
+        return self._used > self.max_chars or time.perf_counter() > self.deadline
+
+    def repr1(self, x: Any, level: int) -> str:
+        if self._spent():
+            self.cut = True
+            return "..."
+        s = self._repr_subclass(x, level)
+        if s is None:
+            s = super().repr1(x, level)
+        self._used += len(s)
+        return s
+
+    def _repr_subclass(self, x: Any, level: int) -> Optional[str]:
+        """The repr of a subclass of a builtin container. None for other values."""
+        for base, method in _CONTAINERS:
+            if isinstance(x, base):
+                break
+        else:
+            return None
+        kind = type(x)
+        if kind is base or not len(x):
+            return None
+        if kind.__repr__ is base.__repr__:
+            return getattr(self, method)(x, level)
+        name = kind.__name__
+        if isinstance(x, tuple) and hasattr(x, "_fields"):
+            # a namedtuple
+            if level <= 0:
+                self.cut = True
+                return f"{name}(...)"
+            fields = [f"{f}={self.repr1(v, level - 1)}" for f, v in zip(x._fields, x)]
+            return f"{name}({', '.join(fields)})"
+        # the class whose __repr__ is used. the ones of collections are made again
+        # here, in their format. other classes have their own
+        owner = next(c for c in kind.__mro__ if "__repr__" in c.__dict__)
+        if owner is Counter:
+            return f"{name}({self.repr_dict(x, level)})"
+        if owner is defaultdict:
+            return f"{name}({x.default_factory!r}, {self.repr_dict(x, level)})"
+        if owner is OrderedDict and sys.version_info >= (3, 12):
+            return f"{name}({self.repr_dict(x, level)})"
+        if owner is OrderedDict:
+            return f"{name}({self._repr_pairs(x, level)})"
+        return None
+
+    def _pieces(
+        self, items: Iterable[Any], piece: Callable[[Any], str], more: bool
+    ) -> List[str]:
+        """
+        The repr of each item until the limits are used up, then a single "..." if
+        any items were left out.
+        """
+        pieces = []
+        for item in items:
+            if self._spent():
+                self.cut = more = True
+                break
+            pieces.append(piece(item))
+        return pieces + (["..."] if more else [])
+
+    def _repr_iterable(self, x, level, left, right, maxiter, trail=""):
+        n = len(x)
+        if level <= 0 and n:
+            self.cut = True
+            return left + "..." + right
+        if n > maxiter:
+            self.cut = True
+        pieces = self._pieces(
+            islice(x, maxiter), lambda item: self.repr1(item, level - 1), n > maxiter
+        )
+        if n == 1 and trail:
+            right = trail + right
+        return left + ", ".join(pieces) + right
+
+    def repr_int(self, x: int, level: int) -> str:
+        # converting a huge int to decimal is slow, and raises ValueError on 3.11
+        if x.bit_length() > 4 * self.maxlong:
+            self.cut = True
+            return f"<int with about {int(x.bit_length() * 0.30103) + 1} digits>"
+        return super().repr_int(x, level)
+
+    def _items(self, x: Any, limit: int) -> Tuple[list, bool]:
+        items = list(islice(x, limit))
+        if len(x) > limit:
+            self.cut = True
+            return items, True
+        return items, False
+
+    # reprlib sorts dicts and sets first, which is slow for large ones. this keeps
+    # their order, like repr does
+    def repr_dict(self, x: dict, level: int) -> str:
+        if not x:
+            return "{}"
+        if level <= 0:
+            self.cut = True
+            return "{...}"
+        keys, more = self._items(x, self.maxdict)
+        pieces = self._pieces(
+            keys,
+            lambda k: f"{self.repr1(k, level - 1)}: {self.repr1(x[k], level - 1)}",
+            more,
+        )
+        return "{" + ", ".join(pieces) + "}"
+
+    def _repr_pairs(self, x: dict, level: int) -> str:
+        """The items of a dict as a list of pairs, like the repr of OrderedDict."""
+        if level <= 0:
+            self.cut = True
+            return "[...]"
+        keys, more = self._items(x, self.maxdict)
+        pieces = self._pieces(
+            keys,
+            lambda k: f"({self.repr1(k, level - 1)}, {self.repr1(x[k], level - 1)})",
+            more,
+        )
+        return "[" + ", ".join(pieces) + "]"
+
+    def _repr_set(self, x: Any, level: int, limit: int, left: str, right: str) -> str:
+        if level <= 0:
+            self.cut = True
+            return left + "..." + right
+        items, more = self._items(x, limit)
+        pieces = self._pieces(items, lambda item: self.repr1(item, level - 1), more)
+        return left + ", ".join(pieces) + right
+
+    def repr_set(self, x: set, level: int) -> str:
+        if not x:
+            return "set()"
+        return self._repr_set(x, level, self.maxset, "{", "}")
+
+    def repr_frozenset(self, x: frozenset, level: int) -> str:
+        if not x:
+            return "frozenset()"
+        return self._repr_set(x, level, self.maxfrozenset, "frozenset({", "})")
+
+    def repr_str(self, x: str, level: int) -> str:
+        if len(x) > self.maxstring:
+            self.cut = True
+            return repr(x[: self.maxstring]) + "..."
+        return repr(x)
+
+    def repr_bytes(self, x: bytes, level: int) -> str:
+        if len(x) > self.maxstring:
+            self.cut = True
+            return repr(x[: self.maxstring]) + "..."
+        return repr(x)
+
+    def repr_bytearray(self, x: bytearray, level: int) -> str:
+        if len(x) > self.maxstring:
+            self.cut = True
+            return f"bytearray({bytes(x[: self.maxstring])!r}...)"
+        return repr(x)
+
+    def repr_instance(self, x: Any, level: int) -> str:
+        module = type(x).__module__.split(".")[0]
+        try:
+            if module in ("numpy", "pandas") and module in sys.modules:
+                s = _summarized_repr(x, module)
+            else:
+                s = repr(x)
+        except Exception:
+            # like reprlib
+            return f"<{type(x).__name__} instance at {id(x):#x}>"
+        if len(s) > self.maxother:
+            self.cut = True
+            s = s[: self.maxother] + "..."
+        return s
+
+
+def _summarized_repr(x: Any, module: str) -> str:
+    """The repr of a numpy or pandas value with few enough items shown."""
+    try:
+        if module == "numpy":
+            numpy = sys.modules["numpy"]
+            with numpy.printoptions(threshold=100, edgeitems=3):
+                return repr(x)
+        pandas = sys.modules["pandas"]
+        with pandas.option_context("display.max_rows", 20, "display.max_columns", 20):
+            return repr(x)
+    except Exception:
+        # an old version without printoptions or option_context
+        return repr(x)
+
+
+def safe_repr(
+    value: Any, max_chars: int = MAX_DISPLAY_CHARS, seconds: float = MAX_DISPLAY_SECONDS
+) -> Tuple[str, bool]:
+    """The repr of the value within the limits, and whether it was cut."""
+    r = SafeRepr(max_chars, seconds)
+    text = r.repr(value)
+    return text, r.cut
@@ -1,48 +1,177 @@
-from typing import Any, List, Optional, Union
-from dataclasses import dataclass
+import sys
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Union
+from dataclasses import dataclass, fields, replace
+
+from pai.code_exec import SpilledOutput
+
+if TYPE_CHECKING:
+    from pai.session import SessionStore
+    from pai.telemetry import Span
+
+
+def _slotted(cls: type) -> type:
+    """
+    The dataclass with __slots__ for its fields, like dataclass(slots=True) on 3.10+.
+
+    A class with __slots__ can't have class attributes of the same names, so slots
+    can't be declared on a dataclass with defaults. The class is made again without
+    them. The defaults are kept by __init__.
+    """
+    names = tuple(f.name for f in fields(cls))
+    body = {k: v for k, v in cls.__dict__.items() if k not in names}
+    body.pop("__dict__", None)
+    body.pop("__weakref__", None)
+    body["__slots__"] = names
+    body["__qualname__"] = cls.__qualname__
+    return type(cls)(cls.__name__, cls.__bases__, body)
 
 
 class HistoryNode:
+    # a long session has a lot of nodes. the node and data classes use slots to keep
+    # them small. prompts repeat, so they are interned
+
+    @_slotted
     @dataclass
     class UserCode:
         code: str
         result: str
+        # the part of the result that was too large to keep in memory
+        spilled_output: Optional[SpilledOutput] = None
 
+    @_slotted
     @dataclass
     class LLMCode:
         prompt: str
         code: str
         result: str
         raw_resp: Any
+        spilled_output: Optional[SpilledOutput] = None
 
+        def __post_init__(self):
+            self.prompt = sys.intern(self.prompt)
+
+    @_slotted
     @dataclass
     class LLMError:
         prompt: str
         error: str
         raw_resp: Any
 
+        def __post_init__(self):
+            self.prompt = sys.intern(self.prompt)
+
+    @_slotted
     @dataclass
     class LLMMessage:
         prompt: str
         message: str
         raw_resp: Any
 
+        def __post_init__(self):
+            self.prompt = sys.intern(self.prompt)
+
+    @_slotted
+    @dataclass
+    class Summary:
+        summary: str
+        # how many nodes from the start of the lineage it replaces
+        nodes: int
+
+    @_slotted
     @dataclass
     class Root:
         pass
 
-    Data = Union[UserCode, LLMCode, LLMMessage, LLMError, Root]
+    Data = Union[UserCode, LLMCode, LLMMessage, LLMError, Summary, Root]
 
-    data: Data
-    children: List["HistoryNode"] = []
-    parent: Optional["HistoryNode"] = None
-    depth: int = 0
+    __slots__ = (
+        "_data",
+        "_load",
+        "children",
+        "parent",
+        "depth",
+        "token_count",
+        "id",
+        "spans",
+        "summary",
+        # llms cache the messages rendered for a node in weak dicts
+        "__weakref__",
+    )
+    children: List["HistoryNode"]
+    parent: Optional["HistoryNode"]
+    depth: int
+    token_count: Optional[int]
+    # the id of the node in the session store
+    id: Optional[int]
+    # how long each phase of the turn that added the node took
+    spans: Optional[List["Span"]]
+    # a node with the summary of the lineage up to and including this node. see
+    # pai.summary
+    summary: Optional["HistoryNode"]
 
-    def __init__(self, data: Data):
-        self.data = data
+    def __init__(
+        self,
+        data: Optional[Data],
+        load: Optional[Callable[[], "HistoryNode.Data"]] = None,
+    ):
+        """Pass load instead of data to read the data the first time it is used."""
+        self._data = data
+        self._load = load
         self.children = []
         self.parent = None
         self.depth = 0
+        self.token_count = None
+        self.id = None
+        self.spans = None
+        self.summary = None
+
+    @property
+    def data(self) -> Data:
+        if self._data is None:
+            assert self._load is not None
+            self._data = self._load()
+            self._load = None
+        return self._data
+
+    @data.setter
+    def data(self, data: Data):
+        self._data = data
+        self._load = None
+
+    def text(self) -> str:
+        """The text of the node that is used as llm context."""
+        data = self.data
+        if isinstance(data, HistoryNode.UserCode):
+            return f"{data.code}\n{data.result}"
+        elif isinstance(data, HistoryNode.LLMCode):
+            return f"{data.prompt}\n{data.code}\n{data.result}"
+        elif isinstance(data, HistoryNode.LLMMessage):
+            return f"{data.prompt}\n{data.message}"
+        elif isinstance(data, HistoryNode.LLMError):
+            return f"{data.prompt}\n{data.error}"
+        elif isinstance(data, HistoryNode.Summary):
+            return data.summary
+        return ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The node as data that can be written as JSON. Raw llm responses are left out."""
+        data = self.data
+        d: Dict[str, Any] = {"kind": type(data).__name__, "depth": self.depth}
+        for f in fields(data):
+            if f.name not in ("raw_resp", "spilled_output"):
+                d[f.name] = getattr(data, f.name)
+        if self.spans is not None:
+            d["spans"] = [
+                {"name": s.name, "start": s.start, "duration": s.duration, **s.attrs}
+                for s in self.spans
+            ]
+        return d
+
+    def tokens(self, count_tokens: Callable[[str], int]) -> int:
+        """The number of tokens in the node. Counted once and cached on the node."""
+        if self.token_count is None:
+            self.token_count = count_tokens(self.text())
+        return self.token_count
 
     def add_child(self, child_node):
         child_node.parent = self
@@ -51,44 +180,96 @@ class HistoryNode:
 
 
 class HistoryTree:
-    def __init__(self):
-        self.root = HistoryNode(HistoryNode.Root())
+    def __init__(
+        self,
+        store: Optional["SessionStore"] = None,
+        root: Optional[HistoryNode] = None,
+    ):
+        """
+        store: append the tree to this session store as it grows
+
+        root: the root of a tree that was already built, e.g. from a session store
+        """
+        self.store = store
+        if root is None:
+            root = HistoryNode(HistoryNode.Root())
+            if store is not None:
+                store.add_node(root, root)
+        self.root = root
         self.cursor = self.root
+        # called with the new cursor when the cursor moves to another node, other
+        # than a node that was just added
+        self.branch_listeners: List[Callable[[HistoryNode], None]] = []
+        # called with each node that is added
+        self.add_listeners: List[Callable[[HistoryNode], None]] = []
 
-    def add_node(self, data: HistoryNode.Data):
+    def add_node(self, data: HistoryNode.Data) -> HistoryNode:
         """Add a new execution to the history tree."""
         new_node = HistoryNode(data)
         self.cursor.add_child(new_node)
         self.cursor = new_node
+        if self.store is not None:
+            self.store.add_node(self.root, new_node)
+        for listener in self.add_listeners:
+            listener(new_node)
+        return new_node
+
+    def _move(self, node: HistoryNode):
+        self.cursor = node
+        if self.store is not None:
+            self.store.move_cursor(self.root, node)
+        for listener in self.branch_listeners:
+            listener(node)
 
     def move_up(self):
         """Move the cursor to the parent node."""
         if self.cursor.parent:
-            self.cursor = self.cursor.parent
+            self._move(self.cursor.parent)
 
     def move_to_child(self, index: int):
         """Move the cursor to a specified child node."""
         if 0 <= index < len(self.cursor.children):
-            self.cursor = self.cursor.children[index]
+            self._move(self.cursor.children[index])
 
     def branch_from(self, node):
         """Set the cursor to a specific node."""
-        self.cursor = node
+        self._move(node)
 
     def current_position(self) -> HistoryNode:
         """Get the current node the cursor is pointing to."""
         return self.cursor
 
-    def lineage(self, max_nodes: Optional[int] = None) -> List[HistoryNode]:
-        """Get the lineage of the current node starting from the root."""
+    def lineage(
+        self,
+        max_nodes: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+    ) -> List[HistoryNode]:
+        """
+        Get the lineage of the current node starting from the root.
+
+        max_nodes: only include the newest max_nodes nodes
+
+        max_tokens: only include the newest nodes that fit in max_tokens tokens.
+        count_tokens is used to count the tokens in each node. The newest node is
+        always included. If it doesn't fit, a copy with the middle of its result cut
+        out is included instead.
+        """
         lineage = []
+        tokens = 0
         node = self.cursor
         while node and (max_nodes is None or len(lineage) < max_nodes):
+            if max_tokens is not None and count_tokens is not None:
+                tokens += node.tokens(count_tokens)
+                if tokens > max_tokens:
+                    if not lineage:
+                        lineage.append(_cut_to_fit(node, max_tokens, count_tokens))
+                    break
             lineage.append(node)
             node = node.parent
 
         # remove the last node if it is the root node
-        if lineage[-1] and isinstance(lineage[-1].data, HistoryNode.Root):
+        if lineage and isinstance(lineage[-1].data, HistoryNode.Root):
             lineage.pop()
 
         # reverse the list so that the root is first
@@ -103,3 +284,29 @@ class HistoryTree:
 
     def __repr__(self):
         return f"HistoryTree(cursor={self.cursor})"
+
+
+def _cut_to_fit(
+    node: HistoryNode, max_tokens: int, count_tokens: Callable[[str], int]
+) -> HistoryNode:
+    """
+    A copy of the node with the middle of its result cut out, so it fits in max_tokens
+    if it can. The start and the end of the output, e.g. a traceback, are kept.
+    """
+    data = node.data
+    if not isinstance(data, (HistoryNode.UserCode, HistoryNode.LLMCode)):
+        return node
+    result = data.result
+    # a first guess from the share of the tokens that fits, then smaller until it fits
+    keep = len(result) * max_tokens // max(1, node.tokens(count_tokens))
+    while True:
+        cut = (
+            result[: keep // 2]
+            + "\n... (output cut)\n"
+            + result[len(result) - keep // 2 :]
+        )
+        short = HistoryNode(replace(data, result=cut))
+        short.depth = node.depth
+        if keep == 0 or short.tokens(count_tokens) <= max_tokens:
+            return short
+        keep -= max(1, keep // 10)
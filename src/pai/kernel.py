@@ -0,0 +1,648 @@
+"""
+Run code in a worker process instead of the process running the REPL.
+
+The worker owns the namespace and runs each cell with CodeExec. It talks to KernelExec
+over a socket using multiprocessing Connection messages:
+
+    parent -> worker
+        ("init", KernelConfig, values, function_names)
+        ("run", run_id, source)
+        ("return", value)  reply to a "call"
+        ("jobs",)  take the background jobs that finished
+        ("digest",)  describe the variables, see pai.digest
+        ("snapshot",)  fork a snapshot of the namespace
+        ("shutdown",)
+
+    worker -> parent
+        ("output", run_id, text)  output written while the cell runs
+        ("call", name, args, kwargs)  call a function that lives in the parent
+        ("result", run_id, result, spill_path, spill_size)
+        ("jobs", [(job_id, source, result, spill_path, spill_size), ...])
+        ("digest", text)
+        ("snapshot", pid)  followed by the socket of the snapshot
+        ("snapshot", None, reason)  no snapshot was taken because other threads run
+
+    parent -> snapshot
+        ("resume",)  fork a worker with the namespace of the snapshot
+
+    snapshot -> parent
+        ("resumed", pid)  followed by the socket of the new worker
+
+Runaway code only takes down the worker. It is restarted without touching the history.
+
+A snapshot is a forked copy of the worker that waits until it is resumed. Forking is
+copy-on-write, so a snapshot only costs the memory the worker changes after it, and
+resuming takes milliseconds however large the namespace is. Closing the socket of a
+snapshot ends it.
+"""
+import os
+import pickle
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+
+from pai.code_exec import (
+    DEFAULT_OUTPUT_HEAD,
+    DEFAULT_OUTPUT_TAIL,
+    CodeExec,
+    FinishedJob,
+    SpilledOutput,
+)
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
+
+# how long an interrupted cell has to stop before the worker is killed
+INTERRUPT_GRACE_SECONDS = 2.0
+
+
+@dataclass
+class KernelConfig:
+    # wall clock seconds a cell can run before it is interrupted
+    timeout: Optional[float] = None
+    # bytes of address space the worker can use
+    memory_limit: Optional[int] = None
+    # seconds of cpu time a cell can use
+    cpu_limit: Optional[int] = None
+    output_head: int = DEFAULT_OUTPUT_HEAD
+    output_tail: int = DEFAULT_OUTPUT_TAIL
+    # add bg(), jobs() and wait() to the namespace of the worker
+    background_jobs: bool = False
+    # how many snapshots of the namespace to keep. the oldest are dropped
+    snapshots: int = 0
+
+
+def _spill_message(spill: Optional[SpilledOutput]):
+    """The path and size of the spilled output, which the parent takes over."""
+    if spill is None:
+        return None, 0
+    spill._finalizer.detach()
+    return spill.path, spill.size
+
+
+def _kill(proc: subprocess.Popen):
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+class KernelExec:
+    """Runs code in a worker process. Has the same interface as CodeExec."""
+
+    def __init__(
+        self, locals: Dict[str, Any] = {}, config: KernelConfig = KernelConfig()
+    ):
+        if os.name != "posix":
+            raise RuntimeError("The kernel is only supported on POSIX systems")
+
+        self.config = config
+        # functions can't be sent to the worker. the worker gets stubs that call back to them
+        self.functions: Dict[str, Callable] = {
+            k: v for k, v in locals.items() if callable(v)
+        }
+        self.values: Dict[str, Any] = {
+            k: v for k, v in locals.items() if not callable(v)
+        }
+        self.last_spill: Optional[SpilledOutput] = None
+        # see CodeExec.last_failed
+        self.last_failed = False
+        # why the worker didn't take the last snapshot. None if it took it
+        self.snapshot_skipped: Optional[str] = None
+        self.startup_code: List[str] = []
+        self._run_id = 0
+        self._busy = False
+        self._restart_pending = False
+        self._close_pending = False
+        self._restarting = False
+        self._lock = threading.RLock()
+        self._proc: Optional[subprocess.Popen] = None
+        # the worker. not the pid of _proc after a snapshot was restored
+        self._pid: Optional[int] = None
+        self._conn: Optional[Connection] = None
+        self._finalizer: Optional[weakref.finalize] = None
+        # the sockets of the snapshots by id, oldest first
+        self._snapshots: Dict[int, Connection] = {}
+        self._snapshot_id = 0
+        self._start()
+
+    def _start(self):
+        parent_sock, child_sock = socket.socketpair()
+
+        # make sure the worker imports this copy of pai
+        env = dict(os.environ)
+        pai_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(
+            p for p in [pai_path, env.get("PYTHONPATH")] if p
+        )
+
+        self._proc = subprocess.Popen(
+            [sys.executable, "-m", "pai.kernel", str(child_sock.fileno())],
+            pass_fds=[child_sock.fileno()],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            # Ctrl+C in the terminal is forwarded by interrupt() instead
+            start_new_session=True,
+        )
+        child_sock.close()
+        self._pid = self._proc.pid
+        self._conn = Connection(parent_sock.detach())
+        self._conn.send(("init", self.config, self.values, list(self.functions.keys())))
+        self._finalizer = weakref.finalize(self, _kill, self._proc)
+
+    def _stop(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        if self._proc is not None and self._pid != self._proc.pid:
+            # a worker resumed from a snapshot isn't our child. it also exits when
+            # its socket is closed
+            try:
+                os.kill(self._pid, signal.SIGKILL)  # type: ignore
+            except OSError:
+                pass
+        if self._conn is not None:
+            self._conn.close()
+        self._proc = None
+        self._pid = None
+        self._conn = None
+
+    def _alive(self) -> bool:
+        if self._conn is None or self._proc is None:
+            return False
+        if self._pid == self._proc.pid:
+            return self._proc.poll() is None
+        # the socket is closed if a resumed worker died
+        return True
+
+    def restart(self):
+        """Start a new worker with a fresh namespace and run the startup code again."""
+        if self._busy:
+            # restart() was called by the running cell. restart when it is done
+            self._restart_pending = True
+            return
+
+        self._stop()
+        self._start()
+        self._restarting = True
+        try:
+            for source in self.startup_code:
+                self.custom_run_source(source)
+        finally:
+            self._restarting = False
+
+    def _died(self) -> str:
+        """Restart the worker after it died. Returns the message to show for the cell."""
+        if self._restarting:
+            # don't keep restarting a worker that dies while running the startup code
+            return "The kernel died.\n"
+        self._busy = False
+        self.restart()
+        return "The kernel died. It was restarted.\n"
+
+    def close(self):
+        """Stop the worker."""
+        if self._busy:
+            # close() was called by the running cell. close when it is done
+            self._close_pending = True
+            return
+        if self._conn is not None and self._proc is not None:
+            try:
+                self._conn.send(("shutdown",))
+                self._proc.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self._stop()
+        for conn in self._snapshots.values():
+            conn.close()
+        self._snapshots.clear()
+
+    def interrupt(self):
+        """Raise KeyboardInterrupt in the code running in the worker."""
+        if self._alive():
+            try:
+                os.kill(self._pid, signal.SIGINT)  # type: ignore
+            except OSError:
+                pass
+
+    def snapshot(self) -> Optional[int]:
+        """
+        Fork a snapshot of the namespace. Returns its id for restore(), or None if
+        snapshots are off, code is running or other threads run in the worker. Then
+        snapshot_skipped says why.
+        """
+        if not self.config.snapshots or self._busy:
+            return None
+        with self._lock:
+            if not self._alive():
+                return None
+            assert self._conn is not None
+            try:
+                self._conn.send(("snapshot",))
+                while True:
+                    msg = self._conn.recv()
+                    if msg[0] == "snapshot":
+                        break
+                    # anything else is from a cell that was abandoned
+                if msg[1] is None:
+                    self.snapshot_skipped = msg[2]
+                    return None
+                snapshot = Connection(reduction.recv_handle(self._conn))
+                self.snapshot_skipped = None
+            except (EOFError, OSError):
+                return None
+
+            self._snapshot_id += 1
+            self._snapshots[self._snapshot_id] = snapshot
+            while len(self._snapshots) > self.config.snapshots:
+                oldest = next(iter(self._snapshots))
+                self._snapshots.pop(oldest).close()
+            return self._snapshot_id
+
+    def restore(self, snapshot: int) -> bool:
+        """
+        Replace the worker with one resumed from the snapshot, so the namespace is
+        what it was when the snapshot was taken. The snapshot can be restored again.
+        Returns False if the snapshot was dropped or code is running.
+        """
+        if self._busy:
+            return False
+        with self._lock:
+            conn = self._snapshots.pop(snapshot, None)
+            if conn is None:
+                return False
+            try:
+                conn.send(("resume",))
+                _, pid = conn.recv()
+                worker = Connection(reduction.recv_handle(conn))
+            except (EOFError, OSError):
+                conn.close()
+                return False
+            # the newest restored snapshot is dropped last
+            self._snapshots[snapshot] = conn
+
+            if self._conn is not None:
+                try:
+                    self._conn.send(("shutdown",))
+                except OSError:
+                    pass
+            # keep _proc, so it is reaped when the kernel is stopped
+            finalizer, proc = self._finalizer, self._proc
+            self._finalizer = None
+            self._stop()
+            self._finalizer, self._proc = finalizer, proc
+            self._pid = pid
+            self._conn = worker
+            return True
+
+    def custom_run_source(
+        self, source: str, on_output: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Run the source in the worker and get the string output. See CodeExec.custom_run_source."""
+        output = self.stream_run_source(source)
+        try:
+            while True:
+                chunk = next(output)
+                if on_output is not None:
+                    on_output(chunk)
+        except StopIteration as e:
+            return e.value
+
+    def stream_run_source(self, source: str) -> Generator[str, None, str]:
+        """
+        Run the source in the worker. Yields the output as it is written and returns the result.
+
+        If the cell runs longer than the timeout it is interrupted. If it doesn't stop,
+        or the worker dies, the worker is restarted and the namespace is lost.
+        """
+        # one cell at a time. a cell the caller stopped waiting for finishes first
+        with self._lock:
+            return (yield from self._stream_run_source(source))
+
+    def _stream_run_source(self, source: str) -> Generator[str, None, str]:
+        self.last_spill = None
+        # until the worker says the cell didn't fail
+        self.last_failed = True
+        if not self._alive():
+            return self._died()
+        assert self._conn is not None
+
+        self._run_id += 1
+        run_id = self._run_id
+        try:
+            self._conn.send(("run", run_id, source))
+        except OSError:
+            return self._died()
+
+        deadline = None
+        if self.config.timeout is not None:
+            deadline = time.monotonic() + self.config.timeout
+
+        self._busy = True
+        interrupted = False
+        timed_out = False
+        try:
+            while True:
+                try:
+                    ready = self._conn.poll(0.1)
+                except KeyboardInterrupt:
+                    if interrupted:
+                        # a second Ctrl+C stops waiting for the cell
+                        raise
+                    interrupted = True
+                    self.interrupt()
+                    continue
+
+                if not ready:
+                    if deadline is not None and time.monotonic() > deadline:
+                        if timed_out:
+                            self._busy = False
+                            self.restart()
+                            return (
+                                f"The cell didn't stop after {self.config.timeout} second timeout. "
+                                "The kernel was restarted.\n"
+                            )
+                        timed_out = True
+                        self.interrupt()
+                        deadline = time.monotonic() + INTERRUPT_GRACE_SECONDS
+                    continue
+
+                try:
+                    msg = self._conn.recv()
+                except (EOFError, OSError):
+                    return self._died()
+
+                kind = msg[0]
+                if kind == "output" and msg[1] == run_id:
+                    yield msg[2]
+                elif kind == "call":
+                    _, name, args, kwargs = msg
+                    self._conn.send(("return", self._call(name, args, kwargs)))
+                elif kind == "result" and msg[1] == run_id:
+                    _, _, result, failed, spill_path, spill_size = msg
+                    if spill_path is not None:
+                        self.last_spill = SpilledOutput(spill_path, spill_size)
+                    self.last_failed = failed or timed_out
+                    if timed_out:
+                        result += f"The cell was interrupted after {self.config.timeout} second timeout.\n"
+                    return result
+                # anything else is from a cell that was abandoned
+        finally:
+            self._busy = False
+            if self._close_pending:
+                self._close_pending = False
+                self._restart_pending = False
+                self.close()
+            elif self._restart_pending:
+                self._restart_pending = False
+                self.restart()
+
+    def take_finished_jobs(self) -> List[FinishedJob]:
+        """See CodeExec.take_finished_jobs. The jobs run in the worker."""
+        with self._lock:
+            if not self._alive():
+                return []
+            assert self._conn is not None
+            try:
+                self._conn.send(("jobs",))
+                while True:
+                    msg = self._conn.recv()
+                    if msg[0] == "jobs":
+                        break
+                    # anything else is from a cell that was abandoned
+            except (EOFError, OSError):
+                return []
+        return [
+            (
+                job_id,
+                source,
+                result,
+                SpilledOutput(spill_path, spill_size) if spill_path else None,
+            )
+            for job_id, source, result, spill_path, spill_size in msg[1]
+        ]
+
+    def namespace_digest(self) -> str:
+        """See CodeExec.namespace_digest. Empty while code is running or the worker is down."""
+        if self._busy:
+            return ""
+        with self._lock:
+            if not self._alive():
+                return ""
+            assert self._conn is not None
+            try:
+                self._conn.send(("digest",))
+                while True:
+                    msg = self._conn.recv()
+                    if msg[0] == "digest":
+                        return msg[1]
+                    # anything else is from a cell that was abandoned
+            except (EOFError, OSError):
+                return ""
+
+    def _call(self, name: str, args, kwargs) -> Any:
+        value = self.functions[name](*args, **kwargs)
+        # the return value is only sent back if it can be pickled
+        try:
+            pickle.dumps(value)
+        except Exception:
+            return None
+        return value
+
+
+def _set_cpu_limit(seconds: Optional[int]):
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _on_cpu_limit(signum, frame):
+    raise TimeoutError("The cell exceeded the CPU time limit")
+
+
+def _fork_with_socket() -> Tuple[int, socket.socket]:
+    """
+    Fork a process with a new socket to the parent of the kernel. Returns 0 and its end
+    of the socket in the child, and the pid of the child and the parent's end otherwise.
+    """
+    parent_end, child_end = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        parent_end.close()
+        return 0, child_end
+    child_end.close()
+    return pid, parent_end
+
+
+def _reap(pids: List[int]) -> List[int]:
+    """Reap the children that exited. Returns the ones still running."""
+    running = []
+    for pid in pids:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                running.append(pid)
+        except ChildProcessError:
+            pass
+    return running
+
+
+class _Worker:
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        # the snapshots, or the workers resumed from a snapshot, forked by this process
+        self.children: List[int] = []
+
+    def send(self, msg):
+        # a KeyboardInterrupt in the middle of a message would corrupt the connection
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+        try:
+            self.conn.send(msg)
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGINT})
+
+    def stub(self, name: str) -> Callable:
+        def call(*args, **kwargs):
+            self.send(("call", name, args, kwargs))
+            return self.conn.recv()[1]
+
+        call.__name__ = name
+        return call
+
+    def snapshot(self):
+        """Fork a snapshot. Returns in the snapshot when it is resumed, as the new worker."""
+        self.children = _reap(self.children)
+        # only the forking thread exists in the fork. a job or a pool would never
+        # finish, so no snapshot is taken while other threads run
+        others = [
+            t.name for t in threading.enumerate() if t is not threading.current_thread()
+        ]
+        if others:
+            self.send(("snapshot", None, f"threads are running: {', '.join(others)}"))
+            return
+
+        pid, sock = _fork_with_socket()
+        if pid == 0:
+            self.conn.close()
+            self.conn = Connection(sock.detach())
+            self.children = []
+            self._wait_for_resume()
+            return
+        self.send(("snapshot", pid))
+        reduction.send_handle(self.conn, sock.fileno(), os.getppid())
+        sock.close()
+        self.children.append(pid)
+
+    def _wait_for_resume(self):
+        """Run by a snapshot. Returns in the worker forked when it is resumed."""
+        # only the worker reacts to Ctrl+C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                # the snapshot was dropped or the kernel stopped
+                os._exit(0)
+            self.children = _reap(self.children)
+            if msg[0] != "resume":
+                continue
+
+            pid, sock = _fork_with_socket()
+            if pid == 0:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                self.conn.close()
+                self.conn = Connection(sock.detach())
+                self.children = []
+                return
+            self.conn.send(("resumed", pid))
+            reduction.send_handle(self.conn, sock.fileno(), os.getppid())
+            sock.close()
+            self.children.append(pid)
+
+    def serve(self):
+        _, config, values, function_names = self.conn.recv()
+
+        if resource is not None and config.memory_limit is not None:
+            resource.setrlimit(
+                resource.RLIMIT_AS, (config.memory_limit, config.memory_limit)
+            )
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+
+        locals = dict(values)
+        for name in function_names:
+            locals[name] = self.stub(name)
+        console = CodeExec(
+            locals=locals,
+            output_head=config.output_head,
+            output_tail=config.output_tail,
+            background_jobs=config.background_jobs,
+        )
+
+        while True:
+            try:
+                msg = self.conn.recv()
+            except KeyboardInterrupt:
+                # an interrupt that arrived after the cell finished
+                continue
+            except EOFError:
+                return
+
+            if msg[0] == "shutdown":
+                return
+            elif msg[0] == "run":
+                _, run_id, source = msg
+                _set_cpu_limit(config.cpu_limit)
+                try:
+                    result = console.custom_run_source(
+                        source,
+                        on_output=lambda text: self.send(("output", run_id, text)),
+                    )
+                    failed = console.last_failed
+                except KeyboardInterrupt:
+                    result = "KeyboardInterrupt\n"
+                    failed = True
+                finally:
+                    _set_cpu_limit(None)
+
+                self.send(
+                    (
+                        "result",
+                        run_id,
+                        result,
+                        failed,
+                        *_spill_message(console.last_spill),
+                    )
+                )
+            elif msg[0] == "snapshot":
+                self.snapshot()
+            elif msg[0] == "digest":
+                self.send(("digest", console.namespace_digest()))
+            elif msg[0] == "jobs":
+                self.send(
+                    (
+                        "jobs",
+                        [
+                            (job_id, source, result, *_spill_message(spill))
+                            for job_id, source, result, spill in console.take_finished_jobs()
+                        ],
+                    )
+                )
+
+
+if __name__ == "__main__":
+    _Worker(Connection(int(sys.argv[1]))).serve()
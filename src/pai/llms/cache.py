@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Generator, List, Optional, Tuple
+
+from pai.history import HistoryNode
+from pai.llms.llm_protocol import (
+    LLM,
+    LLMError,
+    LLMResponse,
+    LLMStreamChunk,
+)
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "pai",
+    "llm_cache.sqlite3",
+)
+DEFAULT_CACHE_SIZE = 100 * 1024 * 1024
+
+
+class CachedLLM(LLM):
+    """
+    Wraps an LLM and caches its responses on disk.
+
+    Responses are keyed on the rendered prompt and the description of the LLM. A cache
+    hit replays the stream of the original response without calling the LLM. The least
+    recently used responses are evicted when the cache grows past max_size bytes.
+    Errors are not cached.
+    """
+
+    def __init__(
+        self,
+        llm: LLM,
+        path: str = DEFAULT_CACHE_PATH,
+        max_size: int = DEFAULT_CACHE_SIZE,
+    ) -> None:
+        self.llm = llm
+        self.path = path
+        self.max_size = max_size
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # calls can come from the executor threads of an async console
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._db.commit()
+
+    def agent_support(self) -> bool:
+        return self.llm.agent_support()
+
+    def parallel_support(self) -> bool:
+        return self.llm.parallel_support()
+
+    def count_tokens(self, text: str) -> int:
+        return self.llm.count_tokens(text)
+
+    def count_prompt_tokens(self, rendered: Any) -> int:
+        return self.llm.count_prompt_tokens(rendered)
+
+    def invalidate_cache(self) -> None:
+        # the responses stay valid. only the state of the wrapped llm is dropped
+        self.llm.invalidate_cache()
+
+    def prompt(self, history: List[HistoryNode], prompt: str) -> Any:
+        return self.llm.prompt(history, prompt)
+
+    def description(self) -> str:
+        return self.llm.description()
+
+    def key(self, history: List[HistoryNode], prompt: str) -> str:
+        """The cache key for the prompt rendered from the history."""
+        rendered = json.dumps(
+            self.llm.prompt(history, prompt), sort_keys=True, default=str
+        )
+        h = hashlib.sha256()
+        h.update(self.llm.description().encode("utf-8"))
+        h.update(b"\0")
+        h.update(rendered.encode("utf-8"))
+        return h.hexdigest()
+
+    def call(
+        self, history: List[HistoryNode], prompt: str
+    ) -> Generator[LLMStreamChunk, None, LLMResponse]:
+        key = self.key(history, prompt)
+
+        cached = self._get(key)
+        if cached is not None:
+            chunks, resp = cached
+            for text in chunks:
+                yield LLMStreamChunk(text)
+            return resp
+
+        chunks = []
+        resp = yield from _record(self.llm.call(history, prompt), chunks)
+        if not isinstance(resp, LLMError):
+            self._put(key, chunks, resp)
+        return resp
+
+    def _get(self, key: str) -> Optional[Tuple[List[str], LLMResponse]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            # written by an incompatible version. it is replaced on the next call
+            return None
+
+    def _put(self, key: str, chunks: List[str], resp: LLMResponse):
+        try:
+            value = pickle.dumps((chunks, resp))
+        except Exception:
+            # the raw response can't be stored
+            return
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            # evict the least recently used responses that don't fit
+            self._db.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (
+                            ORDER BY last_used DESC, key
+                        ) AS total FROM responses
+                    ) WHERE total > ?
+                )
+                """,
+                (self.max_size,),
+            )
+            self._db.commit()
+
+    def clear(self):
+        """Remove every cached response."""
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _record(
+    gen: Generator[LLMStreamChunk, None, LLMResponse], chunks: List[str]
+) -> Generator[LLMStreamChunk, None, LLMResponse]:
+    """Pass the stream through, keeping the text of each chunk."""
+    try:
+        while True:
+            chunk = next(gen)
+            chunks.append(chunk.text)
+            yield chunk
+    except StopIteration as e:
+        return e.value
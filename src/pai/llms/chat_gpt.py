@@ -1,10 +1,13 @@
 import json
-from typing import Any, Generator, List, Optional
-import openai
+import sys
+import weakref
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Tuple, Union
 
 from pai.history import HistoryNode
+from pai.llms.code_stream import CodeFieldDecoder, SyntaxCheck
 from pai.llms.llm_protocol import (
     LLM,
+    AsyncLLM,
     LLMError,
     LLMResponse,
     LLMResponseCode,
@@ -24,6 +27,39 @@ Full system and internet access granted.
 """
 
 
+class _PromptPrefix:
+    """The messages built for a lineage, before the prompt is added."""
+
+    def __init__(self, sys_prompt: str) -> None:
+        self.sys_prompt = sys_prompt
+        self.nodes: List[HistoryNode] = []
+        self.messages: List[Any] = [
+            {
+                "role": "system",
+                "content": sys_prompt,
+            },
+        ]
+        # the contents of a trailing user message. they are kept as parts and joined
+        # when the prompt is built so that runs of user code aren't rebuilt on every append
+        self.user_parts: List[str] = []
+
+    def append(self, message: Any) -> None:
+        if self.user_parts:
+            self.messages.append({"role": "user", "content": "".join(self.user_parts)})
+            self.user_parts = []
+        if message["role"] == "user":
+            self.user_parts.append(message["content"])
+        else:
+            self.messages.append(message)
+
+    def copy(self) -> "_PromptPrefix":
+        prefix = _PromptPrefix(self.sys_prompt)
+        prefix.nodes = list(self.nodes)
+        prefix.messages = list(self.messages)
+        prefix.user_parts = list(self.user_parts)
+        return prefix
+
+
 class ChatGPT(LLM):
     model: str
     sys_prompt: str
@@ -31,96 +67,197 @@ class ChatGPT(LLM):
     def __init__(self, model: str, sys_prompt: str = DEFAULT_SYS_PROMPT) -> None:
         self.model = model
         self.sys_prompt = sys_prompt
+        # rendered messages for each history node
+        self._node_cache: "weakref.WeakKeyDictionary[HistoryNode, List[Any]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._last_prefix = _PromptPrefix(sys_prompt)
+        # the history, prompt, system prompt and messages of the last prompt built.
+        # the console builds the prompt to count its tokens just before call() needs it
+        self._last_prompt: Optional[
+            Tuple[List[HistoryNode], str, str, List[Any]]
+        ] = None
+        self._encoding: Any = None
 
     def agent_support(self) -> bool:
         return True
 
+    def parallel_support(self) -> bool:
+        return True
+
     def description(self) -> str:
         return f"{self.model}"
 
+    def count_tokens(self, text: str) -> int:
+        # tiktoken is optional. without it the default estimate is used
+        if self._encoding is None:
+            try:
+                import tiktoken
+
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except Exception:
+                self._encoding = False
+        if self._encoding is False:
+            return super().count_tokens(text)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_prompt_tokens(self, rendered: Any) -> int:
+        # the overhead of the chat format is what openai documents for its chat models
+        tokens = 3  # the reply is primed with the assistant role
+        for message in rendered:
+            tokens += 3
+            for key, value in message.items():
+                if key == "function_call":
+                    tokens += self.count_tokens(value["name"])
+                    tokens += self.count_tokens(value["arguments"])
+                elif value is not None:
+                    tokens += self.count_tokens(value)
+                    if key == "name":
+                        tokens += 1
+        # the function definitions are sent with every request
+        functions = self._request([])["functions"]
+        return tokens + self.count_tokens(json.dumps(functions))
+
+    def _node_messages(self, node: HistoryNode) -> List[Any]:
+        """Render the messages for a single node. The result is cached per node."""
+        messages = self._node_cache.get(node)
+        if messages is not None:
+            return messages
+
+        if isinstance(node.data, HistoryNode.UserCode):
+            messages = [
+                {
+                    "role": "user",
+                    "content": f">>>{node.data.code}\\n{node.data.result}\\n",
+                }
+            ]
+        elif isinstance(node.data, HistoryNode.LLMCode):
+            messages = [
+                {"role": "user", "content": f"{node.data.prompt}"},
+                {
+                    "role": "assistant",
+                    "content": None,  # type: ignore
+                    "function_call": {
+                        "name": "python",
+                        "arguments": json.dumps({"code": node.data.code}),
+                    },
+                },
+                {
+                    "role": "function",
+                    "name": "python",
+                    "content": f"{node.data.result}",
+                },
+            ]
+        elif isinstance(node.data, HistoryNode.LLMMessage):
+            messages = [
+                {"role": "user", "content": f"{node.data.prompt}"},
+                {"role": "assistant", "content": f"{node.data.message}"},
+            ]
+        elif isinstance(node.data, HistoryNode.LLMError):
+            messages = [{"role": "user", "content": f"{node.data.prompt}"}]
+            # the assistant message that couldn't be parsed
+            if node.data.raw_resp is not None:
+                messages.append(node.data.raw_resp)
+            messages.append({"role": "user", "content": f"{node.data.error}"})
+        elif isinstance(node.data, HistoryNode.Summary):
+            messages = [
+                {
+                    "role": "user",
+                    "content": f"Summary of the session so far:\n{node.data.summary}\n",
+                }
+            ]
+        else:
+            # the root node doesn't render to anything
+            messages = []
+
+        self._node_cache[node] = messages
+        return messages
+
+    def _prefix(self, history: List[HistoryNode]) -> "_PromptPrefix":
+        """
+        Get the messages for the history without the prompt.
+
+        History usually grows by appending to the lineage, so the prefix built for the
+        previous call is reused when it is still the start of the history. Only the
+        new nodes are added to it. Trailing nodes that aren't in the tree, like
+        retrieved context, change on every call. They are added to a copy.
+        """
+        if not history:
+            # e.g. to count the tokens of the system prompt. the last prefix is kept
+            return _PromptPrefix(self.sys_prompt)
+        attached = len(history)
+        while attached and history[attached - 1].parent is None:
+            attached -= 1
+        if attached < len(history):
+            prefix = self._prefix(history[:attached]).copy()
+            for node in history[attached:]:
+                self._add_node(prefix, node)
+            return prefix
+
+        prefix = self._last_prefix
+        n = len(prefix.nodes)
+        reusable = (
+            prefix.sys_prompt is self.sys_prompt
+            and len(history) >= n
+            and all(a is b for a, b in zip(history, prefix.nodes))
+        )
+        if not reusable:
+            prefix = _PromptPrefix(self.sys_prompt)
+            n = 0
+
+        for node in history[n:]:
+            self._add_node(prefix, node)
+
+        self._last_prefix = prefix
+        return prefix
+
+    def _add_node(self, prefix: "_PromptPrefix", node: HistoryNode):
+        if isinstance(node.data, HistoryNode.UserCode):
+            # consecutive user code is merged into one user message
+            prefix.user_parts.extend(m["content"] for m in self._node_messages(node))
+        else:
+            for message in self._node_messages(node):
+                prefix.append(message)
+        prefix.nodes.append(node)
+
     def prompt(
         self,
         history: List[HistoryNode],
         prompt: str,
     ) -> Any:
-        messages = [
-            {
-                "role": "system",
-                "content": self.sys_prompt,
-            },
-        ]
+        last = self._last_prompt
+        if (
+            last is not None
+            and last[1] == prompt
+            and last[2] is self.sys_prompt
+            and len(last[0]) == len(history)
+            and all(a is b for a, b in zip(history, last[0]))
+        ):
+            return last[3]
 
-        # build the messages from the history
-        for node in history:
-            if isinstance(node.data, HistoryNode.Root):
-                # skip the root node
-                continue
-            if isinstance(node.data, HistoryNode.UserCode):
-                # check if the last message is user code.
-                # if it is, then add the node data to the last message. if it isn't, then add a new message
-                if messages[-1]["role"] == "user":
-                    messages[-1][
-                        "content"
-                    ] += f">>>{node.data.code}\\n{node.data.result}\\n"
-                else:
-                    messages.append(
-                        {
-                            "role": "user",
-                            "content": f">>>{node.data.code}\\n{node.data.result}\\n",
-                        }
-                    )
-            elif isinstance(node.data, HistoryNode.LLMCode):
-                messages.extend(
-                    [
-                        {"role": "user", "content": f"{node.data.prompt}"},
-                        {
-                            "role": "assistant",
-                            "content": None,  # type: ignore
-                            "function_call": {
-                                "name": "python",
-                                "arguments": json.dumps({"code": node.data.code}),
-                            },
-                        },
-                        {
-                            "role": "function",
-                            "name": "python",
-                            "content": f"{node.data.result}",
-                        },
-                    ]
-                )
-            elif isinstance(node.data, HistoryNode.LLMMessage):
-                messages.extend(
-                    [
-                        {"role": "user", "content": f"{node.data.prompt}"},
-                        {"role": "assistant", "content": f"{node.data.message}"},
-                    ]
-                )
-            elif isinstance(node.data, HistoryNode.LLMError):
-                messages.extend(
-                    [
-                        {"role": "user", "content": f"{node.data.prompt}"},
-                        node.data.raw_resp.choices[0].message,
-                        {"role": "user", "content": f"{node.data.error}"},
-                    ]
-                )
+        prefix = self._prefix(history)
+
+        messages = list(prefix.messages)
+        user_content = "".join(prefix.user_parts)
 
         # if there is a user prompt, then add it to the messages
         if prompt.strip() != "":
-            if messages[-1]["role"] == "user":
+            if prefix.user_parts:
                 # if the last message is a user prompt, then add the prompt to the last message
-                messages[-1]["content"] += f"\\n{prompt}"
+                user_content += f"\\n{prompt}"
             else:
                 # if the last message is not a user prompt, then add a new message
-                messages.append({"role": "user", "content": f"{prompt}"})
+                user_content = f"{prompt}"
 
-        return messages
+        if prefix.user_parts or prompt.strip() != "":
+            messages.append({"role": "user", "content": user_content})
 
-    def call(
-        self, history: List[HistoryNode], prompt: str
-    ) -> Generator[LLMStreamChunk, None, LLMResponse]:
-        messages = self.prompt(history, prompt)
+        self._last_prompt = (list(history), prompt, self.sys_prompt, messages)
+        return messages
 
-        resp: Any = openai.ChatCompletion.create(
+    def _request(self, messages: List[Any]) -> Dict[str, Any]:
+        """The arguments for a streaming ChatCompletion request."""
+        return dict(
             model=self.model,
             messages=messages,
             # function_call={"name": "python"},
@@ -142,31 +279,132 @@ class ChatGPT(LLM):
             stream=True,
         )
 
-        raw_chunks = []
-        response_text = ""
-        func_call = {
+    def call(
+        self, history: List[HistoryNode], prompt: str
+    ) -> Generator[LLMStreamChunk, None, LLMResponse]:
+        messages = self.prompt(history, prompt)
+
+        # openai is slow to import. it is imported on the first call
+        import openai
+
+        resp: Any = openai.ChatCompletion.create(**self._request(messages))
+
+        stream = _ResponseStream()
+        for response_chunk in resp:
+            yield from stream.feed(response_chunk)
+            if stream.syntax_error is not None:
+                # the code can't compile. don't wait for the rest of it
+                if hasattr(resp, "close"):
+                    resp.close()
+                break
+
+        yield from stream.end()
+        return stream.response(prompt)
+
+
+class AsyncChatGPT(ChatGPT, AsyncLLM):
+    """ChatGPT with an async call."""
+
+    async def call(  # type: ignore[override]
+        self, history: List[HistoryNode], prompt: str
+    ) -> AsyncGenerator[Union[LLMStreamChunk, LLMResponse], None]:
+        messages = self.prompt(history, prompt)
+
+        import openai
+
+        resp: Any = await openai.ChatCompletion.acreate(**self._request(messages))
+
+        stream = _ResponseStream()
+        async for response_chunk in resp:
+            for chunk in stream.feed(response_chunk):
+                yield chunk
+            if stream.syntax_error is not None:
+                if hasattr(resp, "aclose"):
+                    await resp.aclose()
+                break
+
+        for chunk in stream.end():
+            yield chunk
+        yield stream.response(prompt)
+
+
+class _ResponseStream:
+    """
+    Collects the chunks of a streaming ChatCompletion response.
+
+    The chunks aren't kept. The raw response is the assistant message they add up to,
+    which is all that is needed to render the response in a prompt again.
+
+    The code of a function call is decoded and checked as it arrives. The decoded code
+    is streamed instead of the JSON it is encoded in.
+    """
+
+    def __init__(self) -> None:
+        self.response_text = ""
+        self.func_call = {
             "name": "",
             "arguments": "",
         }
+        self.code = CodeFieldDecoder()
+        self.syntax_check = SyntaxCheck()
+        # set when the code can't compile. the response is stopped there
+        self.syntax_error: Optional[SyntaxError] = None
 
+    def feed(self, response_chunk: Any) -> List[LLMStreamChunk]:
+        """Add a chunk of the response. Returns the text to stream."""
+        chunks = []
         # this is nasty
-        for response_chunk in resp:
-            if "choices" in response_chunk:
-                deltas = response_chunk["choices"][0]["delta"]
-                if "function_call" in deltas:
-                    if "name" in deltas["function_call"]:
-                        func_call["name"] = deltas["function_call"]["name"]
-                    if "arguments" in deltas["function_call"]:
-                        func_call["arguments"] += deltas["function_call"]["arguments"]
-                        yield LLMStreamChunk(deltas["function_call"]["arguments"])
-                elif "content" in deltas:
-                    response_text += deltas["content"]
-                    yield LLMStreamChunk(deltas["content"])
-                if response_chunk["choices"][0]["finish_reason"] == "function_call":
-                    yield LLMStreamChunk(f"\n")
-            raw_chunks.append(response_chunk)
-
-        yield LLMStreamChunk(f"\n")
+        if "choices" in response_chunk:
+            deltas = response_chunk["choices"][0]["delta"]
+            if "function_call" in deltas:
+                if "name" in deltas["function_call"]:
+                    self.func_call["name"] = deltas["function_call"]["name"]
+                if "arguments" in deltas["function_call"]:
+                    arguments = deltas["function_call"]["arguments"]
+                    self.func_call["arguments"] += arguments
+                    code = self.code.feed(arguments)
+                    if code:
+                        chunks.append(LLMStreamChunk(code))
+                        self.syntax_error = self.syntax_check.feed(code)
+            elif "content" in deltas:
+                self.response_text += deltas["content"]
+                chunks.append(LLMStreamChunk(deltas["content"]))
+            if response_chunk["choices"][0]["finish_reason"] == "function_call":
+                chunks.append(LLMStreamChunk(f"\n"))
+        return chunks
+
+    def end(self) -> List[LLMStreamChunk]:
+        """The text to stream after the last chunk."""
+        if self.syntax_error is not None:
+            return [LLMStreamChunk(f"\n{self._syntax_error_message()}\n")]
+        return [LLMStreamChunk(f"\n")]
+
+    def _syntax_error_message(self) -> str:
+        e = self.syntax_error
+        assert e is not None
+        return f"SyntaxError: {e.msg} (line {e.lineno}). The function call was stopped."
+
+    def message(self) -> Dict[str, Any]:
+        """The assistant message of the response."""
+        message: Dict[str, Any] = {
+            "role": "assistant",
+            "content": self.response_text or None,
+        }
+        if self.func_call["name"] != "":
+            message["function_call"] = {
+                "name": sys.intern(self.func_call["name"]),
+                "arguments": self.func_call["arguments"],
+            }
+        return message
+
+    def response(self, prompt: str) -> LLMResponse:
+        """The response once all the chunks have been added."""
+        func_call = self.func_call
+        response_text = self.response_text
+        raw = self.message()
+
+        if self.syntax_error is not None:
+            return LLMError(prompt=prompt, error=self._syntax_error_message(), raw=raw)
 
         # check if the response is a function call
         if func_call["name"] != "":
@@ -184,21 +422,21 @@ class ChatGPT(LLM):
                         prompt=prompt,
                         code=func_call["arguments"],
                         message=response_text or None,
-                        raw=raw_chunks,
+                        raw=raw,
                     )
                 except SyntaxError:
                     # return the original JSONDecodeError
-                    return LLMError(prompt=prompt, error=str(e), raw=resp)
+                    return LLMError(prompt=prompt, error=str(e), raw=raw)
 
             return LLMResponseCode(
                 prompt=prompt,
                 code=j["code"],
                 message=response_text or None,
-                raw=raw_chunks,
+                raw=raw,
             )
         else:
             return LLMResponseMessage(
                 prompt=prompt,
                 message=response_text,
-                raw=raw_chunks,
+                raw=raw,
             )
@@ -0,0 +1,184 @@
+"""
+Decode the code of a function call while it is streamed.
+
+The arguments of a function call arrive as pieces of a JSON object like
+{"code": "import os\\nos.listdir()"}. CodeFieldDecoder turns them into the code they
+encode as they arrive, and SyntaxCheck checks that code one line at a time, so a call
+whose code can't compile can be stopped before it is finished.
+"""
+import codeop
+import re
+import warnings
+from typing import List, Optional
+
+_CODE_KEY_RE = re.compile(r'"code"\s*:\s*"')
+# characters of a JSON string that don't need decoding
+_PLAIN_RE = re.compile(r'[^"\\]+')
+# a line that starts a statement, not a clause of the statement before it
+_NEW_STATEMENT_RE = re.compile(r"(?!(?:else|elif|except|finally)\b)[^\s#]")
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class CodeFieldDecoder:
+    """
+    Decodes the code field from the pieces of the arguments of a function call.
+
+    Sometimes the arguments are just code, not a JSON object. Then they are passed
+    through as they are.
+    """
+
+    def __init__(self) -> None:
+        # start, key, string, done or raw
+        self.state = "start"
+        self.code = ""
+        # text that can't be decoded until more arrives, e.g. half an escape
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        """Add a piece of the arguments. Returns the code decoded from it."""
+        if self.state == "start":
+            text = self._pending + text
+            stripped = text.lstrip()
+            if not stripped:
+                self._pending = text
+                return ""
+            self._pending = ""
+            self.state = "key" if stripped[0] == "{" else "raw"
+
+        if self.state == "raw":
+            self.code += text
+            return text
+
+        if self.state == "key":
+            text = self._pending + text
+            m = _CODE_KEY_RE.search(text)
+            if m is None:
+                self._pending = text
+                return ""
+            self._pending = ""
+            self.state = "string"
+            text = text[m.end() :]
+
+        if self.state == "string":
+            decoded = self._decode(self._pending + text)
+            self.code += decoded
+            return decoded
+
+        return ""
+
+    def _decode(self, text: str) -> str:
+        out: List[str] = []
+        self._pending = ""
+        i = 0
+        while i < len(text):
+            m = _PLAIN_RE.match(text, i)
+            if m is not None:
+                out.append(m.group())
+                i = m.end()
+                continue
+
+            if text[i] == '"':
+                # the end of the string
+                self.state = "done"
+                break
+
+            # an escape
+            if i + 1 == len(text):
+                self._pending = text[i:]
+                break
+            c = text[i + 1]
+            if c != "u":
+                out.append(_ESCAPES.get(c, c))
+                i += 2
+                continue
+
+            if i + 6 > len(text):
+                self._pending = text[i:]
+                break
+            n = int(text[i + 2 : i + 6], 16)
+            if 0xD800 <= n < 0xDC00:
+                # the first half of a surrogate pair. the second half is another \u escape
+                if i + 12 > len(text) and text[i + 6 : i + 8] in ("", "\\", "\\u"):
+                    self._pending = text[i:]
+                    break
+                if text[i + 6 : i + 8] == "\\u":
+                    low = int(text[i + 8 : i + 12], 16)
+                    if 0xDC00 <= low < 0xE000:
+                        out.append(chr(0x10000 + ((n - 0xD800) << 10) + (low - 0xDC00)))
+                        i += 12
+                        continue
+            out.append(chr(n))
+            i += 6
+        return "".join(out)
+
+
+class SyntaxCheck:
+    """
+    Checks code for syntax errors as it grows.
+
+    The code is checked each time a line is finished. Code that is only unfinished,
+    e.g. an open bracket, a block without a body yet or a backslash at the end of the
+    line, is not an error. Statements that are known to be complete aren't compiled
+    again.
+    """
+
+    def __init__(self) -> None:
+        self.source = ""
+        self.error: Optional[SyntaxError] = None
+        # where the last check ended
+        self._checked = 0
+        # the start of the statements that are still checked, and the line it is on
+        self._start = 0
+        self._start_line = 0
+        # where the last check ended if the code up to there was complete
+        self._complete = -1
+
+    def feed(self, text: str) -> Optional[SyntaxError]:
+        """Add code. Returns the syntax error if the code can't compile."""
+        self.source += text
+        if self.error is not None or "\n" not in text:
+            return self.error
+
+        end = self.source.rfind("\n") + 1
+        if end <= self._checked or self.source.endswith(("\\\n", "\\\r\n"), 0, end):
+            # nothing new, or the last line is continued by a backslash. it can't be
+            # checked until the line it continues on is finished
+            return None
+
+        if self._complete >= 0 and _NEW_STATEMENT_RE.match(self.source, self._complete):
+            # everything before is complete and can't be continued by what follows
+            self._start_line += self.source.count("\n", self._start, self._complete)
+            self._start = self._complete
+        self._checked = end
+        self._complete = -1
+
+        try:
+            with warnings.catch_warnings():
+                # e.g. invalid escape sequences. they are reported when the code runs
+                warnings.simplefilter("ignore")
+                compiled = codeop.compile_command(
+                    self.source[self._start : end], "<llm>", "exec"
+                )
+        except SyntaxError as e:
+            if "unexpected EOF" in str(e.msg):
+                # only unfinished, like the ones compile_command returns None for
+                return self.error
+            if e.lineno is not None:
+                e.lineno += self._start_line
+            self.error = e
+        except (ValueError, OverflowError):
+            # e.g. a null byte. left for the final compile to report
+            pass
+        else:
+            if compiled is not None:
+                self._complete = end
+        return self.error
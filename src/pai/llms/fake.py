@@ -1,8 +1,10 @@
+import asyncio
 import time
-from typing import Any, Generator, List
+from typing import Any, AsyncGenerator, Generator, List, Union
 from pai.history import HistoryNode
 from pai.llms.llm_protocol import (
     LLM,
+    AsyncLLM,
     LLMError,
     LLMResponse,
     LLMResponseCode,
@@ -16,26 +18,51 @@ def chunk_string(s, n):
     return [s[i : i + n] for i in range(0, len(s), n)]
 
 
+FAKE_MESSAGE = "This code will list the files\nin the current directory. \n```python\nimport os\nos.listdir()\n```\n"
+
+
+def fake_response(prompt: str) -> LLMResponse:
+    return LLMResponseCode(
+        prompt=prompt,
+        code="import os\nos.listdir()",
+        message="This code will list the files\nin the current directory.",
+        raw=None,
+    )
+
+
 class FakeLLM(LLM):
+    def __init__(self, chunk_delay: float = 0.2) -> None:
+        # seconds to wait after each chunk. 0 streams as fast as possible
+        self.chunk_delay = chunk_delay
+
     def prompt(self, history: List[HistoryNode], prompt: str) -> Any:
         return prompt
 
     def description(self) -> str:
         return "FakeLLM"
 
+    def parallel_support(self) -> bool:
+        return True
+
     def call(
         self, history: List[HistoryNode], prompt: str
     ) -> Generator[LLMStreamChunk, None, LLMResponse]:
-        message = "This code will list the files\nin the current directory. \n```python\nimport os\nos.listdir()\n```\n"
-
         # chuck the message by 7 characters
-        for s in chunk_string(message, 7):
+        for s in chunk_string(FAKE_MESSAGE, 7):
             yield LLMStreamChunk(s)
-            time.sleep(0.2)
-
-        return LLMResponseCode(
-            prompt=prompt,
-            code="import os\nos.listdir()",
-            message="This code will list the files\nin the current directory.",
-            raw=None,
-        )
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+
+        return fake_response(prompt)
+
+
+class AsyncFakeLLM(FakeLLM, AsyncLLM):
+    async def call(  # type: ignore[override]
+        self, history: List[HistoryNode], prompt: str
+    ) -> AsyncGenerator[Union[LLMStreamChunk, LLMResponse], None]:
+        for s in chunk_string(FAKE_MESSAGE, 7):
+            yield LLMStreamChunk(s)
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+
+        yield fake_response(prompt)
@@ -1,4 +1,4 @@
-from typing import Any, Generator, List
+from typing import Any, Generator, List, Optional, Sequence, Tuple
 from pai.history import HistoryNode
 from pai.llms.llm_protocol import (
     LLM,
@@ -7,19 +7,72 @@ from pai.llms.llm_protocol import (
     LLMResponseCode,
     LLMStreamChunk,
 )
-from llama_cpp import CompletionChunk, Iterator, Llama
+from llama_cpp import CompletionChunk, Iterator, Llama, LlamaState
+
+
+def longest_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    """Length of the common prefix of two token sequences."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
 
 
 class LlamaCpp(LLM):
     llama: Llama
+    # the model state after the prompt of the last call was evaluated, before any
+    # tokens were sampled. history only grows by appending, so the next prompt
+    # usually starts with the tokens of this state and only the new suffix has to be
+    # evaluated. states are matched to prompts by their tokens, so they stay usable
+    # when the history branches
+    prompt_state: Optional[LlamaState]
 
     def __init__(self, model_location: str) -> None:
         self.llama = Llama(model_location, verbose=False)
+        self.prompt_state = None
+        # the history, prompt and text of the last prompt built. the console builds
+        # the prompt to count its tokens just before call() needs it
+        self._last_prompt: Optional[Tuple[List[HistoryNode], str, str]] = None
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.llama.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def _restore_prompt_state(self, tokens: List[int]):
+        """Load the saved state if it shares a longer prefix with the prompt than the current state."""
+        if self.prompt_state is None:
+            return
+
+        state = self.prompt_state
+        saved = longest_prefix(state.input_ids[: state.n_tokens].tolist(), tokens)
+        live = longest_prefix(
+            self.llama.input_ids[: self.llama.n_tokens].tolist(), tokens
+        )
+        if saved > live:
+            # llama.cpp evaluates only the tokens after the common prefix
+            self.llama.load_state(state)
+
+    def _eval_prompt(self, tokens: List[int]) -> bool:
+        """Evaluate the tokens the model doesn't have yet. Returns if there were any."""
+        n = longest_prefix(self.llama.input_ids[: self.llama.n_tokens].tolist(), tokens)
+        self.llama.n_tokens = n
+        self.llama.eval(tokens[n:])
+        return n < len(tokens)
 
     def description(self) -> str:
         return f"llama.cpp: {self.llama.model_path}"
 
     def prompt(self, history: List[HistoryNode], prompt: str) -> str:
+        last = self._last_prompt
+        if (
+            last is not None
+            and last[1] == prompt
+            and len(last[0]) == len(history)
+            and all(a is b for a, b in zip(history, last[0]))
+        ):
+            return last[2]
+
         full_prompt = """print hello\n```python\nprint("hello")\n```\nout: hello\n"""
 
         # build the messages from the history
@@ -34,18 +87,31 @@ class LlamaCpp(LLM):
             elif isinstance(node.data, HistoryNode.LLMCode):
                 full_prompt += f"{node.data.prompt}\n```python\n{node.data.code}\n```\nout: {node.data.result}\n"
             elif isinstance(node.data, HistoryNode.LLMMessage):
-                full_prompt += f"{node.data.prompt}\n: {node.data.message}"
+                full_prompt += f"{node.data.prompt}\n: {node.data.message}\n"
             elif isinstance(node.data, HistoryNode.LLMError):
-                full_prompt += f"{node.data.prompt}\n: {node.data.error}"
+                full_prompt += f"{node.data.prompt}\n: {node.data.error}\n"
+            elif isinstance(node.data, HistoryNode.Summary):
+                full_prompt += f"summary of the session so far\n: {node.data.summary}\n"
 
-        full_prompt += f"\n{prompt}\n```python\n"
+        # rendered the same way as the prompt of an LLMCode node so the prompt
+        # is still a prefix of the next one
+        full_prompt += f"{prompt}\n```python\n"
 
+        self._last_prompt = (list(history), prompt, full_prompt)
         return full_prompt
 
     def call(
         self, history: List[HistoryNode], prompt: str
     ) -> Generator[LLMStreamChunk, None, LLMResponse]:
         full_prompt = self.prompt(history, prompt)
+        # tokenized the same way create_completion tokenizes the prompt
+        tokens = self.llama.tokenize(b" " + full_prompt.encode("utf-8"))
+        self._restore_prompt_state(tokens)
+        # create_completion always evaluates the last token of the prompt again and
+        # reuses the rest, so everything but that token is evaluated here. the state
+        # is saved before sampling, while it is still a prefix of the next prompt
+        if self._eval_prompt(tokens[:-1]) or self.prompt_state is None:
+            self.prompt_state = self.llama.save_state()
 
         resp = self.llama(prompt=full_prompt, max_tokens=64, stop=["```"], stream=True)
 
@@ -1,5 +1,16 @@
+import asyncio
+import json
 from abc import abstractmethod
-from typing import Any, Generator, List, Optional, Protocol, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    Generator,
+    List,
+    Optional,
+    Protocol,
+    Tuple,
+    Union,
+)
 from dataclasses import dataclass
 
 from pai.history import HistoryNode
@@ -39,6 +50,24 @@ class LLM(Protocol):
     def agent_support(self) -> bool:
         return False
 
+    def parallel_support(self) -> bool:
+        """Whether several calls can run at the same time."""
+        return False
+
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens in the text. Defaults to an estimate of 4 characters per token."""
+        return len(text) // 4 + 1
+
+    def count_prompt_tokens(self, rendered: Any) -> int:
+        """Count the tokens in a prompt returned by prompt(), as it is sent."""
+        if not isinstance(rendered, str):
+            rendered = json.dumps(rendered, default=str)
+        return self.count_tokens(rendered)
+
+    def invalidate_cache(self) -> None:
+        """Drop any state cached from previous calls. Called when the history branches."""
+        pass
+
     @abstractmethod
     def call(
         self, history: List[HistoryNode], prompt: str
@@ -53,3 +82,101 @@ class LLM(Protocol):
     def description(self) -> str:
         """Return a description of the LLM."""
         ...
+
+
+class AsyncLLM(Protocol):
+    """
+    An LLM with an async streaming call.
+
+    call() yields LLMStreamChunk items as they arrive. The last item is the LLMResponse.
+    """
+
+    def agent_support(self) -> bool:
+        return False
+
+    def parallel_support(self) -> bool:
+        """Whether several calls can run at the same time."""
+        return False
+
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens in the text. Defaults to an estimate of 4 characters per token."""
+        return len(text) // 4 + 1
+
+    def count_prompt_tokens(self, rendered: Any) -> int:
+        """Count the tokens in a prompt returned by prompt(), as it is sent."""
+        if not isinstance(rendered, str):
+            rendered = json.dumps(rendered, default=str)
+        return self.count_tokens(rendered)
+
+    def invalidate_cache(self) -> None:
+        """Drop any state cached from previous calls. Called when the history branches."""
+        pass
+
+    @abstractmethod
+    def call(
+        self, history: List[HistoryNode], prompt: str
+    ) -> AsyncGenerator[Union[LLMStreamChunk, LLMResponse], None]:
+        ...
+
+    @abstractmethod
+    def prompt(self, history: List[HistoryNode], prompt: str) -> Any:
+        ...
+
+    @abstractmethod
+    def description(self) -> str:
+        """Return a description of the LLM."""
+        ...
+
+
+def _step(gen: Generator) -> Tuple[bool, Any]:
+    """Advance the generator. Returns (done, value)."""
+    try:
+        return False, next(gen)
+    except StopIteration as e:
+        return True, e.value
+
+
+class AsyncLLMWrapper(AsyncLLM):
+    """Use a sync LLM as an AsyncLLM. The blocking calls run in the default executor."""
+
+    def __init__(self, llm: LLM):
+        self.llm = llm
+
+    def agent_support(self) -> bool:
+        return self.llm.agent_support()
+
+    def parallel_support(self) -> bool:
+        return self.llm.parallel_support()
+
+    def count_tokens(self, text: str) -> int:
+        return self.llm.count_tokens(text)
+
+    def count_prompt_tokens(self, rendered: Any) -> int:
+        return self.llm.count_prompt_tokens(rendered)
+
+    def invalidate_cache(self) -> None:
+        self.llm.invalidate_cache()
+
+    def prompt(self, history: List[HistoryNode], prompt: str) -> Any:
+        return self.llm.prompt(history, prompt)
+
+    def description(self) -> str:
+        return self.llm.description()
+
+    async def call(
+        self, history: List[HistoryNode], prompt: str
+    ) -> AsyncGenerator[Union[LLMStreamChunk, LLMResponse], None]:
+        loop = asyncio.get_running_loop()
+        gen = self.llm.call(history, prompt)
+        try:
+            while True:
+                done, value = await loop.run_in_executor(None, _step, gen)
+                yield value
+                if done:
+                    return
+        finally:
+            try:
+                gen.close()
+            except ValueError:
+                # cancelled while the step is still running in the executor
+                pass
@@ -1,25 +1,38 @@
+import re
 import sys
-from typing import Generator, Optional
+from typing import TYPE_CHECKING, Generator, List, Optional
 
 from prompt_toolkit import HTML, PromptSession, print_formatted_text
-from prompt_toolkit.key_binding import KeyBindings
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.document import Document
+from prompt_toolkit.filters import Condition
+from prompt_toolkit.key_binding import KeyBindings, merge_key_bindings
 from prompt_toolkit.keys import Keys
 from prompt_toolkit.styles import Style
 from pai.version import VERSION
 
 
 from pai.console import (
+    DEFAULT_INITIAL_CODE_BLOCKS,
     ConsoleEvent,
     PaiConsole,
     LLMCode,
     LLMMessage,
+    CodeOutputChunk,
     CodeResult,
+    Notice,
     UserCode,
     WaitingForInputApproval,
     WaitingForInput,
     WaitingForLLM,
 )
 from pai.llms.llm_protocol import LLM, LLMStreamChunk
+from pai.replay import ReplayPlan
+from pai.telemetry import Stats, Telemetry
+
+if TYPE_CHECKING:
+    from pai.kernel import KernelConfig
+    from pai.session import SessionStore
 
 
 # Create a session object
@@ -44,6 +57,9 @@ def _(event):
     event.current_buffer.validate_and_handle()
 
 
+# "pai: prompt" or "gen[3]: prompt" to generate 3 candidates
+COMMAND_RE = re.compile(r"^(pai|gen)(?:\[(\d+)\])?:")
+
 prompt_style = Style.from_dict(
     {
         "inp": "bold",
@@ -74,6 +90,10 @@ class REPL:
 
     def _ok_prompt(self) -> HTML:
         """Generate the code gen prompt."""
+        if len(self.candidates) > 1:
+            return HTML(
+                f"<gen>OK? {self.candidate_index + 1}/{len(self.candidates)}> </gen>"
+            )
         return HTML(f"<gen>OK?> </gen>")
 
     def _out_prompt(self) -> HTML:
@@ -84,36 +104,127 @@ class REPL:
         """Generate the multi-line prompt."""
         return HTML(f"<multi>...> </multi>")
 
-    def _pai(self, prompt: str):
+    def _pai(self, prompt: str, candidates: int = 1):
         """Start the LLM agent. Generate code using the LLM. When that code is executed, the LLM is called again with the new context."""
-        self.generator = self.console.streaming_code_gen(prompt, agent_mode=True)
+        self.generator = self.console.streaming_code_gen(
+            prompt, agent_mode=True, candidates=candidates
+        )
 
-    def _gen(self, prompt: str):
+    def _gen(self, prompt: str, candidates: int = 1):
         """Generate code using the LLM."""
-        self.generator = self.console.streaming_code_gen(prompt, agent_mode=False)
+        self.generator = self.console.streaming_code_gen(
+            prompt, agent_mode=False, candidates=candidates
+        )
+
+    def _candidate_bindings(self) -> KeyBindings:
+        """Ctrl+N and Ctrl+P switch between the candidates in the approval prompt."""
+        bindings = KeyBindings()
+        has_candidates = Condition(lambda: len(self.candidates) > 1)
+
+        @bindings.add("c-n", filter=has_candidates)
+        def _(event):
+            self._switch_candidate(event.current_buffer, 1)
+
+        @bindings.add("c-p", filter=has_candidates)
+        def _(event):
+            self._switch_candidate(event.current_buffer, -1)
+
+        return bindings
+
+    def _switch_candidate(self, buffer: Buffer, step: int):
+        # keep the edits to the candidate we are leaving
+        self.candidate_texts[self.candidate_index] = buffer.text
+        self.candidate_index = (self.candidate_index + step) % len(self.candidates)
+        buffer.document = Document(self.candidate_texts[self.candidate_index])
 
     def _reset(self):
         """Reset the console state and history."""
+        self.console.close()
+        # a reset starts a new history in the session store
         self.console = self._new_console(self.llm)
         self.generator = self.console.initial_state_generator()
 
-    def _new_console(self, llm: LLM) -> PaiConsole:
-        # Some initial code blocks to execute that tell the LLM about the system
-        initial_code_blocks = [
-            "import os",
-            "import platform",
-            "platform.version()",
-            "platform.machine()",
-            "os.getcwd()",
-        ]
-
-        funcs = {"pai": self._pai, "gen": self._gen, "reset": self._reset}
-        return PaiConsole(llm, locals=funcs, initial_code_blocks=initial_code_blocks)
-
-    def __init__(self, llm: LLM, initial_prompt: Optional[str] = None):
-        self.session = PromptSession(key_bindings=key_bindings)
+    def _restart(self):
+        """Reset the code execution state but keep the history."""
+        self.console.restart()
+
+    def _stats(self) -> Stats:
+        """Show how long the phases of each turn took and how many tokens were used."""
+        return self.console.stats()
+
+    def _replay(self, *names: str, dry_run: bool = False) -> Optional[ReplayPlan]:
+        """Run only the cells needed to define the names again, e.g. after restart(). All the names if none are given. With dry_run=True, show the cells and how long they took instead."""
+        if dry_run:
+            return self.console.plan_replay(names or None)
+        self.generator = self.console.streaming_replay(names or None)
+        return None
+
+    def _show_output(self, text: str):
+        """Print the output of code while it runs. Called by an OutputReader."""
+        if not self.output_shown:
+            print_formatted_text(self._out_prompt(), style=prompt_style, end="")
+            self.output_shown = True
+        print(text, end="", flush=True)
+
+    def _new_console(self, llm: LLM, resume: bool = False) -> PaiConsole:
+        funcs = {
+            "pai": self._pai,
+            "gen": self._gen,
+            "reset": self._reset,
+            "restart": self._restart,
+            "stats": self._stats,
+            "replay": self._replay,
+        }
+        return PaiConsole(
+            llm,
+            llm_context_tokens=self.llm_context_tokens,
+            locals=funcs,
+            initial_code_blocks=DEFAULT_INITIAL_CODE_BLOCKS,
+            kernel=self.kernel,
+            session=self.session_store,
+            resume=resume,
+            # show the first prompt without waiting for the initial code blocks
+            init_in_background=True,
+            # the stats and the trace cover the whole session, across resets
+            telemetry=self.telemetry,
+            background_jobs=True,
+            retrieve=self.retrieve,
+            summarize_after=self.summarize_after,
+            namespace_digest=self.namespace_digest,
+            on_output=self._show_output,
+        )
+
+    def __init__(
+        self,
+        llm: LLM,
+        initial_prompt: Optional[str] = None,
+        llm_context_tokens: Optional[int] = None,
+        kernel: Optional["KernelConfig"] = None,
+        session_store: Optional["SessionStore"] = None,
+        resume: bool = False,
+        telemetry: Optional[Telemetry] = None,
+        retrieve: int = 0,
+        summarize_after: Optional[int] = None,
+        namespace_digest: bool = False,
+    ):
+        # the candidates being approved
+        self.candidates: List[LLMCode] = []
+        self.candidate_texts: List[str] = []
+        self.candidate_index = 0
+        # the output of the running code was printed by _show_output
+        self.output_shown = False
+        self.session = PromptSession(
+            key_bindings=merge_key_bindings([key_bindings, self._candidate_bindings()])
+        )
         self.llm = llm
-        self.console = self._new_console(llm)
+        self.llm_context_tokens = llm_context_tokens
+        self.kernel = kernel
+        self.session_store = session_store
+        self.telemetry = telemetry or Telemetry()
+        self.retrieve = retrieve
+        self.summarize_after = summarize_after
+        self.namespace_digest = namespace_digest
+        self.console = self._new_console(llm, resume=resume)
         self.generator = self.console.initial_state_generator()
 
         print(f"pai v{VERSION} using {self.console.llm.description()}")
@@ -143,16 +254,18 @@ class REPL:
                     )
 
                     # for convenience, if the user types "pai: <code>" then we start the agent
-                    if line.startswith("pai:"):
-                        line = line[4:].strip()
-                        self.generator = self.console.streaming_code_gen(
-                            line, agent_mode=True
-                        )
-                    elif line.startswith("gen:"):
-                        line = line[4:].strip()
+                    command = COMMAND_RE.match(line)
+                    if command:
+                        line = line[command.end() :].strip()
                         self.generator = self.console.streaming_code_gen(
-                            line, agent_mode=False
+                            line,
+                            agent_mode=command.group(1) == "pai",
+                            candidates=int(command.group(2) or 1),
                         )
+                    elif line.startswith("bg:"):
+                        # "bg: <code>" runs the code on a background thread
+                        code = f"bg({line[3:].strip()!r})"
+                        self.generator = self.console.streaming_exec(UserCode(code))
                     elif line.startswith("!"):
                         line = line[1:].strip()
                         code = f"""os.system("{line}")"""
@@ -163,14 +276,24 @@ class REPL:
                     # The LLM generated code but it hasn't been approved yet
                     # Now we prompt the user with the generated code
                     # So they can edit it, approve it, or cancel it
-                    llm_code = event.code
+                    self.candidates = event.candidates or [event.code]
+                    self.candidate_texts = [c.code for c in self.candidates]
+                    self.candidate_index = 0
+                    if len(self.candidates) > 1:
+                        print(
+                            f"{len(self.candidates)} candidates. 'Ctrl+n' and 'Ctrl+p' to switch."
+                        )
 
-                    edited: str = self.session.prompt(
-                        self._ok_prompt(),
-                        default=llm_code.code,
-                        prompt_continuation=self._multi_prompt(),
-                        style=prompt_style,
-                    )
+                    try:
+                        edited: str = self.session.prompt(
+                            self._ok_prompt,
+                            default=self.candidate_texts[0],
+                            prompt_continuation=self._multi_prompt(),
+                            style=prompt_style,
+                        )
+                        llm_code = self.candidates[self.candidate_index]
+                    finally:
+                        self.candidates = []
 
                     # handle ! shell commands by stripping the ! and running the command
                     if edited.startswith("!"):
@@ -183,10 +306,24 @@ class REPL:
                         code=edited,
                         raw_resp=llm_code.raw_resp,
                         agent_mode=llm_code.agent_mode,
+                        candidates=llm_code.candidates,
                     )
                     self.generator = self.console.streaming_exec(console_inp)
+                elif isinstance(event, CodeOutputChunk):
+                    if not isinstance(last_event, CodeOutputChunk):
+                        print_formatted_text(
+                            self._out_prompt(), style=prompt_style, end=""
+                        )
+                    print(event.text, end="")
                 elif isinstance(event, CodeResult):
-                    if event.value:
+                    streamed = self.output_shown
+                    self.output_shown = False
+                    if streamed or isinstance(last_event, CodeOutputChunk):
+                        # the output was already streamed
+                        # print a newline if the output doesn't end with one
+                        if not event.value.endswith("\n"):
+                            print()
+                    elif event.value:
                         print_formatted_text(
                             self._out_prompt(), style=prompt_style, end=""
                         )
@@ -210,6 +347,8 @@ class REPL:
                     if not isinstance(last_event, LLMStreamChunk):
                         print_formatted_text(self._gen_prompt(), style=prompt_style)
                     print(event.text, end="")
+                elif isinstance(event, Notice):
+                    print(event.text, end="")
                 elif isinstance(event, WaitingForLLM):
                     pass
                 else:
@@ -226,3 +365,6 @@ class REPL:
                 # Handle Ctrl+D (exit)
                 print("\nGoodbye!")
                 break
+
+        self.console.close()
+        self.telemetry.close()
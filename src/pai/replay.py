@@ -0,0 +1,430 @@
+"""
+Rebuild the namespace by running only the cells that are needed.
+
+After restart() or a kernel crash the history is kept but the namespace is gone. Running
+every cell of the lineage again repeats slow downloads and dead ends. Instead, each code
+node is parsed for the names it defines and reads. That gives a dataflow graph from
+which only the cells that lead to the wanted names are run again, in their order.
+
+The analysis is static, so it is an approximation:
+- a method call on a name, e.g. items.append(1), counts as changing it, unless the name
+  is a module
+- binding a name, e.g. data = [], replaces it, so the cells that defined it before
+  aren't needed. Changing it, e.g. data[0] = 1 or data += [1], needs them. So does a
+  binding in an if, for, while, try or with statement, which may not run
+- a function counts as reading the globals it uses when it is defined, and when a later
+  cell uses it
+- cells that use exec(), eval(), globals() or import * are always run again
+- replaying stops at the first cell that fails
+"""
+import ast
+import functools
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+if TYPE_CHECKING:
+    from pai.history import HistoryNode
+
+# calls that can read or bind any name
+_OPAQUE_CALLS = {"exec", "eval", "globals", "locals", "vars"}
+# statements whose body may not run, so their bindings may not happen
+_MAYBE_RUNS: Tuple[type, ...] = tuple(
+    getattr(ast, name)
+    for name in [
+        "If",
+        "For",
+        "AsyncFor",
+        "While",
+        "Try",
+        "TryStar",
+        "With",
+        "AsyncWith",
+        "Match",
+    ]
+    if hasattr(ast, name)
+)
+
+
+class CellNames(NamedTuple):
+    # names bound by the cell
+    stores: FrozenSet[str]
+    # names changed before the cell binds them, e.g. x in x.a = 1, x[0] = 1 or x += 1,
+    # and names bound in a statement that may not run, e.g. x in if c: x = 1
+    mutates: FrozenSet[str]
+    # names read before the cell binds them
+    reads: FrozenSet[str]
+    deletes: FrozenSet[str]
+    imports: FrozenSet[str]
+    # names called directly, e.g. pai in pai("...")
+    calls: FrozenSet[str]
+    # names a method is called on before the cell binds them, e.g. items in
+    # items.append(1)
+    calls_on: FrozenSet[str]
+    # the cell can touch any name
+    opaque: bool
+    # the globals read by the functions and classes the cell binds, by name. they are
+    # read when the function is called, e.g. data for def f(): return len(data)
+    call_reads: Dict[str, FrozenSet[str]] = {}
+
+
+def _base_name(node: ast.AST) -> Optional[str]:
+    """x for x.a.b, x[0] or x.f()[1]."""
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _params(args: ast.arguments) -> Set[str]:
+    params = [
+        *getattr(args, "posonlyargs", []),
+        *args.args,
+        *args.kwonlyargs,
+        args.vararg,
+        args.kwarg,
+    ]
+    return {a.arg for a in params if a is not None}
+
+
+class _Scanner:
+    """Collects the names a statement uses. Nested scopes only leak their free names."""
+
+    def __init__(self):
+        self.loads: Set[str] = set()
+        self.stores: Set[str] = set()
+        self.mutates: Set[str] = set()
+        self.deletes: Set[str] = set()
+        self.imports: Set[str] = set()
+        self.calls: Set[str] = set()
+        self.calls_on: Set[str] = set()
+        # free names of the bodies of functions, read when they are called
+        self.call_reads: Set[str] = set()
+        self.opaque = False
+
+    def scan(self, node: ast.AST):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                self.loads.add(node.id)
+            else:
+                self.stores.add(node.id)
+                if isinstance(node.ctx, ast.Del):
+                    self.deletes.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            self._function(node)
+        elif isinstance(node, ast.ClassDef):
+            self.stores.add(node.name)
+            for child in [*node.decorator_list, *node.bases, *node.keywords]:
+                self.scan(child)
+            # the body of a class runs when it is defined
+            self._inner(node.body, set(), runs_now=True)
+        elif isinstance(
+            node, (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+        ):
+            targets = {
+                n.id
+                for g in node.generators
+                for n in ast.walk(g.target)
+                if isinstance(n, ast.Name)
+            }
+            self._inner([node], targets, runs_now=True, scan_children=True)
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                name = alias.asname or alias.name.split(".")[0]
+                self.stores.add(name)
+                self.imports.add(name)
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.name == "*":
+                    self.opaque = True
+                else:
+                    self.stores.add(alias.asname or alias.name)
+                    self.imports.add(alias.asname or alias.name)
+        else:
+            if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+                # x += 1 reads and changes x
+                self.loads.add(node.target.id)
+                self.mutates.add(node.target.id)
+            elif isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(
+                node.ctx, ast.Load
+            ):
+                base = _base_name(node)
+                if base is not None:
+                    self.mutates.add(base)
+            elif isinstance(node, ast.Call):
+                if isinstance(node.func, ast.Name):
+                    self.calls.add(node.func.id)
+                    if node.func.id in _OPAQUE_CALLS:
+                        self.opaque = True
+                else:
+                    base = _base_name(node.func)
+                    if base is not None:
+                        self.calls_on.add(base)
+            for child in ast.iter_child_nodes(node):
+                self.scan(child)
+
+    def _function(self, node):
+        args = node.args
+        if not isinstance(node, ast.Lambda):
+            self.stores.add(node.name)
+            for decorator in node.decorator_list:
+                self.scan(decorator)
+            if node.returns is not None:
+                self.scan(node.returns)
+            for arg in [*args.args, *args.kwonlyargs]:
+                if arg.annotation is not None:
+                    self.scan(arg.annotation)
+        for default in [*args.defaults, *args.kw_defaults]:
+            if default is not None:
+                self.scan(default)
+        body = node.body if isinstance(node.body, list) else [node.body]
+        self._inner(body, _params(args), runs_now=False)
+
+    def _inner(
+        self,
+        nodes: List[ast.AST],
+        local: Set[str],
+        runs_now: bool,
+        scan_children: bool = False,
+    ):
+        inner = _Scanner()
+        for node in nodes:
+            if scan_children:
+                for child in ast.iter_child_nodes(node):
+                    inner.scan(child)
+            else:
+                inner.scan(node)
+        declared_global = {
+            name
+            for node in nodes
+            for n in ast.walk(node)
+            if isinstance(n, ast.Global)
+            for name in n.names
+        }
+        local = (local | inner.stores) - declared_global
+        self.loads |= inner.loads - local
+        self.stores |= inner.stores & declared_global
+        self.opaque |= inner.opaque
+        self.call_reads |= inner.call_reads - local
+        # the body of a function doesn't run until it is called
+        if not runs_now:
+            self.call_reads |= inner.loads - local
+        else:
+            self.calls |= inner.calls
+            self.calls_on |= inner.calls_on - local
+            self.mutates |= inner.mutates - local
+
+
+@functools.lru_cache(maxsize=1024)
+def cell_names(code: str) -> Optional[CellNames]:
+    """The names the cell uses. None if it doesn't parse, so it never ran."""
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    return tree_names(tree)
+
+
+def tree_names(tree: ast.Module) -> CellNames:
+    """The names used by the parsed cell, for callers that already parsed it."""
+    cell = _Scanner()
+    reads: Set[str] = set()
+    # names bound by statements that always run
+    bound: Set[str] = set()
+    # names whose last use in the cell is a del
+    deletes: Set[str] = set()
+    call_reads: Dict[str, FrozenSet[str]] = {}
+    for statement in tree.body:
+        scanner = _Scanner()
+        scanner.scan(statement)
+        # names are used in statement order, so x = 1; x doesn't read an older x, and
+        # x = []; x.append(1) doesn't change one
+        reads |= scanner.loads - bound
+        cell.mutates |= scanner.mutates - bound
+        cell.calls_on |= scanner.calls_on - bound
+        if isinstance(statement, _MAYBE_RUNS):
+            # the old value is kept if the binding doesn't run
+            cell.mutates |= scanner.stores - bound
+        else:
+            deletes = (deletes - scanner.stores) | scanner.deletes
+            bound = (bound | scanner.stores) - deletes
+        for name in scanner.stores:
+            if scanner.call_reads:
+                call_reads[name] = frozenset(scanner.call_reads)
+            else:
+                call_reads.pop(name, None)
+        cell.stores |= scanner.stores
+        cell.imports |= scanner.imports
+        cell.calls |= scanner.calls
+        cell.opaque |= scanner.opaque
+    return CellNames(
+        stores=frozenset(cell.stores),
+        mutates=frozenset(cell.mutates),
+        reads=frozenset(reads),
+        deletes=frozenset(deletes),
+        imports=frozenset(cell.imports),
+        calls=frozenset(cell.calls),
+        calls_on=frozenset(cell.calls_on),
+        opaque=cell.opaque,
+        call_reads=call_reads,
+    )
+
+
+@dataclass
+class ReplayCell:
+    # the depth of the node in the history
+    depth: int
+    code: str
+    defines: List[str]
+    # how long the cell took when it ran. None if it wasn't timed
+    seconds: Optional[float]
+
+    def title(self) -> str:
+        return f"[{self.depth}] {_first_line(self.code)}"
+
+
+def _exec_seconds(node: "HistoryNode") -> Optional[float]:
+    if not node.spans:
+        return None
+    durations = [s.duration for s in node.spans if s.name == "exec"]
+    return sum(durations) if durations else None
+
+
+def _total(cells: List[ReplayCell]) -> float:
+    return sum(c.seconds or 0.0 for c in cells)
+
+
+def _first_line(code: str, width: int = 60) -> str:
+    lines = code.strip().splitlines() or [""]
+    line = lines[0] + (" ..." if len(lines) > 1 else "")
+    return line if len(line) <= width else line[: width - 3] + "..."
+
+
+@dataclass
+class ReplayPlan:
+    """The cells to run again, in order, and the estimated time it takes."""
+
+    cells: List[ReplayCell] = field(default_factory=list)
+    skipped: List[ReplayCell] = field(default_factory=list)
+    targets: List[str] = field(default_factory=list)
+    # targets that no cell of the lineage defines
+    missing: List[str] = field(default_factory=list)
+
+    @property
+    def seconds(self) -> float:
+        """The estimated time, from how long the cells took when they ran."""
+        return _total(self.cells)
+
+    @property
+    def untimed(self) -> int:
+        """How many of the cells have no time, e.g. from a resumed session."""
+        return sum(c.seconds is None for c in self.cells)
+
+    def __repr__(self) -> str:
+        lines = [
+            f"Replay {len(self.cells)} of {len(self.cells) + len(self.skipped)} cells, "
+            f"about {self.seconds:.1f}s"
+            + (f" ({self.untimed} not timed)" if self.untimed else "")
+        ]
+        for c in self.cells:
+            seconds = "?" if c.seconds is None else f"{c.seconds:.1f}s"
+            defines = ", ".join(c.defines)
+            lines.append(
+                f"  {seconds:>7}  {c.title()}" + (f"  -> {defines}" if defines else "")
+            )
+        if self.skipped:
+            lines.append(f"Skip {len(self.skipped)} cells, {_total(self.skipped):.1f}s")
+        if self.missing:
+            lines.append(f"Not defined in the lineage: {', '.join(self.missing)}")
+        return "\n".join(lines)
+
+
+def plan_replay(
+    lineage: List["HistoryNode"],
+    targets: Optional[Iterable[str]] = None,
+    commands: Iterable[str] = (),
+) -> ReplayPlan:
+    """
+    Pick the cells of the lineage that are needed to define the targets again.
+
+    targets: the names to rebuild. All the names the lineage leaves defined if None.
+
+    commands: functions that act on pai instead of the namespace, e.g. pai and reset.
+    Cells that call them are never run again.
+    """
+    from pai.history import HistoryNode
+
+    commands = set(commands)
+    nodes: List[HistoryNode] = []
+    names: List[CellNames] = []
+    for node in lineage:
+        data = node.data
+        if not isinstance(data, (HistoryNode.UserCode, HistoryNode.LLMCode)):
+            continue
+        cell = cell_names(data.code)
+        if cell is None or cell.calls & commands:
+            continue
+        nodes.append(node)
+        names.append(cell)
+
+    # the newest cell that defines each name
+    last_def: Dict[str, int] = {}
+    # the globals read by the functions of the lineage when they are called
+    call_reads: Dict[str, FrozenSet[str]] = {}
+    modules: Set[str] = set()
+    deps: List[Set[int]] = []
+    defines: List[Set[str]] = []
+    for i, cell in enumerate(names):
+        # a name that is only bound doesn't need the cells that defined it before
+        mutated = cell.mutates | (cell.calls_on - modules)
+        changed = cell.stores | mutated
+        # a function the cell uses reads its globals now. so do the functions it uses
+        functions = {**call_reads, **cell.call_reads}
+        used = set(cell.reads | cell.calls | (mutated - cell.deletes))
+        pending = [n for n in used if n in functions]
+        while pending:
+            for n in functions[pending.pop()] - used:
+                used.add(n)
+                if n in functions:
+                    pending.append(n)
+        deps.append({last_def[n] for n in used if n in last_def})
+        for name in cell.deletes:
+            last_def.pop(name, None)
+        for name in changed - cell.deletes:
+            last_def[name] = i
+        for name in cell.stores:
+            if name in cell.call_reads:
+                call_reads[name] = cell.call_reads[name]
+            elif name not in cell.mutates:
+                call_reads.pop(name, None)
+        modules = (modules - cell.stores) | cell.imports
+        defines.append(changed - cell.deletes)
+
+    wanted = sorted(set(targets) if targets else set(last_def))
+    needed: Set[int] = set()
+    stack = [last_def[n] for n in wanted if n in last_def]
+    stack += [i for i, cell in enumerate(names) if cell.opaque]
+    while stack:
+        i = stack.pop()
+        if i not in needed:
+            needed.add(i)
+            stack.extend(deps[i])
+
+    plan = ReplayPlan(targets=wanted, missing=[n for n in wanted if n not in last_def])
+    for i, node in enumerate(nodes):
+        cell = ReplayCell(
+            depth=node.depth,
+            code=node.data.code,  # type: ignore
+            defines=sorted(defines[i]),
+            seconds=_exec_seconds(node),
+        )
+        (plan.cells if i in needed else plan.skipped).append(cell)
+    return plan
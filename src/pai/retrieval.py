@@ -0,0 +1,143 @@
+"""
+Find the nodes of the history that are relevant to a prompt.
+
+The llm context is the newest part of the lineage of the cursor. Cells from other
+branches, or from so long ago that they don't fit, are left out even when they are what
+the prompt is about. BM25Index ranks every node of the tree against the prompt. It is
+updated as nodes are added and needs no network or embedding model.
+"""
+import heapq
+import math
+import re
+from typing import Dict, Iterable, List
+
+from pai.history import HistoryNode
+
+_WORD_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+# too common in code and prompts to tell nodes apart
+_STOPWORDS = frozenset(
+    "a an and are as at be by def else for from if import in is it none not of on or "
+    "print return self the this to true false with".split()
+)
+# characters of a node that are indexed. results can be long
+MAX_INDEXED_CHARS = 20_000
+# characters of each result that are shown to the llm
+MAX_SHOWN_CHARS = 1_000
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words. snake_case names are also split into their parts."""
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        word = word.lower()
+        parts = [p for p in word.split("_") if p]
+        for token in [word, *parts] if len(parts) > 1 else [word]:
+            if len(token) > 1 and token not in _STOPWORDS:
+                tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """
+    An inverted index of the text of history nodes, ranked with Okapi BM25.
+
+    add() only queues the node. Nodes are tokenized on the next search, so adding
+    is cheap and nodes of a resumed session aren't loaded until they are needed.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.nodes: List[HistoryNode] = []
+        # term -> {node index: term frequency}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.lengths: List[int] = []
+        self.total_length = 0
+        self._pending: List[HistoryNode] = []
+
+    def add(self, node: HistoryNode):
+        self._pending.append(node)
+
+    def add_tree(self, root: HistoryNode):
+        """Add every node under the root, e.g. of a resumed session."""
+        stack = list(reversed(root.children))
+        while stack:
+            node = stack.pop()
+            self.add(node)
+            stack.extend(reversed(node.children))
+
+    def _index_pending(self):
+        for node in self._pending:
+            if isinstance(node.data, (HistoryNode.Root, HistoryNode.LLMError)):
+                continue
+            doc = len(self.nodes)
+            self.nodes.append(node)
+            tokens = tokenize(node.text()[:MAX_INDEXED_CHARS])
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                self.postings.setdefault(token, {})[doc] = count
+            self.lengths.append(len(tokens))
+            self.total_length += len(tokens)
+        self._pending = []
+
+    def search(
+        self, query: str, k: int, exclude: Iterable[HistoryNode] = ()
+    ) -> List[HistoryNode]:
+        """The k nodes that match the query best, best first. Nodes in exclude are skipped."""
+        self._index_pending()
+        terms = set(tokenize(query))
+        if not terms or not self.nodes or k <= 0:
+            return []
+
+        n = len(self.nodes)
+        average = self.total_length / n or 1
+        scores: Dict[int, float] = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, tf in postings.items():
+                norm = 1 - self.b + self.b * self.lengths[doc] / average
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (
+                    tf + self.k1 * norm
+                )
+
+        excluded = {id(node) for node in exclude}
+        candidates = (
+            (score, doc)
+            for doc, score in scores.items()
+            if id(self.nodes[doc]) not in excluded
+        )
+        return [self.nodes[doc] for _, doc in heapq.nlargest(k, candidates)]
+
+
+def _shown(text: str) -> str:
+    if len(text) <= MAX_SHOWN_CHARS:
+        return text
+    return text[:MAX_SHOWN_CHARS] + "\n..."
+
+
+def context_node(nodes: List[HistoryNode]) -> HistoryNode:
+    """
+    A node with the text of the retrieved nodes for the llm context.
+
+    It isn't added to the tree. It is rendered as user code, so every llm can show it.
+    """
+    parts = []
+    for node in nodes:
+        data = node.data
+        if isinstance(data, HistoryNode.UserCode):
+            parts.append(f">>> {data.code}\n{_shown(data.result)}")
+        elif isinstance(data, HistoryNode.LLMCode):
+            parts.append(f"# {data.prompt}\n>>> {data.code}\n{_shown(data.result)}")
+        elif isinstance(data, HistoryNode.LLMMessage):
+            parts.append(f"# {data.prompt}\n{_shown(data.message)}")
+    return HistoryNode(
+        HistoryNode.UserCode(
+            code="# earlier cells that look relevant. their variables may not exist now",
+            result="\n".join(parts),
+        )
+    )
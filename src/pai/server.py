@@ -0,0 +1,502 @@
+"""
+Serve many console sessions over a local HTTP API.
+
+Each session is an AsyncPaiConsole. Its code runs in its own kernel process by default,
+so a session running heavy code doesn't stall the others. Requests that run code or
+call the llm stream the console events back as JSON lines until the console waits for
+input again:
+
+    POST   /sessions                    create a session -> {"id": ...}
+    GET    /sessions                    list the sessions
+    DELETE /sessions/<id>               close a session
+    POST   /sessions/<id>/exec          {"code": ...} -> events
+    POST   /sessions/<id>/gen           {"prompt": ..., "agent": false, "candidates": 1} -> events
+    POST   /sessions/<id>/approve       {"candidate": 0, "code": optional edited code} -> events
+    POST   /sessions/<id>/interrupt     stop the running code
+    GET    /sessions/<id>/history       the history as used for llm context
+    GET    /sessions/<id>/stats         latencies and token counts of the session
+
+Every request needs an "Authorization: Bearer <token>" header, since a session runs
+any code it is sent. A session handles one request at a time. Sessions that are idle
+for longer than the idle timeout are closed. The number of llm calls in flight across
+all sessions is capped.
+"""
+import asyncio
+import inspect
+import json
+import os
+import re
+import secrets
+import time
+import uuid
+from dataclasses import asdict, is_dataclass, replace
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from pai.console import (
+    DEFAULT_INITIAL_CODE_BLOCKS,
+    AsyncPaiConsole,
+    ConsoleEvent,
+    LLMCode,
+    UserCode,
+    WaitingForInput,
+    WaitingForInputApproval,
+)
+from pai.history import HistoryNode
+from pai.llms.llm_protocol import (
+    LLM,
+    AsyncLLM,
+    AsyncLLMWrapper,
+    LLMResponse,
+    LLMStreamChunk,
+)
+
+if TYPE_CHECKING:
+    from pai.kernel import KernelConfig
+
+DEFAULT_PORT = 8765
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+# the largest request body that is read
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+def _int_field(body: Dict[str, Any], name: str, default: int) -> int:
+    value = body.get(name, default)
+    # bool is an int too
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise HTTPError(400, f"{name} must be an integer")
+    return value
+
+
+def _bool_field(body: Dict[str, Any], name: str, default: bool) -> bool:
+    value = body.get(name, default)
+    if not isinstance(value, bool):
+        raise HTTPError(400, f"{name} must be true or false")
+    return value
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _LimitedLLM(AsyncLLM):
+    """Shares an llm between sessions and caps the number of calls in flight."""
+
+    def __init__(self, llm: AsyncLLM, semaphore: asyncio.Semaphore):
+        self.llm = llm
+        self.semaphore = semaphore
+
+    def agent_support(self) -> bool:
+        return self.llm.agent_support()
+
+    def parallel_support(self) -> bool:
+        return self.llm.parallel_support()
+
+    def count_tokens(self, text: str) -> int:
+        return self.llm.count_tokens(text)
+
+    def count_prompt_tokens(self, rendered: Any) -> int:
+        return self.llm.count_prompt_tokens(rendered)
+
+    def invalidate_cache(self) -> None:
+        self.llm.invalidate_cache()
+
+    def prompt(self, history: List[HistoryNode], prompt: str) -> Any:
+        return self.llm.prompt(history, prompt)
+
+    def description(self) -> str:
+        return self.llm.description()
+
+    async def call(
+        self, history: List[HistoryNode], prompt: str
+    ) -> AsyncGenerator[Union[LLMStreamChunk, LLMResponse], None]:
+        async with self.semaphore:
+            items = self.llm.call(history, prompt)
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                await items.aclose()
+
+
+def event_to_json(event: Union[ConsoleEvent, LLMStreamChunk]) -> Dict[str, Any]:
+    """The event as a JSON object. Its name says what kind of event it is."""
+    if isinstance(event, LLMStreamChunk):
+        return {"name": "llm-stream-chunk", "text": event.text}
+    assert is_dataclass(event)
+    return asdict(event)
+
+
+class Session:
+    def __init__(self, id: str, console: AsyncPaiConsole):
+        self.id = id
+        self.console = console
+        self.created = time.time()
+        self.last_used = time.monotonic()
+        # the code waiting to be approved
+        self.approval: Optional[WaitingForInputApproval] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "created": self.created,
+            "idle_seconds": time.monotonic() - self.last_used,
+            "busy": self.busy,
+            "waiting_for_approval": self.approval is not None,
+            "history_length": self.console.history_tree.cursor.depth,
+        }
+
+
+class PaiServer:
+    def __init__(
+        self,
+        llm: Union[LLM, AsyncLLM],
+        token: str,
+        kernel: Optional["KernelConfig"] = None,
+        llm_context_tokens: Optional[int] = None,
+        summarize_after: Optional[int] = None,
+        namespace_digest: bool = False,
+        max_llm_calls: int = 4,
+        max_sessions: int = 32,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        """
+        llm: shared by the sessions. An llm that can't run several calls at once,
+        like llama.cpp, gets one call at a time
+
+        token: the bearer token that every request needs
+
+        kernel: run the code of each session in its own worker process with these limits
+        """
+        # a sync llm is called on the default executor
+        if not inspect.isasyncgenfunction(llm.call):
+            llm = AsyncLLMWrapper(llm)  # type: ignore
+        self.llm: AsyncLLM = llm  # type: ignore
+        self.token = token
+        self.kernel = kernel
+        self.llm_context_tokens = llm_context_tokens
+        self.summarize_after = summarize_after
+        self.namespace_digest = namespace_digest
+        self.max_llm_calls = max_llm_calls if self.llm.parallel_support() else 1
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions: Dict[str, Session] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._routes: List[Tuple[str, "re.Pattern[str]", Any]] = [
+            ("POST", re.compile(r"/sessions"), self._create),
+            ("GET", re.compile(r"/sessions"), self._list),
+            ("DELETE", re.compile(r"/sessions/([\w-]+)"), self._delete),
+            ("POST", re.compile(r"/sessions/([\w-]+)/exec"), self._exec),
+            ("POST", re.compile(r"/sessions/([\w-]+)/gen"), self._gen),
+            ("POST", re.compile(r"/sessions/([\w-]+)/approve"), self._approve),
+            ("POST", re.compile(r"/sessions/([\w-]+)/interrupt"), self._interrupt),
+            ("GET", re.compile(r"/sessions/([\w-]+)/history"), self._history),
+            ("GET", re.compile(r"/sessions/([\w-]+)/stats"), self._stats),
+        ]
+
+    async def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+        unix_path: Optional[str] = None,
+    ):
+        """Serve until cancelled. With unix_path, listen on a Unix socket instead of TCP."""
+        # the semaphore belongs to the running loop
+        self._semaphore = asyncio.Semaphore(self.max_llm_calls)
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle, path=unix_path)
+            # only the user running the server can connect
+            os.chmod(unix_path, 0o600)
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+        evictor = asyncio.ensure_future(self._evict_idle())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+            for session in list(self.sessions.values()):
+                await self._close(session)
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_timeout / 2))
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if not session.busy and now - session.last_used > self.idle_timeout:
+                    await self._close(session)
+
+    async def _close(self, session: Session):
+        self.sessions.pop(session.id, None)
+        # stopping a kernel waits for the worker process
+        await asyncio.get_running_loop().run_in_executor(None, session.console.close)
+
+    def _session(self, id: str) -> Session:
+        session = self.sessions.get(id)
+        if session is None:
+            raise HTTPError(404, f"No session {id}")
+        return session
+
+    # handlers return a JSON value or an async generator of events to stream
+
+    async def _create(self, body: Dict[str, Any]) -> Any:
+        if len(self.sessions) >= self.max_sessions:
+            raise HTTPError(503, f"There are already {self.max_sessions} sessions")
+        assert self._semaphore is not None
+        llm = _LimitedLLM(self.llm, self._semaphore)
+
+        def create() -> AsyncPaiConsole:
+            return AsyncPaiConsole(
+                llm,
+                llm_context_tokens=self.llm_context_tokens,
+                summarize_after=self.summarize_after,
+                namespace_digest=self.namespace_digest,
+                initial_code_blocks=DEFAULT_INITIAL_CODE_BLOCKS,
+                kernel=self.kernel,
+                init_in_background=True,
+            )
+
+        # starting a kernel blocks for a moment
+        console = await asyncio.get_running_loop().run_in_executor(None, create)
+        session = Session(uuid.uuid4().hex, console)
+        self.sessions[session.id] = session
+        return {"id": session.id}
+
+    async def _list(self, body: Dict[str, Any]) -> Any:
+        return [session.info() for session in self.sessions.values()]
+
+    async def _delete(self, body: Dict[str, Any], id: str) -> Any:
+        session = self._session(id)
+        session.console.interrupt()
+        await self._close(session)
+        return {"id": id}
+
+    async def _exec(self, body: Dict[str, Any], id: str) -> Any:
+        session = self._session(id)
+        code = body.get("code")
+        if not isinstance(code, str):
+            raise HTTPError(400, "code is required")
+        return await self._events(
+            session, session.console.streaming_exec(UserCode(code=code))
+        )
+
+    async def _gen(self, body: Dict[str, Any], id: str) -> Any:
+        session = self._session(id)
+        prompt = body.get("prompt")
+        if not isinstance(prompt, str):
+            raise HTTPError(400, "prompt is required")
+        agent = _bool_field(body, "agent", False)
+        candidates = _int_field(body, "candidates", 1)
+        if candidates < 1:
+            raise HTTPError(400, "candidates must be at least 1")
+        return await self._events(
+            session,
+            session.console.streaming_code_gen(
+                prompt, agent_mode=agent, candidates=candidates
+            ),
+        )
+
+    async def _approve(self, body: Dict[str, Any], id: str) -> Any:
+        session = self._session(id)
+        if session.approval is None:
+            raise HTTPError(409, "No code is waiting for approval")
+        candidates = session.approval.candidates or [session.approval.code]
+        index = _int_field(body, "candidate", 0)
+        if not 0 <= index < len(candidates):
+            raise HTTPError(400, f"There are {len(candidates)} candidates")
+        llm_code: LLMCode = candidates[index]
+        code = body.get("code")
+        if code is not None and not isinstance(code, str):
+            raise HTTPError(400, "code must be a string")
+        if code is not None:
+            llm_code = replace(llm_code, code=code)
+        return await self._events(session, session.console.streaming_exec(llm_code))
+
+    async def _interrupt(self, body: Dict[str, Any], id: str) -> Any:
+        return {"interrupted": self._session(id).console.interrupt()}
+
+    async def _history(self, body: Dict[str, Any], id: str) -> Any:
+        session = self._session(id)
+        return [node.to_dict() for node in session.console.history_tree.lineage()]
+
+    async def _stats(self, body: Dict[str, Any], id: str) -> Any:
+        stats = self._session(id).console.stats()
+        return {
+            "phases": stats.phases,
+            "prompt_tokens": stats.prompt_tokens,
+            "completion_tokens": stats.completion_tokens,
+            "time_to_first_token": stats.time_to_first_token,
+            "tokens_per_second": stats.tokens_per_second,
+        }
+
+    async def _events(
+        self, session: Session, events: AsyncGenerator[ConsoleEvent, None]
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Stream the events until the console waits for input."""
+        if session.busy:
+            await events.aclose()
+            raise HTTPError(409, "The session is handling another request")
+
+        async def stream():
+            async with session._lock:
+                session.approval = None
+                try:
+                    async for event in events:
+                        if isinstance(event, WaitingForInputApproval):
+                            session.approval = event
+                        yield event_to_json(event)
+                        if isinstance(
+                            event, (WaitingForInput, WaitingForInputApproval)
+                        ):
+                            break
+                finally:
+                    await events.aclose()
+                    session.last_used = time.monotonic()
+
+        return stream()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handle one request per connection."""
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+                result = await self._route(method, path, body)
+            except HTTPError as e:
+                await self._respond(writer, e.status, {"error": e.message})
+                return
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                # a bug in a handler. the client still gets a response
+                await self._respond(writer, 500, {"error": repr(e)})
+                return
+
+            if hasattr(result, "__aiter__"):
+                await self._stream(writer, result)
+            else:
+                await self._respond(writer, 200, result)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # the client went away. closing the stream stops the running code
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Tuple[str, str, Dict[str, Any]]:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HTTPError(400, "Bad request line")
+        method, path, _ = request_line
+
+        headers: Dict[str, str] = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if not secrets.compare_digest(
+            headers.get("authorization", ""), f"Bearer {self.token}"
+        ):
+            raise HTTPError(401, "A valid Authorization: Bearer <token> is required")
+
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+        except ValueError:
+            raise HTTPError(400, "Content-Length must be a number")
+        if length < 0:
+            raise HTTPError(400, "Content-Length must be a number")
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, "The body is too large")
+        body: Dict[str, Any] = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError as e:
+                # a JSONDecodeError, or a UnicodeDecodeError for bytes that aren't text
+                raise HTTPError(400, f"The body isn't JSON: {e}")
+            if not isinstance(body, dict):
+                raise HTTPError(400, "The body must be a JSON object")
+        return method, path.split("?", 1)[0].rstrip("/"), body
+
+    async def _route(self, method: str, path: str, body: Dict[str, Any]) -> Any:
+        allowed = False
+        for route_method, pattern, handler in self._routes:
+            m = pattern.fullmatch(path)
+            if m is None:
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            return await handler(body, *m.groups())
+        if allowed:
+            raise HTTPError(405, f"{method} is not allowed on {path}")
+        raise HTTPError(404, f"Nothing at {path}")
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, value: Any):
+        data = json.dumps(value, default=str).encode("utf-8") + b"\n"
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        await writer.drain()
+
+    async def _stream(
+        self,
+        writer: asyncio.StreamWriter,
+        events: AsyncGenerator[Dict[str, Any], None],
+    ):
+        """Send each event as a JSON line in its own chunk, as soon as it happens."""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        try:
+            async for event in events:
+                data = json.dumps(event, default=str).encode("utf-8") + b"\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                await writer.drain()
+        except Exception as e:
+            if isinstance(e, ConnectionError):
+                raise
+            # the status was already sent. the error is the last event
+            data = json.dumps({"name": "error", "error": repr(e)}).encode() + b"\n"
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        finally:
+            await events.aclose()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
@@ -0,0 +1,148 @@
+"""
+Store the history on disk as it grows so that a session can be resumed.
+
+The history is appended to a SQLite database in WAL mode. Every node and every cursor
+move is a new row, nothing is updated. A file can hold several trees, e.g. one for each
+reset(). Resuming loads the newest tree.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from dataclasses import fields, replace
+from typing import Dict, Optional
+
+from pai.history import HistoryNode, HistoryTree
+
+DEFAULT_SESSION_PATH = os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"),
+    "pai",
+    "session.sqlite3",
+)
+
+
+def _dump(data: HistoryNode.Data) -> bytes:
+    names = {f.name for f in fields(data)}
+    if "spilled_output" in names:
+        # the spill file is deleted when this process exits
+        data = replace(data, spilled_output=None)  # type: ignore
+    try:
+        return pickle.dumps(data)
+    except Exception:
+        if "raw_resp" not in names:
+            raise
+        # the raw response can be something like an open stream
+        return pickle.dumps(replace(data, raw_resp=None))  # type: ignore
+
+
+class SessionStore:
+    """
+    Appends history trees to a SQLite database.
+
+    Loading a tree only reads its structure. The data of each node is read the first
+    time it is used, so resuming a long session is fast.
+    """
+
+    def __init__(self, path: str = DEFAULT_SESSION_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # a commit is durable once it is in the log. the log is synced at checkpoints
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS nodes (
+                id INTEGER PRIMARY KEY,
+                -- null for the root of a tree
+                root INTEGER,
+                parent INTEGER,
+                data BLOB NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS nodes_root ON nodes (root);
+            CREATE TABLE IF NOT EXISTS cursor (
+                id INTEGER PRIMARY KEY,
+                root INTEGER NOT NULL,
+                node INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cursor_root ON cursor (root);
+            """
+        )
+        self._db.commit()
+
+    def new_tree(self) -> HistoryTree:
+        """Start a new tree that is stored as it grows."""
+        return HistoryTree(store=self)
+
+    def resume(self) -> Optional[HistoryTree]:
+        """Load the newest tree. Returns None if there isn't one."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id FROM nodes WHERE parent IS NULL ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            root_id = row[0]
+            rows = self._db.execute(
+                "SELECT id, parent FROM nodes WHERE root = ? ORDER BY id", (root_id,)
+            ).fetchall()
+            cursor = self._db.execute(
+                "SELECT node FROM cursor WHERE root = ? ORDER BY id DESC LIMIT 1",
+                (root_id,),
+            ).fetchone()
+
+        nodes: Dict[int, HistoryNode] = {}
+        root = HistoryNode(HistoryNode.Root())
+        root.id = root_id
+        nodes[root_id] = root
+        for node_id, parent_id in rows:
+            node = HistoryNode(None, load=lambda node_id=node_id: self.load(node_id))
+            node.id = node_id
+            nodes[parent_id].add_child(node)
+            nodes[node_id] = node
+
+        tree = HistoryTree(store=self, root=root)
+        if cursor is not None:
+            tree.cursor = nodes[cursor[0]]
+        return tree
+
+    def load(self, node_id: int) -> HistoryNode.Data:
+        """Read the data of a node."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM nodes WHERE id = ?", (node_id,)
+            ).fetchone()
+        return pickle.loads(row[0])
+
+    def add_node(self, root: HistoryNode, node: HistoryNode):
+        """Append a node to the tree of root. The cursor moves to the new node."""
+        with self._lock:
+            with self._db:
+                node.id = self._db.execute(
+                    "INSERT INTO nodes (root, parent, data, created) VALUES (?, ?, ?, ?)",
+                    (
+                        root.id,
+                        node.parent.id if node.parent is not None else None,
+                        _dump(node.data),
+                        time.time(),
+                    ),
+                ).lastrowid
+                self._db.execute(
+                    "INSERT INTO cursor (root, node) VALUES (?, ?)", (root.id, node.id)
+                )
+
+    def move_cursor(self, root: HistoryNode, node: HistoryNode):
+        """Record that the cursor of the tree of root moved to node."""
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO cursor (root, node) VALUES (?, ?)", (root.id, node.id)
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
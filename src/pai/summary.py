@@ -0,0 +1,73 @@
+"""
+Replace the oldest part of a long lineage with a summary written by the llm.
+
+Once the lineage is longer than `after` nodes, the nodes up to a cut are sent as a
+summary. Cuts are at depths that are multiples of after // 2, so the lineage that is
+sent stays between after // 2 and after nodes and the cut only moves every after // 2
+nodes. The summary of a cut is cached on the node at the cut. It is written from the
+summary of the cut before it and the nodes since, so each one is made once and every
+later call, and every branch through the node, reuses it.
+"""
+from typing import List, Optional
+
+from pai.history import HistoryNode
+from pai.llms.llm_protocol import LLMResponse, LLMResponseCode, LLMResponseMessage
+
+SUMMARY_PROMPT = (
+    "Summarize the session so far for yourself. Answer with a message, not code. "
+    "Keep what later steps need: the variables, functions and files that exist and "
+    "what they hold, facts that were found, what failed and the decisions made. "
+    "Be brief."
+)
+
+
+def _step(after: int) -> int:
+    return max(1, after // 2)
+
+
+def summary_ancestor(cursor: HistoryNode, after: int) -> Optional[HistoryNode]:
+    """The node at the cut for the lineage of the cursor. None if it is short enough."""
+    if cursor.depth <= after:
+        return None
+    step = _step(after)
+    depth = (cursor.depth - step) // step * step
+    node = cursor
+    while node.depth > depth:
+        node = node.parent  # type: ignore
+    return node
+
+
+def pending_summaries(cut: HistoryNode, after: int) -> List[List[HistoryNode]]:
+    """
+    The nodes each missing summary up to the cut is written from, oldest first. Each
+    list starts at the node after the previous cut and ends at the node that gets the
+    summary.
+    """
+    path = []
+    node = cut
+    while node.parent is not None and node.summary is None:
+        path.append(node)
+        node = node.parent
+    path.reverse()
+
+    step = _step(after)
+    chunks = []
+    chunk: List[HistoryNode] = []
+    for node in path:
+        chunk.append(node)
+        if node.depth % step == 0 or node is cut:
+            chunks.append(chunk)
+            chunk = []
+    return chunks
+
+
+def summary_text(resp: Optional[LLMResponse]) -> Optional[str]:
+    """The summary in the response. None if the llm answered with code only or failed."""
+    if isinstance(resp, (LLMResponseMessage, LLMResponseCode)) and resp.message:
+        return resp.message.strip() or None
+    return None
+
+
+def summary_node(text: str, nodes: int) -> HistoryNode:
+    """A node for the summary of the first nodes of a lineage. It isn't added to the tree."""
+    return HistoryNode(HistoryNode.Summary(summary=text, nodes=nodes))
@@ -0,0 +1,217 @@
+"""
+Time the phases of each turn.
+
+A turn is the work that adds a node to the history: building the prompt, calling the
+llm, waiting for the user to approve the code and running it. Each phase is a Span.
+The spans of a turn are attached to the node it adds. They can also be written to a
+trace file, either as JSON lines or as Chrome trace events that chrome://tracing and
+Perfetto can open.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+if TYPE_CHECKING:
+    from pai.history import HistoryNode
+
+
+# the phases of a turn in the order they happen
+PHASES = ("summarize", "prompt", "llm", "approval", "exec")
+
+
+@dataclass
+class Span:
+    __slots__ = ("name", "start", "duration", "attrs")
+    # one of PHASES
+    name: str
+    # seconds since the epoch
+    start: float
+    duration: float
+    # e.g. token counts of an llm call
+    attrs: Dict[str, Any]
+
+
+class TraceFile:
+    """
+    Writes spans to a file as they are recorded.
+
+    Files ending in .json get Chrome trace events. Other files get one JSON object
+    per line.
+    """
+
+    def __init__(self, path: str, format: Optional[str] = None):
+        self.path = path
+        self.format = format or ("chrome" if path.endswith(".json") else "jsonl")
+        if self.format not in ("chrome", "jsonl"):
+            raise ValueError(f"Unknown trace format: {self.format}")
+        self._file: Optional[TextIO] = open(path, "w")
+        self._first = True
+        if self.format == "chrome":
+            # the closing bracket is optional, so a trace is readable if pai crashes
+            self._file.write("[\n")
+
+    def write(self, span: Span, node: Dict[str, Any]):
+        if self._file is None:
+            return
+        if self.format == "chrome":
+            event = {
+                "name": span.name,
+                "cat": "pai",
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": {**span.attrs, **node},
+            }
+            self._file.write(("" if self._first else ",\n") + json.dumps(event))
+        else:
+            record = {
+                "name": span.name,
+                "start": span.start,
+                "duration": span.duration,
+                **node,
+                **span.attrs,
+            }
+            self._file.write(json.dumps(record) + "\n")
+        self._first = False
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        if self.format == "chrome":
+            self._file.write("\n]\n")
+        self._file.close()
+        self._file = None
+
+
+class Telemetry:
+    """
+    Records the spans of each turn and keeps them for stats().
+
+    One Telemetry can be shared by the consoles of a session, e.g. across reset().
+    """
+
+    def __init__(self, trace: Optional[TraceFile] = None):
+        self.trace = trace
+        # every span of the session
+        self.spans: List[Span] = []
+        # the spans of the turn that hasn't added its node yet
+        self._pending: List[Span] = []
+        # spans started with start() that haven't ended
+        self._started: Dict[str, Tuple[float, float]] = {}
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+        """Time the block. Attributes can be added to the yielded dict."""
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.add(Span(name, start, time.perf_counter() - t0, attrs))
+
+    def start(self, name: str):
+        """Start a span that ends in another call, e.g. after the user approves code."""
+        self._started[name] = (time.time(), time.perf_counter())
+
+    def end(self, name: str, **attrs: Any):
+        """End a span started with start(). Does nothing if it wasn't started."""
+        started = self._started.pop(name, None)
+        if started is not None:
+            self.add(Span(name, started[0], time.perf_counter() - started[1], attrs))
+
+    def add(self, span: Span):
+        self.spans.append(span)
+        self._pending.append(span)
+
+    def begin_turn(self):
+        """Start a new turn. Spans of a turn that didn't add a node are written without one."""
+        self._write(self._pending, {})
+        self._pending = []
+        self._started = {}
+
+    def attach(self, node: "HistoryNode"):
+        """Attach the spans of the turn to the node it added."""
+        node.spans = self._pending
+        self._write(
+            self._pending,
+            {"node": node.depth, "kind": type(node.data).__name__},
+        )
+        self._pending = []
+
+    def _write(self, spans: List[Span], node: Dict[str, Any]):
+        if self.trace is not None:
+            for span in spans:
+                self.trace.write(span, node)
+
+    def stats(self) -> "Stats":
+        return Stats(self.spans)
+
+    def close(self):
+        self.begin_turn()
+        if self.trace is not None:
+            self.trace.close()
+
+
+def _mean(values: List[float]) -> Optional[float]:
+    return sum(values) / len(values) if values else None
+
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class Stats:
+    """Latencies of each phase and token counts. Shown as a table."""
+
+    def __init__(self, spans: List[Span]):
+        self.phases: Dict[str, Dict[str, float]] = {}
+        names = list(dict.fromkeys([*PHASES, *(span.name for span in spans)]))
+        for name in names:
+            durations = [s.duration for s in spans if s.name == name]
+            if not durations:
+                continue
+            self.phases[name] = {
+                "count": len(durations),
+                "total": sum(durations),
+                "mean": sum(durations) / len(durations),
+                "p50": _percentile(durations, 0.5),
+                "p95": _percentile(durations, 0.95),
+                "max": max(durations),
+            }
+
+        calls = [s.attrs for s in spans if s.name == "llm"]
+        self.prompt_tokens = sum(a.get("prompt_tokens", 0) for a in calls)
+        self.completion_tokens = sum(a.get("completion_tokens", 0) for a in calls)
+        first_token = [
+            a["time_to_first_token"] for a in calls if "time_to_first_token" in a
+        ]
+        rates = [a["tokens_per_second"] for a in calls if "tokens_per_second" in a]
+        self.time_to_first_token = _mean(first_token)
+        self.tokens_per_second = _mean(rates)
+
+    def __repr__(self) -> str:
+        if not self.phases:
+            return "No turns yet."
+        lines = [
+            f"{'phase':<10}{'count':>7}{'total':>10}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}"
+        ]
+        for name, p in self.phases.items():
+            lines.append(
+                f"{name:<10}{p['count']:>7}{p['total']:>9.2f}s{p['mean']:>9.3f}s"
+                f"{p['p50']:>9.3f}s{p['p95']:>9.3f}s{p['max']:>9.3f}s"
+            )
+        lines.append(
+            f"tokens: {self.prompt_tokens} prompt, {self.completion_tokens} completion"
+        )
+        if self.time_to_first_token is not None:
+            lines.append(f"time to first token: {self.time_to_first_token:.3f}s mean")
+        if self.tokens_per_second is not None:
+            lines.append(f"tokens per second: {self.tokens_per_second:.1f} mean")
+        return "\n".join(lines)
@@ -0,0 +1,50 @@
+import io
+import json
+from typing import Any, Generator, List
+
+from pai.batch import run_batch
+from pai.history import HistoryNode
+from pai.llms.llm_protocol import (
+    LLM,
+    LLMResponse,
+    LLMResponseCode,
+    LLMResponseMessage,
+    LLMStreamChunk,
+)
+
+
+class ScriptedLLM(LLM):
+    """Runs the prompt as code, then answers with a message."""
+
+    def prompt(self, history: List[HistoryNode], prompt: str) -> Any:
+        return prompt
+
+    def description(self) -> str:
+        return "ScriptedLLM"
+
+    def call(
+        self, history: List[HistoryNode], prompt: str
+    ) -> Generator[LLMStreamChunk, None, LLMResponse]:
+        yield from ()
+        if prompt:
+            return LLMResponseCode(prompt=prompt, message=None, code=prompt, raw=None)
+        return LLMResponseMessage(prompt=prompt, message="done", raw=None)
+
+
+def make_llm() -> LLM:
+    return ScriptedLLM()
+
+
+def test_a_crashing_task_fails_alone():
+    tasks = [{"id": str(i), "prompt": f"x = {i}"} for i in range(6)]
+    tasks[2]["prompt"] = "import os\nos._exit(1)"
+    output = io.StringIO()
+
+    run_batch(tasks, output, make_llm, workers=3)
+
+    records = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+    assert sorted(records) == [str(i) for i in range(6)]
+    assert records["2"]["status"] == "failed"
+    for i in (0, 1, 3, 4, 5):
+        assert records[str(i)]["status"] == "done"
+        assert records[str(i)]["steps"] == 1
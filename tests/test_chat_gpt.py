@@ -0,0 +1,37 @@
+import json
+
+from pai.console import PaiConsole
+from pai.llms.chat_gpt import ChatGPT
+
+
+def fake_create(**kwargs):
+    arguments = json.dumps({"code": "x = 1"})
+    for delta, finish_reason in [
+        ({"function_call": {"name": "python", "arguments": arguments}}, None),
+        ({}, "function_call"),
+    ]:
+        yield {"choices": [{"delta": delta, "finish_reason": finish_reason}]}
+
+
+def test_a_turn_builds_the_prompt_once_and_counts_what_is_sent(monkeypatch):
+    import openai
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", fake_create)
+    llm = ChatGPT("gpt-4")
+    builds = []
+    prefix = llm._prefix
+    monkeypatch.setattr(
+        llm, "_prefix", lambda history: builds.append(1) or prefix(history)
+    )
+
+    console = PaiConsole(llm)
+    console.exec("y = 2")
+    list(console.streaming_code_gen("set x"))
+    console.close()
+
+    assert len(builds) == 1
+    (call,) = [s for s in console.telemetry.spans if s.name == "llm"]
+    messages = llm.prompt(console.get_history(), "set x")
+    assert call.attrs["prompt_tokens"] == llm.count_prompt_tokens(messages)
+    # the system prompt is sent too
+    assert call.attrs["prompt_tokens"] > llm.count_tokens(llm.sys_prompt)
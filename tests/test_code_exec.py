@@ -0,0 +1,77 @@
+import ast
+import threading
+
+from pai.code_exec import CodeExec
+from pai.console import PaiConsole, UserCode
+from pai.llms.fake import FakeLLM
+
+
+def test_output_of_threads_started_by_a_cell_is_captured():
+    code = (
+        "import threading\n"
+        "t = threading.Thread(target=lambda: print('from thread'))\n"
+        "t.start()\n"
+        "t.join()\n"
+        "print('main')"
+    )
+    assert CodeExec().custom_run_source(code) == "from thread\nmain\n"
+
+
+def test_output_of_executor_workers_is_captured():
+    code = (
+        "from concurrent.futures import ThreadPoolExecutor\n"
+        "with ThreadPoolExecutor(2) as pool:\n"
+        "    pool.submit(print, 'from worker').result()"
+    )
+    assert CodeExec().custom_run_source(code) == "from worker\n"
+
+
+def test_a_pool_from_an_earlier_cell_writes_to_the_running_cell():
+    executor = CodeExec()
+    start = threading.Thread.start
+    executor.custom_run_source(
+        "from concurrent.futures import ThreadPoolExecutor\n"
+        "pool = ThreadPoolExecutor(1)\n"
+        "pool.submit(print, 'first').result()"
+    )
+    result = executor.custom_run_source("pool.submit(print, 'second').result()")
+    assert result == "second\n"
+    assert threading.Thread.start is start
+    executor.custom_run_source("pool.shutdown()")
+
+
+def test_console_cells_run_on_the_calling_thread_and_stream_their_output():
+    shown = []
+    console = PaiConsole(FakeLLM(), on_output=shown.append)
+    code = (
+        "import signal, threading\n"
+        "previous = signal.signal(signal.SIGTERM, signal.SIG_DFL)\n"
+        "signal.signal(signal.SIGTERM, previous)\n"
+        "print(threading.current_thread() is threading.main_thread())"
+    )
+    events = list(console.streaming_exec(UserCode(code)))
+    assert events[0].value == "True\n"
+    assert "".join(shown) == "True\n"
+    console.close()
+
+
+def test_jobs_share_the_namespace_and_keep_their_own_output():
+    executor = CodeExec(background_jobs=True)
+    executor.custom_run_source("import threading\ngo = threading.Event()")
+    job = executor.start_job("go.wait(5)\nprint('job')\nfound = 1\n1 / 0")
+    assert executor.custom_run_source("go.set()\nprint('main')\n2") == "main\n2\n"
+    assert job.done.wait(5)
+    assert job.result.startswith("job\nTraceback")
+    assert "ZeroDivisionError" in job.result
+    assert executor.custom_run_source("found") == "1\n"
+
+
+def test_a_cell_is_parsed_once(monkeypatch):
+    parses = []
+    parse = ast.parse
+    monkeypatch.setattr(ast, "parse", lambda *args: parses.append(1) or parse(*args))
+    executor = CodeExec()
+    executor.namespace_digest()
+    assert executor.custom_run_source("parsed_once = [1]\nparsed_once") == "[1]\n"
+    assert "parsed_once: list len=1 [1]" in executor.namespace_digest()
+    assert len(parses) == 1
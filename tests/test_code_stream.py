@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from pai.llms.chat_gpt import _ResponseStream
+from pai.llms.code_stream import SyntaxCheck
+
+
+def feed_lines(code):
+    check = SyntaxCheck()
+    return [check.feed(line) for line in code.splitlines(keepends=True)]
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "total = 1 + \\\n    2\n",
+        "with open('a') as a, \\\n     open('b') as b:\n    pass\n",
+        "assert x, \\\n    'message'\n",
+        "x = 1\nif x \\\n   and y:\n    pass\n",
+    ],
+)
+def test_a_backslash_continuation_is_not_an_error(code):
+    assert feed_lines(code) == [None] * len(code.splitlines())
+
+
+def test_a_syntax_error_is_found_on_its_line():
+    errors = feed_lines("x = 1\ndef f(:\n    pass\n")
+    assert errors[0] is None
+    assert errors[1] is not None and errors[1].lineno == 2
+
+
+def test_a_function_call_continued_by_a_backslash_streams_to_the_end():
+    code = "total = 1 + \\\n    2\nprint(total)\n"
+    arguments = json.dumps({"code": code})
+    stream = _ResponseStream()
+    for i in range(0, len(arguments), 5):
+        delta = {"function_call": {"arguments": arguments[i : i + 5]}}
+        stream.feed({"choices": [{"delta": delta, "finish_reason": None}]})
+    assert stream.syntax_error is None
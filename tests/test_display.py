@@ -0,0 +1,37 @@
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+
+from pai.display import MAX_DISPLAY_CHARS, safe_repr
+
+
+def test_a_large_counter_is_cut():
+    counts = Counter(range(1_000_000))
+    text, cut = safe_repr(counts)
+    assert cut
+    assert text.startswith("Counter({0: 1, 1: 1, ")
+    assert len(text) < MAX_DISPLAY_CHARS
+
+
+def test_subclasses_of_containers_keep_their_name():
+    values = defaultdict(list)
+    values["a"].append(1)
+    assert safe_repr(values) == ("defaultdict(<class 'list'>, {'a': [1]})", False)
+    # its repr changed in 3.12
+    assert safe_repr(OrderedDict(a=1)) == (repr(OrderedDict(a=1)), False)
+    assert safe_repr(namedtuple("Point", "x y")(1, 2)) == ("Point(x=1, y=2)", False)
+
+    class Items(list):
+        pass
+
+    text, cut = safe_repr(Items(range(1_000)))
+    assert cut and text.startswith("[0, 1, 2, ") and text.endswith(", ...]")
+
+
+def test_items_stop_once_the_limit_is_used_up():
+    for value in [
+        {i: "x" * 500 for i in range(30)},
+        ["x" * 100 for _ in range(1_000)],
+        {f"{i:0100}" for i in range(1_000)},
+    ]:
+        text, cut = safe_repr(value)
+        assert cut and text.count("...") == 1 and text[:-1].endswith(", ...")
+        assert len(text) < MAX_DISPLAY_CHARS + 600
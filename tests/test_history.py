@@ -0,0 +1,36 @@
+from pai.console import PaiConsole
+from pai.history import HistoryNode, HistoryTree
+from pai.llms.chat_gpt import ChatGPT
+
+
+def count_tokens(text):
+    return len(text.split())
+
+
+def test_the_newest_node_is_kept_with_its_result_cut_to_fit():
+    tree = HistoryTree()
+    tree.add_node(HistoryNode.UserCode(code="x = 1", result=""))
+    result = "start " + "line " * 1_000 + "end"
+    tree.add_node(HistoryNode.UserCode(code="print(x)", result=result))
+
+    (node,) = tree.lineage(max_tokens=100, count_tokens=count_tokens)
+    assert node.tokens(count_tokens) <= 100
+    assert node.data.code == "print(x)"
+    assert node.data.result.startswith("start line")
+    assert node.data.result.endswith("line end")
+    assert "(output cut)" in node.data.result
+
+
+def test_the_system_prompt_and_the_prompt_come_out_of_the_budget():
+    llm = ChatGPT("gpt-4")
+    console = PaiConsole(llm, llm_context_tokens=1_000)
+    for i in range(100):
+        console.exec(f"x_{i} = {i}")
+    prompt = "add up all the x_ variables " * 20
+
+    history = console.get_history(prompt)
+    fixed = llm.count_prompt_tokens(llm.prompt([], prompt))
+    assert fixed > 100
+    history_tokens = sum(node.tokens(llm.count_tokens) for node in history)
+    assert 0 < history_tokens <= 1_000 - fixed
+    console.close()
@@ -0,0 +1,21 @@
+from pai.console import Notice, PaiConsole, UserCode
+from pai.kernel import KernelConfig
+from pai.llms.fake import FakeLLM
+
+
+def notices(console, code):
+    return [e for e in console.streaming_exec(UserCode(code)) if isinstance(e, Notice)]
+
+
+def test_threads_that_stop_snapshots_are_reported_once():
+    console = PaiConsole(FakeLLM(chunk_delay=0), kernel=KernelConfig(snapshots=5))
+    pool = (
+        "from concurrent.futures import ThreadPoolExecutor\npool = ThreadPoolExecutor()"
+    )
+    (notice,) = notices(console, pool + "\npool.submit(int).result()")
+    assert "ThreadPoolExecutor-0_0" in notice.text
+    assert notices(console, "x = 1") == []
+
+    notices(console, "pool.shutdown()")
+    assert console.console.snapshot_skipped is None
+    console.close()
@@ -0,0 +1,104 @@
+from typing import List
+
+import pytest
+
+from pai.console import PaiConsole
+from pai.history import HistoryNode, HistoryTree
+from pai.llms.fake import FakeLLM
+from pai.replay import cell_names, plan_replay
+
+
+def lineage(*cells: str) -> List[HistoryNode]:
+    tree = HistoryTree()
+    for code in cells:
+        tree.add_node(HistoryNode.UserCode(code=code, result=""))
+    return tree.lineage()
+
+
+def replayed(plan) -> List[str]:
+    return [cell.code for cell in plan.cells]
+
+
+def test_rebinding_drops_the_old_definition():
+    plan = plan_replay(
+        lineage("data = slow_download()", "data = [1, 2, 3]", "total = sum(data)"),
+        ["total"],
+    )
+    assert replayed(plan) == ["data = [1, 2, 3]", "total = sum(data)"]
+    assert [cell.code for cell in plan.skipped] == ["data = slow_download()"]
+
+
+def test_rebinding_then_changing_in_one_cell_drops_the_old_definition():
+    plan = plan_replay(
+        lineage("data = slow_download()", "data = []\ndata.append(1)\ndata[0] = 2"),
+        ["data"],
+    )
+    assert replayed(plan) == ["data = []\ndata.append(1)\ndata[0] = 2"]
+
+
+def test_changing_needs_the_old_definition():
+    for change in ["data.append(4)", "data[0] = 0", "data += [4]", "data.size = 3"]:
+        plan = plan_replay(lineage("data = [1, 2, 3]", change), ["data"])
+        assert replayed(plan) == ["data = [1, 2, 3]", change], change
+
+
+def test_method_calls_on_modules_dont_change_them():
+    plan = plan_replay(lineage("import os", "x = 1", "os.getcwd()"), ["os"])
+    assert replayed(plan) == ["import os"]
+
+
+def test_cell_names_splits_bindings_and_changes():
+    names = cell_names("x = 1\ny.a = 2\nz[0] += 1\nw += 1")
+    assert names is not None
+    assert names.stores == {"x", "w"}
+    assert names.mutates == {"y", "z", "w"}
+    assert names.reads >= {"y", "z", "w"}
+
+
+def test_calling_a_function_needs_the_globals_it_reads():
+    plan = plan_replay(
+        lineage("def f():\n    return len(data)", "data = slow()", "n = f()"), ["n"]
+    )
+    assert replayed(plan) == [
+        "def f():\n    return len(data)",
+        "data = slow()",
+        "n = f()",
+    ]
+
+    plan = plan_replay(
+        lineage(
+            "def g():\n    return data",
+            "def f():\n    return g()",
+            "data = slow()",
+            "other = 1",
+            "n = f()",
+        ),
+        ["n"],
+    )
+    assert "data = slow()" in replayed(plan)
+    assert "other = 1" not in replayed(plan)
+
+
+@pytest.mark.parametrize(
+    "binding",
+    [
+        "if False:\n    x = 2",
+        "try:\n    x = fails()\nexcept Exception:\n    pass",
+        "for x in []:\n    pass",
+        "with context():\n    x = 2",
+    ],
+)
+def test_a_binding_that_may_not_run_keeps_the_old_definition(binding):
+    plan = plan_replay(lineage("x = slow()", binding, "y = x"), ["y"])
+    assert replayed(plan) == ["x = slow()", binding, "y = x"]
+
+
+def test_replay_stops_at_the_first_cell_that_fails():
+    console = PaiConsole(FakeLLM())
+    for code in ["a = 1", "b = undefined", "c = a + 1"]:
+        console.exec(code)
+    console.restart()
+    events = list(console.streaming_replay())
+    assert "Stopped at [2] b = undefined, which failed" in events[-2].value
+    assert console.exec("'c' in dir()").value == "False\n"
+    console.close()
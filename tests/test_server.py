@@ -0,0 +1,56 @@
+import asyncio
+import json
+import re
+
+from pai.llms.fake import FakeLLM
+from pai.server import PaiServer
+
+
+async def request(path, method, url, body=None):
+    reader, writer = await asyncio.open_unix_connection(path)
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(
+        f"{method} {url} HTTP/1.1\r\nAuthorization: Bearer token\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+    )
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(content)
+
+
+def test_bad_fields_are_rejected_and_handler_errors_get_a_response(tmp_path):
+    server = PaiServer(FakeLLM(chunk_delay=0), token="token")
+
+    async def fail(body):
+        raise RuntimeError("a bug")
+
+    server._routes.append(("GET", re.compile(r"/fail"), fail))
+    path = str(tmp_path / "pai.sock")
+
+    async def main():
+        serving = asyncio.ensure_future(server.serve(unix_path=path))
+        while not (tmp_path / "pai.sock").exists():
+            await asyncio.sleep(0.01)
+        try:
+            _, session = await request(path, "POST", "/sessions")
+            gen = f"/sessions/{session['id']}/gen"
+            assert await request(
+                path, "POST", gen, {"prompt": "", "candidates": "2"}
+            ) == (
+                400,
+                {"error": "candidates must be an integer"},
+            )
+            assert await request(path, "POST", gen, {"prompt": "", "agent": "no"}) == (
+                400,
+                {"error": "agent must be true or false"},
+            )
+            assert await request(path, "GET", "/fail") == (
+                500,
+                {"error": "RuntimeError('a bug')"},
+            )
+        finally:
+            serving.cancel()
+            await asyncio.gather(serving, return_exceptions=True)
+
+    asyncio.run(main())